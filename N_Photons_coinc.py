@@ -6,6 +6,12 @@
 This script gives the N-Photon coincidence rate as a function of the transmission of the setup. We also give
 the value with the best values we found in experimental papers in the literature.
 
+sweep_C_rate evaluates the rate on grids of any of the parameters at once, in log10 to avoid the underflow of
+T_tot**N at large N:
+    rates = sweep_C_rate(N=np.arange(2, 13), Brightness_device=np.linspace(0.1, 1, 100), T_chip=np.linspace(0.1, 1, 100))
+    rates.dims                                  # ('N', 'Brightness_device', 'T_chip')
+    rates.sel(N=6).values                       # (100, 100) map of log10 of the rate [Hz]
+
 """
 
 import numpy as np
@@ -15,6 +21,12 @@ from plotly.graph_objs import *
 from deepdiff import DeepDiff
 import copy
 
+import pandas as pd
+
+from profiling import stage
+from job_queue import submit, show_progress
+from nphoton_model import fourier_coincidences
+
 
 # Deadtime of the DMX
 def ff_DMX(N, t_switch, max_delay_photons):
@@ -33,19 +45,202 @@ def C_rate(N, t_switch, max_delay_photons, RepetitionRate, Brightness_device, T_
 
     return RepetitionRate * ff_DMX(N, t_switch, max_delay_photons) * 1e6 / N * T_tot ** N / Factor_postseclect
 
+# Parameters of C_rate, in the order of the dimensions of sweep_C_rate
+SWEEP_PARAMETERS = ('N', 't_switch', 'max_delay_photons', 'RepetitionRate', 'Brightness_device', 'T_DMX', 'T_chip',
+                    'T_detec', 'Factor_postseclect')
+
+# Best experimental values in the literature, used for the parameters that are not swept
+BEST_VALUES = {'t_switch': 60,  # [ns]
+               'max_delay_photons': 1000,  # [ns]
+               'RepetitionRate': 320,  # [MHz]
+               'Brightness_device': 0.57,
+               'T_DMX': 0.80,
+               'T_chip': 0.70,
+               'T_detec': 0.9,
+               'Factor_postseclect': 8}
+
+# Ranges of the maps
+SWEEP_RANGES = {'t_switch': (1, 200),
+                'max_delay_photons': (250, 10000),
+                'RepetitionRate': (10, 1000),
+                'Brightness_device': (0.01, 1),
+                'T_DMX': (0.01, 1),
+                'T_chip': (0.01, 1),
+                'T_detec': (0.01, 1),
+                'Factor_postseclect': (1, 64)}
+
+
+class LabelledArray:
+    """
+    Array whose dimensions have names and coordinates, e.g. the log10 of the rate returned by sweep_C_rate.
+    """
+
+    def __init__(self, values, dims, coords):
+        self.values = values
+        self.dims = tuple(dims)
+        self.coords = coords
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def sel(self, **selection):
+        """
+        :param selection: dimension=value, the nearest coordinate is taken and the dimension is dropped
+        :return: LabelledArray
+        """
+        index = [slice(None)] * len(self.dims)
+        for name, value in selection.items():
+            index[self.dims.index(name)] = int(np.argmin(np.abs(self.coords[name] - value)))
+        dims = [name for name in self.dims if name not in selection]
+        return LabelledArray(self.values[tuple(index)], dims, {name: self.coords[name] for name in dims})
+
+    def to_frame(self, name='value'):
+        """
+        :return: DataFrame - one line per point, one column per dimension
+        """
+        index = pd.MultiIndex.from_product([self.coords[dim] for dim in self.dims], names=self.dims)
+        return pd.DataFrame({name: self.values.ravel()}, index=index).reset_index()
+
+
+def log_C_rate(N, t_switch, max_delay_photons, RepetitionRate, Brightness_device, T_DMX, T_chip, T_detec,
+               Factor_postseclect):
+    """
+    log10 of C_rate, the parameters being numbers or arrays that broadcast together.
+
+    :return: array - log10 of the N-photon coincidence rate [Hz], -inf where the DMX is never open
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ff = np.log10(np.clip(ff_DMX(N, t_switch, max_delay_photons), 0, None))
+        log_T_tot = np.log10(Brightness_device) + np.log10(T_DMX) + np.log10(T_chip) + np.log10(T_detec)
+        return np.log10(RepetitionRate * 1e6) + log_ff - np.log10(N) + N * log_T_tot - np.log10(Factor_postseclect)
+
+
+def sweep_C_rate(**parameters):
+    """
+    N-photon coincidence rate on a grid of parameters.
+
+    :param parameters: name=value for the parameters of C_rate (SWEEP_PARAMETERS). A number is fixed, a sequence is a
+    dimension of the grid. Not given: BEST_VALUES, and N from 2 to 12.
+    :return: LabelledArray - log10 of the rate [Hz], dimensions in the order of SWEEP_PARAMETERS
+    """
+    unknown = set(parameters) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown parameters: %s' % ', '.join(sorted(unknown)))
+    values = {'N': np.arange(2, 12 + 1), **BEST_VALUES, **parameters}
+
+    dims = [name for name in SWEEP_PARAMETERS if np.ndim(values[name]) > 0]
+    coords = {name: np.asarray(values[name]) for name in dims}
+    # Each swept parameter along its own axis
+    arguments = {}
+    for name in SWEEP_PARAMETERS:
+        if name in coords:
+            shape = [1] * len(dims)
+            shape[dims.index(name)] = -1
+            arguments[name] = coords[name].reshape(shape)
+        else:
+            arguments[name] = values[name]
+    log_rate = log_C_rate(**arguments)
+    return LabelledArray(np.broadcast_to(log_rate, tuple(len(coords[name]) for name in dims)), dims, coords)
+
+
+# Transmissions whose product is T_tot
+TRANSMISSIONS = ('Brightness_device', 'T_DMX', 'T_chip', 'T_detec')
+
+
+def required_parameter(name, target_rate, **parameters):
+    """
+    Value of one parameter for which the N-photon rate reaches target_rate, the others being fixed. The rate is a power
+    of each parameter (T_tot**N, RepetitionRate, 1 / Factor_postseclect, and ff_DMX is linear in t_switch and in
+    1 / max_delay_photons): the equation is inverted in closed form, in log10.
+
+    :param name: str - parameter of SWEEP_PARAMETERS, except N
+    :param target_rate: float or array - N-photon coincidence rate [Hz]
+    :param parameters: name=value for the other parameters, numbers or arrays that broadcast together. Not given:
+    BEST_VALUES, and N from 2 to 12.
+    :return: array - minimum value of the parameter, maximum for t_switch and Factor_postseclect. Values out of their
+    physical range (a transmission above 1...) mean that the target cannot be reached, NaN that no value reaches it.
+    """
+    values = {'N': np.arange(2, 12 + 1), **BEST_VALUES, **parameters}
+    N, t_switch, max_delay = values['N'], values['t_switch'], values['max_delay_photons']
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # Decades of rate that are missing
+        missing = np.log10(target_rate) - log_C_rate(**values)
+        if name in TRANSMISSIONS:
+            return values[name] * 10 ** (missing / N)
+        if name == 'RepetitionRate':
+            return values[name] * 10 ** missing
+        if name == 'Factor_postseclect':
+            return values[name] * 10 ** -missing
+        # Fill factor of the DMX that is needed, from the rate with the DMX always open
+        ff = 10 ** (np.log10(target_rate) - log_C_rate(**{**values, 't_switch': 0}))
+        if name == 't_switch':
+            return np.where(ff <= 1, (1 - ff) * max_delay / (N - 1), np.nan)
+        if name == 'max_delay_photons':
+            return np.where(ff < 1, t_switch * (N - 1) / (1 - ff), np.nan)
+    raise ValueError('Unknown parameter: %s' % name)
+
+
+def max_photons(target_rate, n_max=64, **parameters):
+    """
+    Largest number of photons whose coincidence rate reaches target_rate. The rate decreases with N: it is found by
+    bisection on the integers, on all the points of the grid at once.
+
+    :param target_rate: float or array - N-photon coincidence rate [Hz]
+    :param n_max: int - upper bound of the search
+    :param parameters: as required_parameter, without N
+    :return: array - largest N >= 2, NaN where even 2 photons do not reach the target
+    """
+    values = {**BEST_VALUES, **parameters}
+    log_target = np.log10(target_rate)
+    # The rate is reached at lower and not at upper
+    lower = np.full(np.broadcast(log_target, *values.values()).shape, 2)
+    upper = np.full_like(lower, n_max + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reached = log_C_rate(lower, **values) >= log_target
+        for _ in range(int(np.ceil(np.log2(n_max)))):
+            middle = (lower + upper) // 2
+            above = log_C_rate(middle, **values) >= log_target
+            lower = np.where(above, middle, lower)
+            upper = np.where(above, upper, middle)
+    return np.where(reached, lower, np.nan)
+
+
+def pareto_frontier(target_rate, x_name, y_name, N=None, n_points=200, **parameters):
+    """
+    Minimum values of two transmissions that reach target_rate, for every N: below the frontier the rate is too low.
+    Only their product matters, so the frontier of N is x * y = P(N) with P(N) <= x, y <= 1.
+
+    :param x_name, y_name: str - two of TRANSMISSIONS
+    :param N: array - numbers of photons, from 2 to 12 by default
+    :param n_points: int - number of points of each frontier
+    :param parameters: values of the other parameters, BEST_VALUES by default
+    :return: DataFrame - 'N', x_name, y_name, one line per point, the N whose target cannot be reached are dropped
+    """
+    N = np.arange(2, 12 + 1) if N is None else np.asarray(N)
+    # Minimum of x with y = 1: the product needed
+    product = required_parameter(x_name, target_rate, **{**parameters, 'N': N, y_name: 1.})[:, np.newaxis]
+    # From (P, 1) to (1, P), with points evenly spaced in log
+    s = np.linspace(0, 1, n_points)[np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = product ** (1 - s)
+    frontier = pd.DataFrame({'N': np.repeat(N, n_points), x_name: x.ravel(), y_name: (product / x).ravel()})
+    return frontier[np.repeat(product[:, 0] <= 1, n_points)].reset_index(drop=True)
+
+
 def main():
 
     with st.sidebar:
 
         # Best experimental values in the literature
-        RepetitionRate = 320  # in MHz
-        Brightness_device = 0.57
-        T_DMX = 0.80
-        T_chip = 0.70
-        T_detec = 0.9
-        t_switch = 60  # [ns]
-        max_delay_photons = 1000  # [ns]
-        Factor_postseclect = 8
+        RepetitionRate = BEST_VALUES['RepetitionRate']  # in MHz
+        Brightness_device = BEST_VALUES['Brightness_device']
+        T_DMX = BEST_VALUES['T_DMX']
+        T_chip = BEST_VALUES['T_chip']
+        T_detec = BEST_VALUES['T_detec']
+        t_switch = BEST_VALUES['t_switch']  # [ns]
+        max_delay_photons = BEST_VALUES['max_delay_photons']  # [ns]
+        Factor_postseclect = BEST_VALUES['Factor_postseclect']
 
         RepetitionRate = st.number_input('Repetition rate of the laser [MHz]',
                                          value=RepetitionRate,
@@ -77,15 +272,14 @@ def main():
         if colb.button('?'):
             plot_DMX = True
 
-            # Def x-axis, y-axis and the meshgrid
+            # Def x-axis and y-axis, broadcast against each other
             N = np.arange(2, 12 + 1)
             list_delay_photons = np.linspace(250, 10000, 200)
-            X, Y = np.meshgrid(N, list_delay_photons)
 
             layout = Layout(
                 plot_bgcolor='whitesmoke'
             )
-            fig1 = go.Figure(go.Surface(z=ff_DMX(X, t_switch, Y) * T_DMX,
+            fig1 = go.Figure(go.Surface(z=ff_DMX(N[np.newaxis, :], t_switch, list_delay_photons[:, np.newaxis]) * T_DMX,
                                         x=N,
                                         y=list_delay_photons,
                                         cmin=0,
@@ -137,7 +331,8 @@ def main():
 
     if plot_DMX:
         st.write('Press R to quit this mode.')
-        st.plotly_chart(fig1)
+        with stage('plot'):
+            st.plotly_chart(fig1)
 
     current_values = {'RepetitionRate': RepetitionRate,
                       'Brightness_device': Brightness_device,
@@ -203,7 +398,8 @@ def main():
     fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
     fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
     fig.update_yaxes(type="log")
-    st.plotly_chart(fig)
+    with stage('plot'):
+        st.plotly_chart(fig)
 
     with st.expander("Detailed report on previous plot"):
         for id, dat in enumerate(st.session_state.saved_data):
@@ -212,6 +408,114 @@ def main():
             st.write(f"Saved values {id}")
             st.write(DeepDiff(current_values, temporary_dat))
 
+    with st.expander("Requirement solver"):
+        # Which values of the components reach a target rate, the others being at their current values
+        current = {'t_switch': t_switch, 'max_delay_photons': max_delay_photons, 'RepetitionRate': RepetitionRate,
+                   'Brightness_device': Brightness_device, 'T_DMX': T_DMX, 'T_chip': T_chip, 'T_detec': T_detec,
+                   'Factor_postseclect': Factor_postseclect}
+        col1, col2, col3 = st.columns(3)
+        target_rate = col1.number_input('Target N-photon rate [Hz]', value=1.0, min_value=1e-6, format='%g')
+        x_name = col2.selectbox('X-axis', TRANSMISSIONS, index=0, key='x_requirement')
+        y_name = col3.selectbox('Y-axis', TRANSMISSIONS, index=2, key='y_requirement')
+
+        n_reached = max_photons(target_rate, **current)
+        if np.isnan(n_reached):
+            st.write(f"Even 2 photons do not reach {target_rate:g} Hz with the current values.")
+        else:
+            st.write(f"Up to {n_reached:.0f} photons reach {target_rate:g} Hz with the current values.")
+        requirements = pd.DataFrame({name: required_parameter(name, target_rate, N=N, **current)
+                                     for name in SWEEP_PARAMETERS[1:]}, index=pd.Index(N, name='N'))
+        st.write('Minimum value of each parameter alone (maximum for t_switch and Factor_postseclect). A transmission '
+                 'above 1 cannot be reached.')
+        st.dataframe(requirements)
+
+        if x_name == y_name:
+            st.warning('Choose two different transmissions.')
+        else:
+            frontier = pareto_frontier(target_rate, x_name, y_name, N=N, **current)
+            fig4 = go.Figure(layout=Layout(plot_bgcolor='whitesmoke'))
+            for n, line in frontier.groupby('N'):
+                fig4.add_trace(go.Scatter(x=line[x_name], y=line[y_name], mode='lines', line=dict(width=3),
+                                          name=f'N = {n}'))
+            fig4.add_trace(go.Scatter(x=[current[x_name]], y=[current[y_name]], mode='markers',
+                                      marker=dict(size=12, color='seagreen', symbol='square'), name='Current values'))
+            fig4.update_layout(title=f'Minimum values for {target_rate:g} Hz',
+                               width=900, height=600,
+                               margin=dict(l=40, r=40, b=40, t=40),
+                               xaxis_title=x_name,
+                               yaxis_title=y_name,
+                               font=dict(
+                                   family="Courier New, monospace",
+                                   size=18,
+                                   color="White"
+                               )
+                               )
+            fig4.update_xaxes(range=[0, 1], showgrid=True, gridwidth=1, gridcolor='dimgrey')
+            fig4.update_yaxes(range=[0, 1], showgrid=True, gridwidth=1, gridcolor='dimgrey')
+            with stage('plot'):
+                st.plotly_chart(fig4)
+
+    with st.expander("Map of the coincidence rate"):
+        # Two parameters swept over their range, the others at their current values
+        col1, col2, col3 = st.columns(3)
+        x_name = col1.selectbox('X-axis', list(SWEEP_RANGES), index=list(SWEEP_RANGES).index('Brightness_device'),
+                                key='x_map')
+        y_name = col2.selectbox('Y-axis', list(SWEEP_RANGES), index=list(SWEEP_RANGES).index('T_chip'), key='y_map')
+        n_map = col3.number_input('N-photon', value=6, min_value=2, max_value=12, step=1)
+        if x_name == y_name:
+            st.warning('Choose two different parameters.')
+        else:
+            grids = {name: np.linspace(*SWEEP_RANGES[name], 300) for name in (x_name, y_name)}
+            rates = sweep_C_rate(**{**current, **grids, 'N': int(n_map)})
+            log_rate = rates.values if rates.dims == (y_name, x_name) else rates.values.T
+            fig3 = go.Figure(go.Heatmap(x=grids[x_name], y=grids[y_name], z=log_rate,
+                                        colorbar=dict(title='log10 rate [Hz]')))
+            fig3.update_layout(width=900, height=600,
+                               margin=dict(l=40, r=40, b=40, t=40),
+                               xaxis_title=x_name,
+                               yaxis_title=y_name,
+                               font=dict(
+                                   family="Courier New, monospace",
+                                   size=18,
+                                   color="White"
+                               )
+                               )
+            with stage('plot'):
+                st.plotly_chart(fig3)
+
+    with st.expander("N-photon interference of imperfect sources"):
+        # Fourier interferometer: the N-fold coincidence is suppressed for N identical photons, N even
+        col1, col2, col3, col4 = st.columns(4)
+        g2 = col1.number_input('g2', value=0.02, min_value=0.0, max_value=0.5, step=0.01)
+        M = col2.number_input('Indistinguishability', value=0.9, min_value=0.0, max_value=1.0, step=0.05)
+        n_max = col3.number_input('Up to N', value=8, min_value=2, max_value=12, step=1)
+        multiphoton_model = col4.selectbox('Multiphoton model', ("distinguishable", "indistinguishable"))
+        T_tot = Brightness_device * T_DMX * T_chip * T_detec
+
+        job = submit(fourier_coincidences, int(n_max), T_tot, g2, M, multiphoton_model=multiphoton_model)
+        with stage('permanents'):
+            coincidences = show_progress(job, 'Computing the N-photon interference...')
+        if coincidences is not None:
+            fig2 = go.Figure(layout=Layout(plot_bgcolor='whitesmoke'))
+            for name in ('ideal', 'distinguishable', 'imperfect'):
+                fig2.add_trace(go.Scatter(x=coincidences['N'], y=coincidences[name], line=dict(width=3),
+                                          marker=dict(size=10), name=name))
+            fig2.update_layout(width=900, height=600,
+                               margin=dict(l=40, r=40, b=40, t=40),
+                               xaxis_title="N-photon",
+                               yaxis_title="P(one photon per output | N photons)",
+                               font=dict(
+                                   family="Courier New, monospace",
+                                   size=18,
+                                   color="White"
+                               )
+                               )
+            fig2.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
+            fig2.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
+            with stage('plot'):
+                st.plotly_chart(fig2)
+            st.dataframe(coincidences)
+
 
 if __name__ == '__main__':
     main()
@@ -8,7 +8,12 @@ import numpy as np
 from scipy.signal import find_peaks, peak_widths
 import matplotlib.pyplot as plt
 
+from result_cache import cached
+from profiling import timed
 
+
+@timed('find_sidepeaks')
+@cached('find_sidepeaks')
 def find_sidepeaks(data):
     # Peak finder
     # peaks is a list of the index of all peaks with a certain prominence and width
@@ -68,6 +73,7 @@ def get_baseline(data, central_pk, pk_width, pk_sep, num_pks):
         return bg
 
 
+@timed('integration')
 def get_g2_1input(dat_g2, peak_width, peak_sep, central_peak, num_peaks, baseline=True):
     if baseline:
         bg = get_baseline(dat_g2, central_peak, peak_width, peak_sep, num_peaks)
@@ -97,6 +103,7 @@ def get_g2_1input(dat_g2, peak_width, peak_sep, central_peak, num_peaks, baselin
     return g2
 
 
+@timed('integration')
 def get_HOM_1input(dat_HOM, peak_width, peak_sep, central_peak, num_peaks, baseline=True):
     if baseline:
         bg = get_baseline(dat_HOM, central_peak, peak_width, peak_sep, num_peaks)
@@ -127,6 +134,27 @@ def get_HOM_1input(dat_HOM, peak_width, peak_sep, central_peak, num_peaks, basel
     return V
 
 
+@cached('poisson_error')
+def poisson_error(estimator, data, peak_width, peak_sep, central_peak, num_peaks, baseline=True, n_sim=100,
+                  job=None):
+    """
+    :param estimator: function - get_g2_1input or get_HOM_1input
+    :param data: list - histogram of 2-photon correlation
+    :param n_sim: int - number of histograms drawn from a Poisson distribution
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: float - standard deviation of the estimator over the simulated histograms
+    """
+    values = []
+    for sim in range(n_sim):
+        values.append(estimator(np.random.poisson(data), peak_width, peak_sep, central_peak, num_peaks,
+                                baseline=baseline))
+        if job is not None:
+            job.set_progress((sim + 1) / n_sim)
+
+    return np.std(values)
+
+
+@timed('integration')
 def get_HOM_2input(HOM_ortho, HOM_para, num_peaks=6, baseline=True, plotit=False, manualmode=False,
                    ct_peak=1557, peak_sp=190, peak_w=35):
     """
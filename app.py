@@ -31,6 +31,8 @@ import fit_reflectivity
 import fit_PL
 import N_Photons_coinc
 import imperfect_SPS
+from result_cache import show_cache_stats
+from profiling import start_run, end_run, show_profile_panel
 
 choose_functionality = st.selectbox('What are we fitting today?',
                                     ('Select an option',
@@ -76,22 +78,31 @@ if choose_functionality =='Select an option':
         unsafe_allow_html=True,
     )
 
-if choose_functionality =='Lifetime':
-    fit_lifetime.main()
-if choose_functionality =='HOM sidepeaks':
-    fit_HOM.main()
-if choose_functionality == 'HOM ortho/para':
-    fit_2HOM.main()
-if choose_functionality =='g2':
-    fit_g2.main()
-if choose_functionality == 'Reflectivity':
-    fit_reflectivity.main()
-if choose_functionality == 'Photoluminescence':
-    fit_PL.main()
-if choose_functionality == 'Pulse calculator':
-    pulse_calculator.main()
-if choose_functionality == 'N-photon coincidence':
-    N_Photons_coinc.main()
-if choose_functionality == 'Phenomenological model':
-    imperfect_SPS.main()
-
+# Time and peak memory of each stage of the page (also dumped to a file when FITMYDATA_PROFILE is set)
+profiling = st.sidebar.checkbox('Profiling', help='Shows the time and peak memory of each stage of the page')
+start_run(enabled=profiling)
+try:
+    if choose_functionality =='Lifetime':
+        fit_lifetime.main()
+    if choose_functionality =='HOM sidepeaks':
+        fit_HOM.main()
+    if choose_functionality == 'HOM ortho/para':
+        fit_2HOM.main()
+    if choose_functionality =='g2':
+        fit_g2.main()
+    if choose_functionality == 'Reflectivity':
+        fit_reflectivity.main()
+    if choose_functionality == 'Photoluminescence':
+        fit_PL.main()
+    if choose_functionality == 'Pulse calculator':
+        pulse_calculator.main()
+    if choose_functionality == 'N-photon coincidence':
+        N_Photons_coinc.main()
+    if choose_functionality == 'Phenomenological model':
+        imperfect_SPS.main()
+finally:
+    end_run()
+    if profiling:
+        show_profile_panel()
+    # Hit/miss statistics of the result cache, to tune its size (also when the page stopped early)
+    show_cache_stats()
@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Benchmarks of the public functions of the toolbox on synthetic data.
+
+The generators are seeded, so a given size always gives the same data:
+- synthetic_histogram: pulsed g2 or HOM correlation histogram
+- synthetic_decay: lifetime histogram of a pulse train (exciton or trion)
+- synthetic_spectrum: reflectivity dip or PL line on a CCD energy axis
+- write_ptu: HydraHarp T2 (correlation) or T3 (lifetime) .ptu file
+
+Each case is timed for every requested size (number of bins, pixels or records, 10^4 to 10^8) and appended to a
+history file together with the current git commit. With --compare, the timings are compared to the last run of
+another commit on the same machine and the script fails if one of them is slower than the threshold.
+
+python benchmarks.py --sizes 1e4 1e5 1e6
+python benchmarks.py --sizes 1e4 1e6 --filter fit_lifetime --compare --threshold 0.25
+
+With --check-models, the closed forms of mzi_model that replace Perceval in imperfect_SPS (mzi_outcomes,
+mzi_fock_outcomes) are compared to Perceval on random sources and phases instead, and the script fails if they differ.
+
+python benchmarks.py --check-models
+
+The result cache is disabled, otherwise all the repeats but the first would be cache hits.
+
+"""
+
+import argparse
+import inspect
+import json
+import os
+import platform
+import struct
+import subprocess
+import tempfile
+import time
+
+# Must be set before the modules using the cache are imported
+os.environ['FITMYDATA_CACHE_ENTRIES'] = '0'
+os.environ.pop('FITMYDATA_CACHE_DIR', None)
+
+import numpy as np
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.benchmarks', 'history.jsonl')
+
+
+# SYNTHETIC DATA
+
+def synthetic_histogram(n_bins, kind='g2', peak_sep=190, peak_width=35, counts=2000, value=0.03, background=2,
+                        seed=0):
+    """
+    :param n_bins: int - length of the histogram
+    :param kind: str - 'g2' or 'HOM'
+    :param value: float - g2(0) for 'g2', V_HOM for 'HOM'
+    :return: array - Poisson distributed histogram with the central peak in the middle
+    """
+    rng = np.random.default_rng(seed)
+    time_bin = np.arange(n_bins)
+    central_peak = n_bins // 2
+    k = np.round((time_bin - central_peak) / peak_sep)
+    distance = time_bin - central_peak - k * peak_sep
+
+    amplitude = np.full(n_bins, float(counts))
+    if kind == 'HOM':
+        # Unbalanced MZI: the peaks at ±1 delay are 3/4 of the uncorrelated peaks
+        amplitude[np.abs(k) == 1] *= 0.75
+        amplitude[k == 0] *= (1 - value) / 2
+    else:
+        amplitude[k == 0] *= value
+
+    sigma = peak_width / 6
+    hist = background + amplitude * np.exp(-distance ** 2 / (2 * sigma ** 2))
+    return rng.poisson(hist).astype(float)
+
+
+def synthetic_decay(n_bins, resolution=0.004, period=12.5, tau=0.145, w=4., counts=5000, background=5,
+                    exciton=True, seed=0):
+    """
+    :param n_bins: int - length of the histogram
+    :param resolution: float - time bin [ns]
+    :param period: float - repetition period of the laser [ns]
+    :param tau: float - lifetime [ns]
+    :param w: float - pulsation of the fine structure beat [rad/ns], only for exciton=True
+    :return: array - Poisson distributed histogram of a train of decays, the first one starting after 1 ns
+    """
+    rng = np.random.default_rng(seed)
+    t = resolution * np.arange(n_bins)
+    # time since the last pulse, the first pulse arrives at 1 ns
+    t_pulse = (t - 1.) % period
+    decay = counts * np.exp(-t_pulse / tau)
+    if exciton:
+        decay *= np.sin(w * t_pulse + np.pi / 4) ** 2 * 2
+    decay[t < 1.] = 0
+    return rng.poisson(background + decay).astype(float)
+
+
+def synthetic_spectrum(n_px, kind='reflectivity', spectro=924.4782, calib=45.34942, kappa=100e-6, depth=0.5,
+                       counts=10000, seed=0):
+    """
+    :param n_px: int - number of pixels of the CCD
+    :param kind: str - 'reflectivity' (Lorentzian dip on a linear background) or 'PL' (Lorentzian line)
+    :param kappa: float - FWHM of the mode or line [eV]
+    :return: array, array - energy axis [eV] (as px_to_eV for px = 1...n_px) and counts. The mode is in the middle.
+    """
+    rng = np.random.default_rng(seed)
+    px = np.arange(1, n_px + 1)
+    X = 1239.8 / (spectro - (670 - px) * 1 / calib)
+    xc = X[n_px // 2]
+    lorentzian = (kappa / 2) ** 2 / ((X - xc) ** 2 + (kappa / 2) ** 2)
+    if kind == 'PL':
+        signal = 50 + counts * lorentzian
+    else:
+        slope = np.linspace(0.95, 1.05, n_px)
+        signal = counts * slope * (1 - depth * lorentzian)
+    return X, rng.poisson(signal).astype(float)
+
+
+# PTU tag types
+tyEmpty8 = 0xFFFF0008
+tyInt8 = 0x10000008
+tyFloat8 = 0x20000008
+tyAnsiString = 0x4001FFFF
+# HydraHarp V2 record types
+rtHydraHarp2T2 = 0x01010204
+rtHydraHarp2T3 = 0x01010304
+
+
+def _ptu_tag(ident, value, tag_type):
+    header = struct.pack('<32siI', ident.encode(), -1, tag_type)
+    if tag_type == tyFloat8:
+        return header + struct.pack('<d', value)
+    if tag_type == tyAnsiString:
+        string = value.encode() + b'\x00' * (8 - len(value) % 8)
+        return header + struct.pack('<q', len(string)) + string
+    return header + struct.pack('<q', value)
+
+
+def _insert_overflows(records, n_overflows, shift):
+    # Insert an overflow record (special bit + channel 63) before each record following one or more wraparounds.
+    # n_overflows is the cumulated number of wraparounds before each record.
+    jumps = np.diff(n_overflows, prepend=0)
+    where = np.nonzero(jumps)[0]
+    overflows = (1 << 31) | (63 << shift) | jumps[where].astype(np.uint32)
+    return np.insert(records, where, overflows.astype(np.uint32))
+
+
+def write_ptu(path, n_records, mode='T2', resolution=4e-12, sync_rate=80e6, tau=0.145e-9, jitter=20e-12,
+              count_rate=1e6, seed=0):
+    """
+    Write a HydraHarp V2 .ptu file.
+    T2: photons of a pulsed single photon source on channels 1 and 2 (HBT), timetags in ps.
+    T3: photons on channel 1 with a sync-relative delay following an exponential decay of lifetime tau.
+
+    :param n_records: int - number of photon records (overflow records come on top)
+    :param resolution: float - resolution of the dtime for T3 [s]
+    :return: str - path
+    """
+    rng = np.random.default_rng(seed)
+    period = 1 / sync_rate
+    # Pulses giving a detected photon: the gaps between them follow a geometric law
+    pulses = np.cumsum(rng.geometric(min(count_rate / sync_rate, 1.), n_records)).astype(np.int64)
+    delay = rng.exponential(tau, n_records) + rng.normal(0, jitter, n_records)
+
+    if mode == 'T2':
+        global_resolution = 1e-12
+        timetag = np.round((pulses * period + delay) / global_resolution).astype(np.int64)
+        channel = rng.integers(0, 2, n_records).astype(np.uint32)
+        order = np.argsort(timetag, kind='stable')
+        timetag, channel = timetag[order], channel[order]
+        wraparound = 33554432
+        records = (channel << 25) | (timetag % wraparound).astype(np.uint32)
+        records = _insert_overflows(records, timetag // wraparound, 25)
+        record_type = rtHydraHarp2T2
+        measurement_mode = 2
+    else:
+        global_resolution = period
+        dtime = np.clip(np.round(np.abs(delay) / resolution), 0, 2 ** 15 - 1).astype(np.uint32)
+        wraparound = 1024
+        records = (dtime << 10) | (pulses % wraparound).astype(np.uint32)
+        records = _insert_overflows(records, pulses // wraparound, 25)
+        record_type = rtHydraHarp2T3
+        measurement_mode = 3
+
+    tags = [('File_GUID', '{00000000-0000-0000-0000-000000000000}', tyAnsiString),
+            ('Measurement_Mode', measurement_mode, tyInt8),
+            ('MeasDesc_BinningFactor', 1, tyInt8),
+            ('MeasDesc_Resolution', resolution if mode == 'T3' else global_resolution, tyFloat8),
+            ('MeasDesc_GlobalResolution', global_resolution, tyFloat8),
+            ('HW_InpChannels', 2, tyInt8),
+            ('TTResult_SyncRate', int(sync_rate), tyInt8),
+            ('TTResultFormat_TTTRRecType', record_type, tyInt8),
+            ('TTResultFormat_BitsPerRecord', 32, tyInt8),
+            ('TTResult_NumberOfRecords', len(records), tyInt8),
+            ('Header_End', 0, tyEmpty8)]
+
+    with open(path, 'wb') as f:
+        f.write(b'PQTTTR\x00\x00' + b'1.0.00\x00\x00')
+        for ident, value, tag_type in tags:
+            f.write(_ptu_tag(ident, value, tag_type))
+        f.write(records.astype('<u4').tobytes())
+
+    return path
+
+
+# CASES
+
+class Case:
+
+    def __init__(self, module, function, make_args, scales=True):
+        """
+        :param module: str - module of the function
+        :param function: str - name of the function
+        :param make_args: function - size -> (args, kwargs)
+        :param scales: bool - False if the cost does not depend on the size (run once with size None)
+        """
+        self.module = module
+        self.function = function
+        self.make_args = make_args
+        self.scales = scales
+
+    @property
+    def name(self):
+        return self.module + '.' + self.function
+
+    def load(self):
+        # The undecorated function: no cache and no profiling stage
+        module = __import__(self.module)
+        return inspect.unwrap(getattr(module, self.function))
+
+
+def _histogram_args(kind):
+    def make_args(size):
+        data = synthetic_histogram(size, kind)
+        return (data,), {}
+    return make_args
+
+
+def _integration_args(kind, with_baseline=True):
+    def make_args(size):
+        from antibunching_toolbox import find_sidepeaks
+        data = synthetic_histogram(size, kind)
+        peaks, data_pk, central_peak, peak_sep, peak_width = find_sidepeaks(data)
+        return (data, peak_width, peak_sep, central_peak, 6), {'baseline': with_baseline}
+    return make_args
+
+
+def _baseline_args(size):
+    (data, peak_width, peak_sep, central_peak, num_peaks), _ = _integration_args('g2')(size)
+    return (data, central_peak, peak_width, peak_sep, num_peaks), {}
+
+
+def _poisson_error_args(size):
+    from antibunching_toolbox import get_g2_1input
+    args, kwargs = _integration_args('g2')(size)
+    return (get_g2_1input,) + args, kwargs
+
+
+def _hom_2input_args(size):
+    ortho = synthetic_histogram(size, 'HOM', value=0., seed=1)
+    para = synthetic_histogram(size, 'HOM', value=0.9, seed=1)
+    return (ortho, para), {}
+
+
+def _lifetime_window(size, exciton):
+    # Same window as fit_lifetime.main: from the first peak + 10 ps to 1 ns later
+    data = synthetic_decay(max(size, 1000), exciton=exciton)
+    first_peak = int(np.argmax(data[:int(2 / 0.004)]))
+    data_fit = data[first_peak + 2:first_peak + 250]
+    return data_fit, 0.004 * np.arange(len(data_fit))
+
+
+def _fit_X_args(size):
+    data_fit, x = _lifetime_window(size, True)
+    return (data_fit, x, 2380., 4., 0.145), {}
+
+
+def _fit_T_args(size):
+    data_fit, x = _lifetime_window(size, False)
+    return (data_fit, x, 2380., 0.145), {}
+
+
+def _fit_batch_args(size):
+    # 100 decays of a power series
+    data_fit, x = _lifetime_window(size, True)
+    rng = np.random.default_rng(0)
+    stack = rng.poisson(np.outer(np.linspace(0.5, 1.5, 100), data_fit)).astype(float)
+    return (stack, x, 'Exciton'), {}
+
+
+def _poisson_fit_args(size):
+    # Same decay and initial values as fit_lifetime_T
+    from lmfit import Parameters
+    from poisson_fit import exp_decay
+    data_fit, x = _lifetime_window(size, False)
+    pars = Parameters()
+    pars.add('y0', value=1., min=0)
+    pars.add('N0', value=2380.)
+    pars.add('tau', value=0.145)
+    return (exp_decay, pars, data_fit, x), {}
+
+
+def _fit_global_args(size):
+    # The same 100 decays as fit_lifetime_batch, fitted with a shared lifetime and FSS
+    (stack, x, _), _ = _fit_batch_args(size)
+    return (stack, x, 'Exciton', ('w', 'tau')), {}
+
+
+def _reconvolution_args(size):
+    # Window from 200 ps before the rise to 1 ns after, IRF of 20 ps rms at the rise
+    data = synthetic_decay(max(size, 1000), exciton=False)
+    t = 0.004 * np.arange(len(data))
+    irf = np.random.default_rng(1).poisson(1 + 1e4 * np.exp(-0.5 * ((t - 1.) / 0.020) ** 2)).astype(float)
+    window = slice(int(0.8 / 0.004), int(2. / 0.004))
+    return (data[window], irf[window], 0.004), {'n_exp': 2}
+
+
+def _axis_args(size):
+    return (924.4782, np.arange(1, size + 1), 45.34942), {}
+
+
+def _fit_cav_args(size):
+    X, Y = synthetic_spectrum(size, 'reflectivity')
+    center = size // 2
+    return (X, Y, max(center - 300, 0), min(center + 300, size), 1, 75), {}
+
+
+def _varpro_args(size):
+    # Window of 150 px around the mode with the initial values of fit_cav
+    from lmfit.models import LinearModel, LorentzianModel
+    X, Y = synthetic_spectrum(size, 'reflectivity')
+    window = slice(max(size // 2 - 75, 0), size // 2 + 75)
+    model = LinearModel(prefix='bkg_') + LorentzianModel(prefix='lz1_')
+    params = model.make_params(bkg_slope=0, bkg_intercept=0, lz1_center=X[size // 2 + 2], lz1_amplitude=-1000,
+                               lz1_sigma=100e-6)
+    return (params, Y[window], X[window]), {}
+
+
+def _cavity_stack_args(size):
+    # 64 noisy copies of the synthetic reflectivity spectrum
+    X, Y = synthetic_spectrum(size, 'reflectivity')
+    stack = np.random.default_rng(0).poisson(np.clip(Y, 0, None), (64, len(Y))).astype(float)
+    center = size // 2
+    return (X, stack, max(center - 300, 0), min(center + 300, size)), {}
+
+
+def _track_modes_args(size):
+    # The stack of fit_cav_batch as a series
+    (X, stack, start_search, stop_search), _ = _cavity_stack_args(size)
+    return (X, stack), {'start_search': start_search, 'stop_search': stop_search}
+
+
+def _fit_PL_args(size):
+    X, Y = synthetic_spectrum(size, 'PL')
+    return (X, Y, 1, 75, 924.4782, 45.34942), {}
+
+
+def _ptu_args(mode):
+    def make_args(size):
+        path = os.path.join(tempfile.gettempdir(), f'fitmydata_benchmark_{mode}_{size}.ptu')
+        if not os.path.exists(path):
+            write_ptu(path, size, mode)
+        return (path,), {}
+    return make_args
+
+
+def _ptu_file_args(mode):
+    def make_args(size):
+        from io import BytesIO
+        (path,), _ = _ptu_args(mode)(size)
+        with open(path, 'rb') as f:
+            upload = BytesIO(f.read())
+        upload.name = os.path.basename(path)
+        return (upload,), {}
+    return make_args
+
+
+def _winspec_args(size):
+    # Multi-frame Winspec export of size pixels in frames of 1340 pixels
+    path = os.path.join(tempfile.gettempdir(), f'fitmydata_benchmark_winspec_{size}.txt')
+    n_frames = max(size // 1340, 1)
+    if not os.path.exists(path):
+        _, Y = synthetic_spectrum(1340, 'reflectivity')
+        px = np.tile(np.arange(1, 1341), n_frames)
+        np.savetxt(path, np.column_stack((px, np.tile(Y, n_frames))), fmt='%d', delimiter='\t', newline='\r\n')
+    return (path, 1340), {}
+
+
+def _spe_args(size):
+    # SPE 2.x file of uint16 frames of 100 rows x 1340 px, size pixels once binned. The spectra are binned on 20 rows.
+    path = os.path.join(tempfile.gettempdir(), f'fitmydata_benchmark_{size}.spe')
+    n_frames = max(size // 1340, 1)
+    if not os.path.exists(path):
+        header = bytearray(4100)
+        struct.pack_into('<H', header, 42, 1340)
+        struct.pack_into('<h', header, 108, 3)
+        struct.pack_into('<H', header, 656, 100)
+        struct.pack_into('<i', header, 1446, n_frames)
+        _, Y = synthetic_spectrum(1340, 'reflectivity')
+        frame = np.tile(Y / 100, (100, 1)).astype(np.uint16).tobytes()
+        with open(path, 'wb') as f:
+            f.write(bytes(header))
+            for _ in range(n_frames):
+                f.write(frame)
+    return (path,), {'rows': (40, 60)}
+
+
+def _qpu_args(size):
+    from imperfect_SPS import QPU
+    return (QPU(), 0.9, 0.05, 0.02, 0.95), {}
+
+
+def _nphoton_args(size):
+    # N-fold coincidence of 8 sources in the 8-mode Fourier interferometer
+    from nphoton_model import fourier_unitary
+    return (fourier_unitary(8), np.ones((1, 8), dtype=int), 0.9, 0.8, 0.02, 0.9), {}
+
+
+CASES = [
+    Case('antibunching_toolbox', 'find_sidepeaks', _histogram_args('g2')),
+    Case('antibunching_toolbox', 'get_baseline', _baseline_args),
+    Case('antibunching_toolbox', 'get_g2_1input', _integration_args('g2')),
+    Case('antibunching_toolbox', 'get_HOM_1input', _integration_args('HOM')),
+    Case('antibunching_toolbox', 'get_HOM_2input', _hom_2input_args),
+    Case('antibunching_toolbox', 'poisson_error', _poisson_error_args),
+    Case('from_PTU', 'get_ptu_frompath', _ptu_args('T2')),
+    Case('from_PTU', 'get_ptu_fromfile', _ptu_file_args('T2')),
+    Case('from_PTU', 'get_lifetime_fromfile', _ptu_file_args('T3')),
+    Case('fit_lifetime', 'cosine_decay', lambda size: ((0.004 * np.arange(size), 1., 2380., 0., 4., 0.145), {})),
+    Case('fit_lifetime', 'exp_decay', lambda size: ((0.004 * np.arange(size), 1., 2380., 0., 0.145), {})),
+    Case('fit_lifetime', 'fit_lifetime_X', _fit_X_args, scales=False),
+    Case('fit_lifetime', 'fit_lifetime_T', _fit_T_args, scales=False),
+    Case('fit_lifetime', 'fit_lifetime_batch', _fit_batch_args, scales=False),
+    Case('lifetime_toolbox', 'fit_reconvolution', _reconvolution_args, scales=False),
+    Case('lifetime_toolbox', 'fit_global', _fit_global_args, scales=False),
+    Case('poisson_fit', 'poisson_fit', _poisson_fit_args, scales=False),
+    Case('fit_reflectivity', 'px_to_eV', _axis_args),
+    Case('spectro_toolbox', 'nm_to_eV', lambda size: ((np.linspace(900, 950, size),), {})),
+    Case('spectro_toolbox', 'eV_to_nm', lambda size: ((np.linspace(1.30, 1.38, size),), {})),
+    Case('spectro_toolbox', 'nearest_index', lambda size: ((np.linspace(1.38, 1.30, size), np.linspace(1.30, 1.38, 100)), {})),
+    Case('fit_reflectivity', 'get_WLaxis', lambda size: ((924.4782, size, 45.34942), {})),
+    Case('spectro_toolbox', 'load_winspec_frames', _winspec_args),
+    Case('from_SPE', 'get_spe_spectra', _spe_args),
+    Case('fit_reflectivity', 'fit_cav', _fit_cav_args),
+    Case('varpro_fit', 'varpro_fit', _varpro_args, scales=False),
+    Case('cavity_toolbox', 'detect_dips', lambda size: ((_cavity_stack_args(size)[0][1],), {})),
+    Case('cavity_toolbox', 'fit_cav_batch', _cavity_stack_args, scales=False),
+    Case('mode_tracker', 'track_modes', _track_modes_args, scales=False),
+    Case('fit_PL', 'get_Eaxis', lambda size: ((924.4782, size, 45.34942), {})),
+    Case('fit_PL', 'fit_lines', _fit_PL_args),
+    Case('imperfect_SPS', 'compute', _qpu_args, scales=False),
+    Case('imperfect_SPS', 'sweep_visibility',
+         lambda size: (('eta', np.linspace(0, 1, 15), 0.9, 0.05, 0.02, 0.95), {}), scales=False),
+    Case('imperfect_SPS', 'mzi_PhotonNumberTomography',
+         lambda size: ((np.linspace(0, 2 * np.pi, size),), {'eta': 0.5, 'g2': 0.03, 'M': 0.95})),
+    Case('mzi_model', 'mzi_fock_outcomes', lambda size: ((1, 0.5, 0.03, 0.95, np.linspace(0, 2 * np.pi, size)), {})),
+    Case('imperfect_SPS', 'probability_distribution', lambda size: ((0.9, 0.05, 0.02, 0.95), {}), scales=False),
+    Case('imperfect_SPS', 'relative_composition',
+         lambda size: ((0.9, np.linspace(0.01, 1, size)[:, np.newaxis], np.linspace(0, 0.5, 100), 0.95), {})),
+    Case('mzi_model', 'mzi_outcomes', lambda size: ((0.9, np.linspace(0, 1, size), 0.02, 0.95), {})),
+    Case('mzi_model', 'hom_visibility', lambda size: ((0.9, 0.05, np.linspace(0, 0.3, size), 0.95), {})),
+    Case('nphoton_model', 'permanent',
+         lambda size: ((np.random.default_rng(0).normal(size=(max(size // 4096, 1), 10, 10)),), {})),
+    Case('nphoton_model', 'nphoton_outcomes', _nphoton_args, scales=False),
+    Case('N_Photons_coinc', 'sweep_C_rate',
+         lambda size: ((), {'Brightness_device': np.linspace(0.01, 1, max(size // 1100, 1)),
+                            'T_chip': np.linspace(0.01, 1, 100)})),
+    Case('N_Photons_coinc', 'max_photons',
+         lambda size: ((1.,), {'Brightness_device': np.linspace(0.01, 1, max(size // 100, 1))[:, np.newaxis],
+                              'T_chip': np.linspace(0.01, 1, 100)})),
+    Case('N_Photons_coinc', 'pareto_frontier', lambda size: ((1., 'Brightness_device', 'T_chip'), {}), scales=False),
+]
+
+
+# MODEL CHECKS
+
+def perceval_outcomes(beta, eta, g2, M, phase, multiphoton_model='distinguishable'):
+    """
+    Reference of mzi_model: output of the MZI of imperfect_SPS simulated by Perceval (Naive backend), one source on
+    each input, as imperfect_SPS.compute does.
+
+    :return: dict - (photons in the mode 0, photons in the mode 1): probability
+    """
+    import perceval as pcvl
+    from imperfect_SPS import QPU
+    qpu = QPU()
+    sps = pcvl.Source(brightness=beta,
+                      overall_transmission=eta,
+                      multiphoton_component=g2,
+                      multiphoton_model=multiphoton_model,
+                      indistinguishability=M,
+                      indistinguishability_model="homv"
+                      )
+    qpu.phase_shifters[1].set_value(phase)
+    p = pcvl.Processor({0: sps, 1: sps, }, qpu.mzi_circuit)
+    _, sv_out = p.run(qpu.simulator_backend)
+    distribution = {}
+    for output_state in sv_out:
+        n0, n1 = [int(m) for m in str(output_state) if m.isdigit()]
+        distribution[(n0, n1)] = distribution.get((n0, n1), 0.) + sv_out[output_state]
+    return distribution
+
+
+def check_models(n_points=20, seed=0):
+    """
+    Compare mzi_outcomes and mzi_fock_outcomes to Perceval for random (beta, eta, g2, M, phase), with both multiphoton
+    models.
+
+    :param n_points: int - number of random points
+    :return: float - largest absolute difference of the probabilities
+    """
+    from mzi_model import mzi_outcomes, mzi_fock_outcomes, OUTCOMES, FOCK_OUTCOMES
+    fock_photons = [tuple(int(n) for n in label[1:-1].split(',')) for label in FOCK_OUTCOMES]
+    rng = np.random.default_rng(seed)
+    worst = 0.
+    for _ in range(n_points):
+        beta, eta, g2, M = rng.uniform(0.2, 1), rng.uniform(0.05, 1), rng.uniform(0, 0.25), rng.uniform(0, 1)
+        phase = rng.uniform(0, 2 * np.pi)
+        for multiphoton_model in ('distinguishable', 'indistinguishable'):
+            reference = perceval_outcomes(beta, eta, g2, M, phase, multiphoton_model)
+            threshold = np.zeros(len(OUTCOMES))
+            for (n0, n1), probability in reference.items():
+                threshold[OUTCOMES.index('|%d,%d>' % (min(n0, 1), min(n1, 1)))] += probability
+            fock = np.array([reference.get(photons, 0.) for photons in fock_photons])
+            difference = max(np.abs(mzi_outcomes(beta, eta, g2, M, phase, multiphoton_model) - threshold).max(),
+                             np.abs(mzi_fock_outcomes(beta, eta, g2, M, phase, multiphoton_model) - fock).max())
+            print(f'beta={beta:.3f} eta={eta:.3f} g2={g2:.3f} M={M:.3f} phase={phase:.3f} {multiphoton_model:<17} '
+                  f'max difference {difference:.2e}')
+            worst = max(worst, difference)
+    return worst
+
+
+# HARNESS
+
+def time_function(fn, args, kwargs, repeat=3):
+    """
+    :return: float - best wall time over repeat calls [s]
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def machine():
+    return platform.node() + '|' + platform.machine() + '|' + platform.python_version()
+
+
+def run(sizes, name_filter='', repeat=3):
+    """
+    :param sizes: list - sizes (bins, pixels or records) of the synthetic data
+    :param name_filter: str - only the cases whose name contains it
+    :return: list - dicts with the case, size and time [s]. A case whose dependency is missing is skipped.
+    """
+    results = []
+    for case in CASES:
+        if name_filter not in case.name:
+            continue
+        try:
+            fn = case.load()
+        except ImportError as e:
+            print(f'{case.name}: skipped ({e})')
+            continue
+        for size in (sizes if case.scales else [None]):
+            args, kwargs = case.make_args(size if size is not None else int(1e4))
+            try:
+                best = time_function(fn, args, kwargs, repeat)
+            except Exception as e:
+                # e.g. a fit that does not converge: reported, but it does not stop the other cases
+                print(f'{case.name:<50} {str(size):>10} failed ({type(e).__name__}: {str(e)[:60]})')
+                continue
+            results.append({'case': case.name, 'size': size, 'time': best})
+            print(f"{case.name:<50} {str(size):>10} {best * 1000:>12.3f} ms")
+    return results
+
+
+def save(results, path=HISTORY_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {'commit': current_commit(), 'date': time.time(), 'machine': machine()}
+    with open(path, 'a') as f:
+        for result in results:
+            f.write(json.dumps({**entry, **result}) + '\n')
+
+
+def compare(results, threshold=0.25, baseline_commit=None, path=HISTORY_FILE):
+    """
+    Compare the results to the last run of another commit (or of baseline_commit) on this machine.
+
+    :param threshold: float - relative slowdown above which a case is a regression
+    :return: list - (case, size, baseline time, time) of the regressions
+    """
+    if not os.path.exists(path):
+        return []
+    commit = current_commit()
+    baseline = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['machine'] != machine():
+                continue
+            if (baseline_commit is None and entry['commit'] != commit) or entry['commit'] == baseline_commit:
+                # later entries overwrite the earlier ones
+                baseline[(entry['case'], entry['size'])] = entry['time']
+
+    regressions = []
+    for result in results:
+        key = (result['case'], result['size'])
+        if key in baseline and result['time'] > (1 + threshold) * baseline[key]:
+            regressions.append((result['case'], result['size'], baseline[key], result['time']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the toolbox on synthetic data.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e4, 1e5, 1e6],
+                        help='number of bins, pixels or records (1e4 to 1e8)')
+    parser.add_argument('--filter', default='', help='only run the cases whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=3, help='the best of repeat calls is kept')
+    parser.add_argument('--no-save', action='store_true', help='do not append the results to the history')
+    parser.add_argument('--compare', action='store_true', help='fail if a case is slower than the baseline')
+    parser.add_argument('--baseline', default=None, help='commit to compare to (default: last other commit)')
+    parser.add_argument('--threshold', type=float, default=0.25, help='tolerated relative slowdown')
+    parser.add_argument('--check-models', action='store_true',
+                        help='compare the closed forms of mzi_model to Perceval instead of timing the cases')
+    args = parser.parse_args()
+
+    if args.check_models:
+        worst = check_models()
+        print(f'mzi_model vs Perceval: max difference {worst:.2e}')
+        if worst > 1e-9:
+            raise SystemExit(1)
+        return
+
+    results = run([int(size) for size in args.sizes], args.filter, args.repeat)
+
+    regressions = compare(results, args.threshold, args.baseline) if args.compare else []
+    if not args.no_save:
+        save(results)
+
+    for case, size, before, after in regressions:
+        print(f'REGRESSION {case} (size {size}): {before * 1000:.3f} ms -> {after * 1000:.3f} ms')
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Batch fits of the cavity modes of many reflectivity spectra: hyperspectral maps of micropillars, temperature or
+voltage tuning series, multi-frame Winspec exports.
+
+The spectra share the same energy axis and form a stack (n_spectra, n_px) or a map (n_rows, n_cols, n_px).
+- the dips are detected on the whole stack at once (smoothing, local minima and depths are array operations)
+- the Lorentzian + linear background fits of fit_cav (variable projection by default, varpro_fit) run in the
+  process pool of uncertainty, the stack being shared with the workers through shared memory
+- each worker fits a contiguous block of neighbouring spectra: every fit starts from the result of the previous
+  spectrum (warm start). A map is traversed as a snake so that consecutive spectra are always neighbours.
+
+    table = fit_cav_batch(X, stack, i_start, i_stop, zoom_fit=75, job=job)
+    table.to_parquet('modes.parquet')
+
+The result is a DataFrame with one line per spectrum: xc, κ (kappa) and Q with their standard errors.
+
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from lmfit.models import LorentzianModel, LinearModel
+from scipy.ndimage import uniform_filter1d
+
+from result_cache import cached
+from profiling import timed
+from uncertainty import SharedArrays, attach_shared, run_tasks
+from poisson_fit import poisson_fit, lorentzian_model, spectral_start
+from varpro_fit import varpro_fit
+
+# Quantities of the table, each with a column name + '_err'
+BATCH_COLUMNS = ('xc', 'kappa', 'Q')
+
+
+def detect_dips(stack, n_modes=1, smooth=5):
+    """
+    Deepest local minima of every spectrum of a stack.
+
+    :param stack: array - one spectrum per row
+    :param n_modes: int - number of dips per spectrum, the deepest first
+    :param smooth: int - width of the moving average applied before the search [px]
+    :return: array, array - (n_spectra, n_modes) indices of the dips and their depth below the median of the spectrum.
+    A spectrum with fewer local minima than n_modes has the index -1 (and the depth -inf) in the missing slots.
+    """
+    stack = np.atleast_2d(np.asarray(stack, dtype=float))
+    smoothed = uniform_filter1d(stack, max(int(smooth), 1), axis=-1, mode='nearest')
+    depth = np.median(smoothed, axis=-1, keepdims=True) - smoothed
+
+    minima = np.zeros(stack.shape, dtype=bool)
+    minima[:, 1:-1] = (smoothed[:, 1:-1] <= smoothed[:, :-2]) & (smoothed[:, 1:-1] < smoothed[:, 2:])
+    depth = np.where(minima, depth, -np.inf)
+
+    n_modes = min(n_modes, stack.shape[1])
+    deepest = np.argpartition(-depth, n_modes - 1, axis=-1)[:, :n_modes]
+    # sorted from the deepest
+    order = np.argsort(-np.take_along_axis(depth, deepest, -1), axis=-1)
+    dips = np.take_along_axis(deepest, order, -1)
+    depths = np.take_along_axis(depth, dips, -1)
+    # argpartition fills the slots without a minimum with other pixels
+    return np.where(np.isfinite(depths), dips, -1), depths
+
+
+def snake_order(shape):
+    """
+    :param shape: tuple - (n_rows, n_cols) of a map
+    :return: array - flat indices of the map, the odd rows being read backwards
+    """
+    indices = np.arange(np.prod(shape)).reshape(shape)
+    indices[1::2] = indices[1::2, ::-1]
+    return indices.ravel()
+
+
+def _cavity_model(n_modes):
+    model = LinearModel(prefix='bkg_')
+    for i in range(1, n_modes + 1):
+        model = model + LorentzianModel(prefix='lz%d_' % i)
+    return model
+
+
+def _initial_params(model, x, y, centers, previous):
+    """
+    :param centers: array - positions of the detected dips [eV]
+    :param previous: lmfit Parameters - result of the neighbouring spectrum, None for a cold start
+    """
+    if previous is None:
+        params = model.make_params()
+        for i, center in enumerate(centers, 1):
+            params['lz%d_center' % i].set(value=center)
+            params['lz%d_sigma' % i].set(value=100e-6)
+        return spectral_start(params, x, y)
+
+    params = previous.copy()
+    for i, center in enumerate(centers, 1):
+        prefix = 'lz%d_' % i
+        # The mode of the neighbour is kept, unless the detected dip is further than a linewidth from it
+        if abs(center - params[prefix + 'center'].value) > 2 * params[prefix + 'sigma'].value:
+            params[prefix + 'center'].set(value=center)
+    return params
+
+
+def _fit_block(descriptors, spectra, dips, zoom_fit, n_modes, likelihood, solver):
+    """
+    Fit a block of neighbouring spectra in a worker, each starting from the result of the previous one.
+
+    :return: array - (len(spectra), 2*len(BATCH_COLUMNS) + 2): values, errors, reduced chi-square and success
+    """
+    with attach_shared(descriptors) as arrays:
+        # Only the spectra of the block are copied out of the shared stack
+        x, block = arrays['x'].copy(), arrays['stack'][spectra]
+    model = _cavity_model(n_modes)
+    rows = np.full((len(spectra), 2 * len(BATCH_COLUMNS) + 2), np.nan)
+
+    previous = None
+    for k, dip in enumerate(dips):
+        if np.any(dip < 0):
+            # fewer dips than modes: not fitted (NaN, success False), the next spectrum starts cold
+            previous = None
+            continue
+        start_fit = max(dip[0] - zoom_fit, 0)
+        stop_fit = dip[0] + zoom_fit
+        xdat_fit, ydat_fit = x[start_fit:stop_fit], block[k, start_fit:stop_fit]
+        params = _initial_params(model, xdat_fit, ydat_fit, x[dip], previous)
+        try:
+            if likelihood == 'poisson':
+                result = poisson_fit(lorentzian_model(n_modes, 'linear'), params, ydat_fit, xdat_fit)
+            elif solver == 'varpro':
+                result = varpro_fit(params, ydat_fit, xdat_fit, 'linear')
+            else:
+                result = model.fit(ydat_fit, params, x=xdat_fit)
+        except ValueError:
+            # e.g. a Poisson fit whose model is negative: the next spectrum starts cold
+            previous = None
+            continue
+
+        xc, sigma = result.params['lz1_center'].value, result.params['lz1_sigma'].value
+        xc_err = result.params['lz1_center'].stderr or np.nan
+        kappa, kappa_err = 2 * sigma, 2 * (result.params['lz1_sigma'].stderr or np.nan)
+        Q = xc / kappa
+        Q_err = abs(Q) * np.hypot(xc_err / xc, kappa_err / kappa)
+        rows[k] = (xc, kappa, Q, xc_err, kappa_err, Q_err, result.redchi, result.success)
+        previous = result.params if result.success and np.isfinite(xc) else None
+    return rows
+
+
+@timed('fit_cav_batch')
+@cached('fit_cav_batch')
+def fit_cav_batch(x, stack, start_search, stop_search, n_modes=1, zoom_fit=75, likelihood='least_squares',
+                  solver='varpro', n_blocks=None, job=None):
+    """
+    Fit the cavity modes of every spectrum of a stack or a map, as fit_cav does for one spectrum.
+
+    :param x: array - energy axis shared by all the spectra [eV]
+    :param stack: array - (n_spectra, n_px) or (n_rows, n_cols, n_px)
+    :param start_search, stop_search: int - range of pixels where the dips are searched
+    :param n_modes: int - number of Lorentzians, lz1 being the deepest dip
+    :param zoom_fit: int - half width of the fit window around the deepest dip [px]
+    :param likelihood: str - 'least_squares' or 'poisson'
+    :param solver: str - 'varpro' or 'lmfit', for the least squares
+    :param n_blocks: int - number of blocks of neighbouring spectra fitted in parallel. Default: 2 per CPU. The
+    first spectrum of each block starts cold.
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: DataFrame - one line per spectrum: 'spectrum' (or 'row' and 'col' for a map), xc [eV], kappa [eV], Q,
+    their errors xc_err..., redchi and success. The spectra with fewer dips than n_modes are not fitted: NaN and
+    success False.
+    """
+    x = np.asarray(x, dtype=float)
+    stack = np.asarray(stack, dtype=float)
+    map_shape = stack.shape[:-1] if stack.ndim == 3 else None
+    stack = stack.reshape(-1, stack.shape[-1])
+    order = snake_order(map_shape) if map_shape is not None else np.arange(len(stack))
+
+    dips, _ = detect_dips(stack[:, start_search:stop_search], n_modes)
+    dips = np.where(dips >= 0, dips + (start_search or 0), -1)
+
+    n_blocks = min(n_blocks or 2 * (os.cpu_count() or 4), len(order))
+    blocks = np.array_split(order, n_blocks)
+    with SharedArrays({'x': x, 'stack': stack}) as descriptors:
+        tasks = [(descriptors, block, dips[block], int(zoom_fit), n_modes, likelihood, solver) for block in blocks]
+        results = run_tasks(_fit_block, tasks, job)
+
+    rows = np.empty((len(stack), 2 * len(BATCH_COLUMNS) + 2))
+    rows[order] = np.concatenate(results)
+    columns = list(BATCH_COLUMNS) + [name + '_err' for name in BATCH_COLUMNS] + ['redchi', 'success']
+    table = pd.DataFrame(rows, columns=columns)
+    table['success'] = table['success'] == 1
+
+    if map_shape is not None:
+        row, col = np.unravel_index(np.arange(len(stack)), map_shape)
+        table.insert(0, 'col', col)
+        table.insert(0, 'row', row)
+    else:
+        table.insert(0, 'spectrum', np.arange(len(stack)))
+    return table
+
+
+def batch_map(table, name):
+    """
+    :param table: DataFrame - returned by fit_cav_batch for a map
+    :param name: str - column, e.g. 'Q'
+    :return: array - (n_rows, n_cols) image of the column
+    """
+    return table.pivot(index='row', columns='col', values=name).to_numpy()
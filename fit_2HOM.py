@@ -15,6 +15,7 @@ import numpy as np
 import streamlit as st
 from antibunching_toolbox import get_HOM_2input, find_sidepeaks
 import matplotlib.pyplot as plt
+from profiling import stage
 
 
 def main():
@@ -40,28 +41,33 @@ def main():
             # The data has been saved using:
             # np.savetxt(file.txt, [index, hist])
             # we only use the hist
-            data_ortho = np.loadtxt(file_ortho)[1]
+            with stage('load'):
+                data_ortho = np.loadtxt(file_ortho)[1]
         if timetagger == 'HydraHarp':
             with col2:
                 # Channel used with the HydraHarp (starts at 0).
                 use_channel = st.number_input('Use channel:', value=0, key="ch_ortho")
             # For file extracted in ASCII from Picoquant software there are 10 lines of information that we skip.
-            data_ortho = np.loadtxt(file_ortho, skiprows=10)[:, use_channel]
+            with stage('load'):
+                data_ortho = np.loadtxt(file_ortho, skiprows=10)[:, use_channel]
         if timetagger == 'Custom dataset':
             with col2:
                 structure_data = st.radio("Data is stored in:", ('List','Lines', 'Columns'))
             if structure_data == 'List':
-                data_ortho = np.loadtxt(file_ortho)
+                with stage('load'):
+                    data_ortho = np.loadtxt(file_ortho)
             if structure_data == 'Lines':
                 with col3:
                     use_line = st.number_input('Use line:', value=0)
-                data_ortho = np.loadtxt(file_ortho)[use_line]
+                with stage('load'):
+                    data_ortho = np.loadtxt(file_ortho)[use_line]
             if structure_data == 'Columns':
                 with col3:
                     use_col = st.number_input('Use column:', value=0)
                 with col4:
                     skip = st.number_input('Skip rows:', value=0)
-                data_ortho = np.loadtxt(file_ortho, skiprows=skip)[:, use_col]
+                with stage('load'):
+                    data_ortho = np.loadtxt(file_ortho, skiprows=skip)[:, use_col]
 
     col5, col6, col7, col8 = st.columns(4)
     if file_para is not None:
@@ -80,28 +86,33 @@ def main():
             # The data has been saved using:
             # np.savetxt(file.txt, [index, hist])
             # we only use the hist
-            data_para = np.loadtxt(file_para)[1]
+            with stage('load'):
+                data_para = np.loadtxt(file_para)[1]
         if timetagger == 'HydraHarp':
             with col6:
                 # Channel used with the HydraHarp (starts at 0).
                 use_channel = st.number_input('Use channel:', value=0, key="ch_para")
             # For file extracted in ASCII from Picoquant software there are 10 lines of information that we skip.
-            data_para = np.loadtxt(file_para, skiprows=10)[:, use_channel]
+            with stage('load'):
+                data_para = np.loadtxt(file_para, skiprows=10)[:, use_channel]
         if timetagger == 'Custom dataset':
             with col6:
                 structure_data = st.radio("Data is stored in:", ('List','Lines', 'Columns'))
             if structure_data == 'List':
-                data_para = np.loadtxt(file_para)
+                with stage('load'):
+                    data_para = np.loadtxt(file_para)
             if structure_data == 'Lines':
                 with col7:
                     use_line = st.number_input('Use line:', value=0)
-                data_para = np.loadtxt(file_para)[use_line]
+                with stage('load'):
+                    data_para = np.loadtxt(file_para)[use_line]
             if structure_data == 'Columns':
                 with col7:
                     use_col = st.number_input('Use column:', value=0)
                 with col8:
                     skip = st.number_input('Skip rows:', value=0)
-                data_para = np.loadtxt(file_para, skiprows=skip)[:, use_col]
+                with stage('load'):
+                    data_para = np.loadtxt(file_para, skiprows=skip)[:, use_col]
 
     if file_para and file_ortho is not None:
 
@@ -156,7 +167,8 @@ def main():
         ax.set_ylabel("Visibility", fontsize=18)
         ax.tick_params(direction='in', bottom=True, top=True, left=True, right=True, labelsize=12)
 
-        st.pyplot(fig)
+        with stage('plot'):
+            st.pyplot(fig)
 
 
 if __name__ == "__main__":
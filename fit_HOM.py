@@ -12,10 +12,13 @@ Output: Displays a graph and gives the raw V_HOM ± statistical error.
 
 import numpy as np
 import streamlit as st
-from antibunching_toolbox import get_HOM_1input, find_sidepeaks
+from antibunching_toolbox import get_HOM_1input, find_sidepeaks, poisson_error
+from job_queue import submit, show_progress
 import matplotlib.pyplot as plt
 import os
 from from_PTU import get_ptu_fromfile
+from session_toolbox import download_plot
+from profiling import stage
 
 
 def main():
@@ -25,7 +28,8 @@ def main():
 
     if demo_mode:
         file = "demo"
-        data = np.loadtxt(os.getcwd()+"/demo_data/demo_HOM.txt")[1]
+        with stage('load'):
+            data = np.loadtxt(os.getcwd()+"/demo_data/demo_HOM.txt")[1]
     else:
         # Uploading data (in .txt or .dat format only). You can also drag and drop.
         file = st.file_uploader('Load data', type={"txt", "dat", "ptu"}, help='Upload your data here')
@@ -38,7 +42,12 @@ def main():
         if file != "demo":
             ext = file.name[-3:]
             if ext == "ptu":
-                _, data = get_ptu_fromfile(file)
+                # The correlation of large files takes a while, it is done in the background.
+                with stage('load'):
+                    ptu_histogram = show_progress(submit(get_ptu_fromfile, file), 'Reading the PTU file...')
+                if ptu_histogram is None:
+                    st.stop()
+                _, data = ptu_histogram
             else:
                 # Select which TimeTagger is used
                 with col1:
@@ -49,30 +58,36 @@ def main():
                 # Get the histogram from the data file depending on which correlator was used.
                 if timetagger == 'Swabian':
                     try:
-                        data = np.loadtxt(file)[1]
+                        with stage('load'):
+                            data = np.loadtxt(file)[1]
                     except:
-                        data = np.loadtxt(file, skiprows=1)[:, 1]
+                        with stage('load'):
+                            data = np.loadtxt(file, skiprows=1)[:, 1]
                 if timetagger == 'HydraHarp':
                     with col2:
                         # Channel used with the HydraHarp (starts at 0).
                         use_channel = st.number_input('Use channel:', value=0)
                     # For file extracted in ASCII from Picoquant software there are 10 lines of information that we skip.
-                    data = np.loadtxt(file, skiprows=10)[:, use_channel]
+                    with stage('load'):
+                        data = np.loadtxt(file, skiprows=10)[:, use_channel]
                 if timetagger == 'Custom dataset':
                     with col2:
                         structure_data = st.radio("Data is stored in:", ('List', 'Lines', 'Columns'))
                     if structure_data == 'List':
-                        data = np.loadtxt(file)
+                        with stage('load'):
+                            data = np.loadtxt(file)
                     if structure_data == 'Lines':
                         with col3:
                             use_line = st.number_input('Use line:', value=0)
-                        data = np.loadtxt(file)[use_line]
+                        with stage('load'):
+                            data = np.loadtxt(file)[use_line]
                     if structure_data == 'Columns':
                         with col3:
                             use_col = st.number_input('Use column:', value=0)
                         with col4:
                             skip = st.number_input('Skip rows:', value=0)
-                        data = np.loadtxt(file, skiprows=skip)[:, use_col]
+                        with stage('load'):
+                            data = np.loadtxt(file, skiprows=skip)[:, use_col]
 
         # Create time axis to plot
         time = (np.arange(0, len(data)))
@@ -90,16 +105,13 @@ def main():
 
         # Compute HOM
         hom = get_HOM_1input(data, peak_width, peak_sep, central_peak, num_peaks, baseline=base_line)
-        # Compute error on g2
-        errhom = np.std([get_HOM_1input(np.random.poisson(data),
-                                        peak_width,
-                                        peak_sep,
-                                        central_peak,
-                                        num_peaks,
-                                        baseline=base_line)
-                         for sim in range(100)
-                         ]
-                        )
+        # Compute error on HOM. It runs in the background so that the page stays responsive.
+        job = submit(poisson_error, get_HOM_1input, data, peak_width, peak_sep, central_peak, num_peaks,
+                     baseline=base_line)
+        with stage('bootstrap'):
+            errhom = show_progress(job, 'Computing the error...')
+        if errhom is None:
+            st.stop()
 
         # Show integrations windows
         show_details = st.sidebar.checkbox('Show details', value=True)
@@ -158,7 +170,8 @@ def main():
         ax.set_ylabel("Counts", fontsize=18)
         ax.tick_params(direction='in', bottom=True, top=True, left=True, right=True, labelsize=12)
 
-        st.pyplot(fig)
+        with stage('plot'):
+            st.pyplot(fig)
 
         colg2, colerrg2, _= st.columns(3)
         g2 = colg2.number_input('g^2(0) [%] =', 0.00, 100.00) / 100
@@ -177,19 +190,8 @@ def main():
         if g2:
             M = st.markdown(display, unsafe_allow_html=True)
         if file != "demo":
-            # To download the plot
-            directory = os.getcwd()
-            local_path = directory + os.sep + "temp_picture.pdf"
-            fig.savefig(local_path, bbox_inches='tight')
-            with open("temp_picture.pdf", "rb") as picture:
-                btn = st.download_button(
-                    label="Save plot",
-                    data=picture,
-                    file_name=file.name[:-4] + ".pdf",
-                    mime="image/pdf"
-                )
-            if btn:
-                os.remove(local_path)
+            # To download the plot. The pdf is rendered in memory, nothing is written on the server.
+            download_plot(fig, file.name)
 
 
 if __name__ == "__main__":
@@ -5,13 +5,16 @@
 
 This script gets the central frequency and  width of a line (works for laser line too).
 
-Input: .txt file downloaded from your computer using the app.
+Input: .txt file downloaded from your computer using the app, or the binary .spe file of the camera.
 
 Output: Displays a graph and gives the central frequency of the most prominent peak and its FWHM.
 
 Comments:
 This is not very well commented. It is exactly the same as fit_reflectivity.py but for peaks instead of dips.
 
+A file with several frames (tuning series) can be tracked line by line in the background with
+mode_tracker.track_modes.
+
 """
 
 import numpy as np
@@ -23,22 +26,26 @@ import plotly.graph_objects as go
 from plotly.graph_objs import *
 import scipy.constants
 
+from result_cache import cached
+from profiling import stage, timed
+from uncertainty import show_uncertainties, LORENTZIAN_DERIVED, LORENTZIAN_SCALES
+from poisson_fit import poisson_fit, lorentzian_model, spectral_start
+from varpro_fit import varpro_fit
+from spectro_toolbox import Calibration, get_calibration, load_frames, show_batch
+from mode_tracker import track_modes
+from job_queue import submit, show_progress
+
 
 # UTILS
 
 # Conversion from px to eV
 def px_to_eV(spectro, px, calib):
-    return 1239.8 / (spectro - (670 - px) * 1 / calib)
+    return Calibration(spectro, calib).px_to_eV(px)
 
 
 # Conversion from px to nm
 def px_to_nm(spectro, px, calib):
-    return spectro - (670 - px) * 1 / calib
-
-
-# Conversion from px to nm
-def eV_to_nm(eV):
-    return 1239.8 / eV
+    return Calibration(spectro, calib).px_to_nm(px)
 
 
 # Create the X axis of the camera in px depending on the horizontal size
@@ -46,14 +53,14 @@ def get_Xaxis(nb_px):
     return np.arange(1, nb_px + 1, 1)
 
 
-# get energy (in eV) axis
+# get energy (in eV) axis, computed once per calibration
 def get_Eaxis(spectro, nb_px, calib):
-    return px_to_eV(spectro, get_Xaxis(nb_px), calib)
+    return get_calibration(spectro, calib, nb_px).eV
 
 
-# get WL (in nm) axis
+# get WL (in nm) axis, computed once per calibration
 def get_WLaxis(spectro, nb_px, calib):
-    return px_to_nm(spectro, get_Xaxis(nb_px), calib)
+    return get_calibration(spectro, calib, nb_px).nm
 
 
 # Toolbox for fit.
@@ -66,22 +73,68 @@ def add_peak(prefix, center, amplitude=-1000, sigma=100e-6):
     return peak, pars
 
 
+@timed('fit_PL')
+@cached('fit_PL')
+def fit_lines(xdat, ydat, number_of_elements, zoom_fit, spectro, calib, likelihood='least_squares', solver='lmfit'):
+    # likelihood='poisson' minimises the Poisson deviance instead of the squares (poisson_fit)
+    # solver='varpro' solves the least squares by variable projection (varpro_fit), much faster than lmfit
+
+    model = QuadraticModel(prefix="bkg_")
+    params = model.make_params(a=0, b=0, c=0)
+
+    peaks, properties = find_peaks(ydat, prominence=300, width=3)
+
+    peaks_size = properties["prominences"]
+    max_peak = np.argmax(peaks_size)
+
+    largest_peaks = heapq.nlargest(number_of_elements, enumerate(peaks_size), key=lambda x: x[1])
+
+    CenterPx = peaks[max_peak]
+    start = CenterPx - zoom_fit
+    stop = CenterPx + zoom_fit
+
+    ydat_fit = ydat[start:stop]
+    xdat_fit = xdat[start:stop]
+
+    rough_peak_positions = ()
+    for i in [peaks[x] for x in [idx[0] for idx in largest_peaks]]:
+        rough_peak_positions += (px_to_eV(spectro, i, calib),)
+
+    for i, cen in enumerate(rough_peak_positions):
+        peak, pars = add_peak("lz%d_" % (i + 1), cen)
+        model = model + peak
+        params.update(pars)
+
+    if likelihood == 'poisson':
+        result = poisson_fit(lorentzian_model(len(rough_peak_positions), 'quadratic'),
+                             spectral_start(params, xdat_fit, ydat_fit), ydat_fit, xdat_fit)
+    elif solver == 'varpro':
+        result = varpro_fit(params, ydat_fit, xdat_fit, 'quadratic', model=model)
+    else:
+        result = model.fit(ydat_fit, params, x=xdat_fit)
+
+    return xdat_fit, result
+
+
 # Data must be in a .txt file with 2 columns:
 # column 1 = x abscisse in px
 # column 2 = intensity
 
 
 def main():
-    file = st.file_uploader('Load data', type={"txt"})
+    file = st.file_uploader('Load data', type={"txt", "spe"})
 
     if file is not None:
-        data = np.loadtxt(file)[:, 1]
-
         # !!!! Calibration !!!!
 
         # Nb of pixel on the camera (horizontal axis)
         Nb_px = st.sidebar.number_input('Nb of pixel on the camera (horizontal axis)', value=1340)
 
+        # Frames of the .txt file (second column) or of the binary .spe file
+        with stage('load'):
+            frames = load_frames(file, Nb_px).astype(float)
+        n_frames, Nb_px = frames.shape
+
         # Center WL of the spectro meter (corresponds to the WL of px 670)
         Spectro = st.sidebar.number_input('WL of central pixel [nm]', value=924.4782)
 
@@ -91,44 +144,40 @@ def main():
         # create E axis
         E = get_Eaxis(Spectro, Nb_px, Calib)
 
-        # Fit
-        xdat = get_Eaxis(Spectro, Nb_px, Calib)
-        ydat = data
-
-        model = QuadraticModel(prefix="bkg_")
-        params = model.make_params(a=0, b=0, c=0)
-
-        peaks, properties = find_peaks(ydat, prominence=300, width=3)
-
-        peaks_size = properties["prominences"]
-        max_peak = np.argmax(peaks_size)
-
         # Find the number_of_elements largest peaks in peaks.
         # This is usefull is you see many modes that are too close to each other. If you only see one use 1
         number_of_elements = st.sidebar.number_input('Number of peaks', value=1)
-        largest_peaks = heapq.nlargest(number_of_elements, enumerate(peaks_size), key=lambda x: x[1])
 
-        CenterPx = peaks[max_peak]
         # This might need to be adapted depending on the width of the cavity
         # Try more or less, but around 100 is good for Q = 10 000
         zoom_fit = st.sidebar.number_input('Zoom fit', value=75)
-        start = CenterPx - zoom_fit
-        stop = CenterPx + zoom_fit
 
-        ydat_fit = ydat[start:stop]
-        xdat_fit = xdat[start:stop]
+        # Poisson likelihood for spectra in counts: unbiased in the wings of the lines
+        likelihood = 'poisson' if st.sidebar.checkbox('Poisson likelihood fit') else 'least_squares'
+        # Variable projection: the same least squares, in a few iterations
+        solver = 'varpro' if st.sidebar.checkbox('Fast solver (variable projection)', value=True) else 'lmfit'
+
+        data = frames[0]
+        if n_frames > 1:
+            with st.sidebar.expander("Frames"):
+                # Series: the lines of the first frame are followed in narrow windows
+                track = st.checkbox('Track the lines along the series', value=True)
+                frame = st.number_input('Frame to display', value=0, min_value=0, max_value=n_frames - 1)
+            data = frames[frame]
+
+            if track:
+                table = show_progress(submit(track_modes, E, frames, number_of_elements, 'peak', zoom_fit=zoom_fit,
+                                             likelihood=likelihood, solver=solver),
+                                      'Tracking the lines...')
+                if table is not None:
+                    show_batch(table, file.name)
 
-        rough_peak_positions = ()
-        for i in [peaks[x] for x in [idx[0] for idx in largest_peaks]]:
-            rough_peak_positions += (px_to_eV(Spectro, i, Calib),)
-
-        for i, cen in enumerate(rough_peak_positions):
-            peak, pars = add_peak("lz%d_" % (i + 1), cen)
-            model = model + peak
-            params.update(pars)
+        # Fit
+        xdat = E
+        ydat = data
 
-        init = model.eval(params, x=xdat_fit)
-        result = model.fit(ydat_fit, params, x=xdat_fit)
+        xdat_fit, result = fit_lines(xdat, ydat, number_of_elements, zoom_fit, Spectro, Calib,
+                                     likelihood=likelihood, solver=solver)
         xc = result.params["lz1_center"].value
         sigma = result.params["lz1_sigma"].value
 
@@ -170,7 +219,12 @@ def main():
                           xaxis=dict(tickformat="000"),
                           yaxis=dict(tickformat="000")
                           )
-        st.plotly_chart(fig)
+        with stage('plot'):
+            st.plotly_chart(fig)
+
+        # Bootstrap / profile likelihood errors on the linewidth and the Q factor
+        show_uncertainties(result, ['lz1_center', 'kappa', 'Q'], derived=LORENTZIAN_DERIVED,
+                           profile=['lz1_sigma'], scales=LORENTZIAN_SCALES)
 
 
 if __name__ == "__main__":
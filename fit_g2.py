@@ -12,10 +12,13 @@ Output: Displays a graph and gives g2(0) ± statistical error.
 
 import numpy as np
 import streamlit as st
-from antibunching_toolbox import get_g2_1input, find_sidepeaks
+from antibunching_toolbox import get_g2_1input, find_sidepeaks, poisson_error
+from job_queue import submit, show_progress
 import matplotlib.pyplot as plt
 import os
 from from_PTU import get_ptu_fromfile
+from session_toolbox import download_plot
+from profiling import stage
 
 
 def main():
@@ -24,7 +27,8 @@ def main():
 
     if demo_mode:
         file = "demo"
-        data = np.loadtxt(os.getcwd()+"/demo_data/demo_g2.txt")[1]
+        with stage('load'):
+            data = np.loadtxt(os.getcwd()+"/demo_data/demo_g2.txt")[1]
     else:
         # Uploading data (in .txt or .dat format only). You can also drag and drop.
         file = st.file_uploader('Load data', type={"txt", "dat", "ptu"}, help = 'Upload your data here')
@@ -37,7 +41,12 @@ def main():
             ext = file.name[-3:]
 
             if ext == "ptu":
-                _, data = get_ptu_fromfile(file)
+                # The correlation of large files takes a while, it is done in the background.
+                with stage('load'):
+                    ptu_histogram = show_progress(submit(get_ptu_fromfile, file), 'Reading the PTU file...')
+                if ptu_histogram is None:
+                    st.stop()
+                _, data = ptu_histogram
 
             else:
                 # Select which TimeTagger is used
@@ -53,30 +62,36 @@ def main():
                     # np.savetxt(file.txt, [index, hist])
                     # we only use the hist
                     try:
-                        data = np.loadtxt(file)[1]
+                        with stage('load'):
+                            data = np.loadtxt(file)[1]
                     except:
-                        data = np.loadtxt(file, skiprows=1)[:, 1]
+                        with stage('load'):
+                            data = np.loadtxt(file, skiprows=1)[:, 1]
                 if timetagger == 'HydraHarp':
                     with col2:
                         # Channel used with the HydraHarp (starts at 0).
                         use_channel = st.number_input('Use channel:', value=0)
                     # For file extracted in ASCII from Picoquant software there are 10 lines of information that we skip.
-                    data = np.loadtxt(file, skiprows=10)[:, use_channel]
+                    with stage('load'):
+                        data = np.loadtxt(file, skiprows=10)[:, use_channel]
                 if timetagger == 'Custom dataset':
                     with col2:
                         structure_data = st.radio("Data is stored in:", ('List','Lines', 'Columns'))
                     if structure_data == 'List':
-                        data = np.loadtxt(file)
+                        with stage('load'):
+                            data = np.loadtxt(file)
                     if structure_data == 'Lines':
                         with col3:
                             use_line = st.number_input('Use line:', value=0)
-                        data = np.loadtxt(file)[use_line]
+                        with stage('load'):
+                            data = np.loadtxt(file)[use_line]
                     if structure_data == 'Columns':
                         with col3:
                             use_col = st.number_input('Use column:', value=0)
                         with col4:
                             skip = st.number_input('Skip rows:', value=0)
-                        data = np.loadtxt(file, skiprows=skip)[:, use_col]
+                        with stage('load'):
+                            data = np.loadtxt(file, skiprows=skip)[:, use_col]
 
         # Create time axis to plot
         time = (np.arange(0, len(data)))
@@ -94,16 +109,13 @@ def main():
 
         # Compute g2
         g2 = get_g2_1input(data, peak_width, peak_sep, central_peak, num_peaks, baseline=base_line)
-        # Compute error on g2
-        errg2 = np.std([get_g2_1input(np.random.poisson(data),
-                                      peak_width,
-                                      peak_sep,
-                                      central_peak,
-                                      num_peaks,
-                                      baseline=base_line)
-                        for sim in range(100)
-                        ]
-                       )
+        # Compute error on g2. It runs in the background so that the page stays responsive.
+        job = submit(poisson_error, get_g2_1input, data, peak_width, peak_sep, central_peak, num_peaks,
+                     baseline=base_line)
+        with stage('bootstrap'):
+            errg2 = show_progress(job, 'Computing the error...')
+        if errg2 is None:
+            st.stop()
 
         title_fig = f'g2 = {g2 * 100:.3} \u00B1 {errg2 * 100:.2} %'
 
@@ -169,22 +181,12 @@ def main():
         ax.set_ylabel("$g^{(2)}(t)$", fontsize=18)
         ax.tick_params(direction='in', bottom=True, top=True, left=True, right=True, labelsize=12)
 
-        st.pyplot(fig)
+        with stage('plot'):
+            st.pyplot(fig)
 
         if file != "demo":
-            # To download the plot
-            directory = os.getcwd()
-            local_path = directory + os.sep + "temp_picture.pdf"
-            fig.savefig(local_path, bbox_inches='tight')
-            with open("temp_picture.pdf", "rb") as picture:
-                btn = st.download_button(
-                    label="Save plot",
-                    data=picture,
-                    file_name=file.name[:-4] + ".pdf",
-                    mime="image/pdf"
-                )
-            if btn:
-                os.remove(local_path)
+            # To download the plot. The pdf is rendered in memory, nothing is written on the server.
+            download_plot(fig, file.name)
 
 
 if __name__ == "__main__":
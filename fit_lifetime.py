@@ -5,19 +5,35 @@
 
 This script gets the lifetime (and FSS) for a Trion or an Exciton from the Time evolution of the emission
 
-Input: .dat (HydraHarp) file downloaded from your computer using the app. Resolution must be 4 ps.
+Input: .dat (HydraHarp) file downloaded from your computer using the app, or directly the .ptu file measured in
+       Mode 3 (T3). The resolution is read from the file.
+       Optionally the .dat histogram of the instrument response (IRF) to fit the rise of the signal too.
 
 Output: Displays a graph and gives the lifetime (in ps) and FSS (in eV).
 
+Global fit: several files (or channels) fitted at once, the lifetime and/or the FSS being shared by all the decays.
+
 """
 
 import numpy as np
 import scipy
 import streamlit as st
-from lmfit import Model, Parameters
+import lmfit
+from lmfit import Model, Parameters, fit_report
 import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
 import os
+import inspect
+import pandas as pd
+from session_toolbox import download_plot
+from result_cache import cached, input_hash
+from profiling import stage, timed
+from lifetime_toolbox import guess_decay, fit_reconvolution, detect_period, fold_periods, fit_global, \
+    GLOBAL_PARAMETERS
+from job_queue import submit, show_progress
+from from_PTU import get_lifetime_fromfile
+from uncertainty import show_uncertainties
+from poisson_fit import poisson_fit, exp_decay as exp_decay_poisson, cosine_decay as cosine_decay_poisson
 
 # UTILS
 # Some constants used to get the FSS in eV
@@ -31,44 +47,275 @@ def exp_decay(x, y0, N0, t0, tau):
     return y0+N0*np.exp(-(x-t0)/tau)
 
 
-def fit_lifetime_X(data_fit, x_axis, c, w, tau):
-    mod = Model(cosine_decay)
-
+# Analytic Jacobians of the models, used by lmfit instead of finite differences.
+# lmfit calls them as Dfun(params, data, weights, x=x) and expects d(residual)/d(parameter) for the varying
+# parameters only, in the order in which they were added.
+def cosine_decay_jacobian(params, data, weights, x):
+    c1, c2, phi, w, tau = [params[name].value for name in ('c1', 'c2', 'phi', 'w', 'tau')]
+    sin2 = np.sin(w*x+phi)**2
+    decay = np.exp(-x/tau)
+    # d(sin²)/dphi = sin(2(wx+phi))
+    dphi = c1 * c2 * np.sin(2*(w*x+phi)) * decay
+    derivatives = {'c1': c2 * sin2 * decay,
+                   'c2': c1 * sin2 * decay,
+                   'phi': dphi,
+                   'w': x * dphi,
+                   'tau': c1 * c2 * sin2 * decay * x / tau**2}
+    return _stack_jacobian(params, derivatives, weights)
+
+
+def exp_decay_jacobian(params, data, weights, x):
+    y0, N0, t0, tau = [params[name].value for name in ('y0', 'N0', 't0', 'tau')]
+    decay = np.exp(-(x-t0)/tau)
+    derivatives = {'y0': np.ones_like(x),
+                   'N0': decay,
+                   't0': N0 * decay / tau,
+                   'tau': N0 * decay * (x-t0) / tau**2}
+    return _stack_jacobian(params, derivatives, weights)
+
+
+def _stack_jacobian(params, derivatives, weights):
+    jac = _residual_sign * np.column_stack([derivatives[name] for name in params if params[name].vary])
+    if weights is not None:
+        jac = jac * np.asarray(weights)[:, None]
+    return jac
+
+
+# The models are built once: a fit only creates its parameters.
+model_X = Model(cosine_decay)
+model_T = Model(exp_decay)
+
+# The residual of lmfit models is model - data in the pinned lmfit 1.0 (requirements.txt), data - model from
+# lmfit 1.2: the Jacobian follows.
+_residual_sign = 1. if tuple(int(v) for v in lmfit.__version__.split('.')[:2]) < (1, 2) else -1.
+
+
+@timed('fit_lifetime_X')
+@cached('fit_lifetime_X')
+def fit_lifetime_X(data_fit, x_axis, c, w, tau, phi=0, likelihood='least_squares'):
     # Initial parameter for the fit
+    # likelihood='poisson' minimises the Poisson deviance instead of the squares (poisson_fit)
+    # The amplitude is c1*c2: c1 is fixed, otherwise the Jacobian is singular.
     pars = Parameters()
-    pars.add('c1', value=1)
+    pars.add('c1', value=1, vary=False)
     pars.add('c2', value=c)
-    pars.add('phi', value=0)
+    pars.add('phi', value=phi)
     pars.add('w', value=w, min=0)
     pars.add('tau', value=tau)
 
-    result = mod.fit(data_fit, pars, x=x_axis)
+    if likelihood == 'poisson':
+        # With phi = 0 the model vanishes at x = 0, where there are counts: the likelihood needs a positive model
+        if np.sin(phi)**2 < 0.1:
+            pars['phi'].set(value=np.pi/4)
+            pars['c2'].set(value=c/2)
+        return poisson_fit(cosine_decay_poisson, pars, data_fit, x_axis)
+    result = model_X.fit(data_fit, pars, x=x_axis, fit_kws={'Dfun': cosine_decay_jacobian})
     return result
 
 
-def fit_lifetime_T(data_fit, x_axis, c, tau):
-    mod = Model(exp_decay)
+@timed('fit_lifetime_T')
+@cached('fit_lifetime_T')
+def fit_lifetime_T(data_fit, x_axis, c, tau, y0=1, likelihood='least_squares'):
     # Initial parameter
+    # The window starts at x = 0: t0 is fixed since N0*exp(t0/tau) is a single amplitude.
     pars = Parameters()
-    pars.add('y0', value=1)
+    pars.add('y0', value=y0)
     pars.add('N0', value=c)
-    pars.add('t0', value=0, min=0)
+    pars.add('t0', value=0, vary=False)
     pars.add('tau', value=tau)
 
-    result = mod.fit(data_fit, pars, x=x_axis)
+    if likelihood == 'poisson':
+        # The background has to be positive for the likelihood
+        pars['y0'].set(value=max(y0, 0.1), min=0)
+        return poisson_fit(exp_decay_poisson, pars, data_fit, x_axis)
+    result = model_T.fit(data_fit, pars, x=x_axis, fit_kws={'Dfun': exp_decay_jacobian})
     return result
 
 
+def fit_lifetime_batch(stack, x_axis, excitonic_particle='Trion', w=4., job=None):
+    """
+    Fit many decays measured with the same time axis (power or temperature series).
+    Each fit starts from the result of the previous one.
+
+    :param stack: array - one decay per row, already cut to the fit window
+    :param x_axis: array - time axis of the window [ns]
+    :param excitonic_particle: str - 'Exciton' or 'Trion'
+    :param w: float - initial pulsation for the first exciton fit
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: dict - arrays of the fitted values and their standard errors, one per row of stack
+    """
+    stack = np.atleast_2d(stack)
+    names = ('c2', 'phi', 'w', 'tau') if excitonic_particle == 'Exciton' else ('y0', 'N0', 'tau')
+    values = {name: np.full(len(stack), np.nan) for name in names}
+    errors = {name + '_err': np.full(len(stack), np.nan) for name in names}
+
+    previous = None
+    for i, data_fit in enumerate(stack):
+        if previous is None:
+            c, tau = guess_decay(data_fit, x_axis)
+            previous = {'c2': c, 'phi': 0, 'w': w, 'tau': tau, 'y0': np.min(data_fit), 'N0': c}
+        # the undecorated fits: no cache entry nor profiling stage for each row
+        if excitonic_particle == 'Exciton':
+            result = inspect.unwrap(fit_lifetime_X)(data_fit, x_axis, previous['c2'], previous['w'],
+                                                    previous['tau'], phi=previous['phi'])
+        else:
+            result = inspect.unwrap(fit_lifetime_T)(data_fit, x_axis, previous['N0'], previous['tau'],
+                                                    y0=previous['y0'])
+        if result.success:
+            previous = dict(result.best_values)
+        for name in names:
+            values[name][i] = result.params[name].value
+            errors[name + '_err'][i] = result.params[name].stderr if result.params[name].stderr is not None \
+                else np.nan
+        if job is not None:
+            job.set_progress((i + 1) / len(stack))
+
+    return {**values, **errors}
+
+
+def load_histograms(file, rebin=1):
+    """
+    :param file: uploaded .dat (ASCII export of HydraHarp) or .ptu (T3) file, or path of a .dat file
+    :param rebin: int - number of bins summed in one bin
+    :return: array, array - histograms (one column per channel) and resolution of each channel [ns]
+    """
+    name = file if isinstance(file, str) else file.name
+    if name.lower().endswith('.ptu'):
+        # Histogrammed from the T3 records in the background, without the ASCII export
+        histograms = show_progress(submit(get_lifetime_fromfile, file, rebin), 'Reading the PTU file...')
+        if histograms is None:
+            st.stop()
+        histograms, resolution = histograms
+        return histograms, np.full(histograms.shape[1], resolution)
+
+    if isinstance(file, str):
+        with open(file) as f:
+            lines = f.read().splitlines()
+    else:
+        lines = file.getvalue().decode(errors='replace').splitlines()
+    # For file extracted in ASCII from Picoquant software there are 10 lines of information, the resolution of each
+    # channel is given after '#ns/bin'.
+    header = [line.strip() for line in lines[:10]]
+    if '#ns/bin' in header:
+        resolutions = np.array(lines[header.index('#ns/bin') + 1].split(), dtype=float)
+    else:
+        resolutions = None
+    histograms = np.loadtxt(lines[10:], ndmin=2)
+    if resolutions is None or len(resolutions) != histograms.shape[1]:
+        resolutions = np.full(histograms.shape[1], 0.004)
+    if rebin > 1:
+        n_bins = len(histograms) // rebin * rebin
+        histograms = histograms[:n_bins].reshape(-1, rebin, histograms.shape[1]).sum(axis=1)
+    return histograms, resolutions * rebin
+
+
+def decay_window(data, window, resolution=0.004):
+    """
+    Cut a decay for the fit: all laser periods summed, from the peak + 10 ps to window [ns] later.
+
+    :param data: array - lifetime histogram
+    :param window: float - length of the fit window [ns]
+    :param resolution: float - bin width [ns]
+    :return: array - the window
+    """
+    peaks, properties = find_peaks(data, prominence=np.max(data) / 2)
+    peaks = peaks[data[peaks] >= np.max(data[peaks]) / 100]
+    if len(peaks) > 1:
+        period, peak_position, n_pulses = detect_period(peaks)
+        data, _ = fold_periods(data, period, peak_position, n_periods=n_pulses)
+    start = int(np.argmax(data)) + int(round(0.010/resolution))
+    return data[start:start + int(window/resolution)]
+
+
+def global_fit():
+    # Fit a series of decays (power, temperature...) at once with some shared parameters.
+
+    # Upload several files from your computer. .dat (ASCII export from HydraHarp) or .ptu (T3).
+    files = st.file_uploader('Load data', type={"dat", "ptu"}, accept_multiple_files=True)
+    if not files:
+        return
+
+    col1, col2 = st.columns(2)
+    with col1:
+        # Select if you want to fit a Trion or an Exciton
+        excitonic_particle = st.selectbox('What is it?', ('Exciton', 'Trion'))
+    with col2:
+        shared = st.multiselect('Shared parameters', GLOBAL_PARAMETERS[excitonic_particle],
+                                default=['w', 'tau'] if excitonic_particle == 'Exciton' else ['tau'])
+    window = st.sidebar.number_input('Fit window [ns]', 0.1, 10.0, 1.0)
+    log_scale = st.sidebar.checkbox('Log scale')
+    rebin = st.sidebar.number_input('Rebin', 1, 64, 1)
+
+    # One decay per selected channel of each file
+    labels = []
+    stack = []
+    resolutions = []
+    for file in files:
+        with stage('load'):
+            histograms, file_resolutions = load_histograms(file, rebin)
+        channels = st.sidebar.multiselect('Channels of ' + file.name, list(range(histograms.shape[1])), default=[0])
+        for channel in channels:
+            labels.append(file.name + ' [' + str(channel) + ']')
+            stack.append(decay_window(histograms[:, channel], window, file_resolutions[channel]))
+            resolutions.append(file_resolutions[channel])
+    if not stack:
+        return
+    if not np.allclose(resolutions, resolutions[0]):
+        st.error('All the decays must have the same resolution.')
+        return
+    resolution = resolutions[0]
+    n_x = min(len(decay) for decay in stack)
+    stack = np.array([decay[:n_x] for decay in stack])
+    X_fit = resolution*np.arange(0, n_x)
+
+    with stage('fit'):
+        result = show_progress(submit(fit_global, stack, X_fit, excitonic_particle, tuple(shared)),
+                               'Fitting the decays...')
+    if result is None:
+        st.stop()
+
+    fig, ax = plt.subplots()
+    ax.tick_params(direction='in', bottom=True, top=True, left=True, right=True, labelsize=12)
+    ax.set_xlabel("Time [ns]", fontsize=14)
+    ax.set_ylabel("Counts", fontsize=14)
+    for i, label in enumerate(labels):
+        line, = ax.plot(X_fit, stack[i], 'o', markersize=2, label=label)
+        ax.plot(X_fit, result['best_fit'][i], color=line.get_color())
+    if 'tau' in shared:
+        ax.set_title('Lifetime = ' + str(round(result['tau'][0] * 1000, 2)) + ' ps')
+    if log_scale:
+        ax.set_yscale('log')
+    ax.legend()
+    with stage('plot'):
+        st.pyplot(fig)
+
+    # One line per decay: fitted values and standard errors. FSS in eV as in the single fit.
+    table = pd.DataFrame({key: result[key] for name in GLOBAL_PARAMETERS[excitonic_particle]
+                          for key in (name, name + '_err')}, index=labels)
+    if excitonic_particle == 'Exciton':
+        table['FSS [eV]'] = 1e9 * table['w'] * 2 * hbar / eV
+    st.dataframe(table)
+    st.write('Reduced chi-square: ' + str(round(result['redchi'], 2)))
+
+    download_plot(fig, output_name='global_fit.pdf')
+
+
 def main():
 
+    if st.sidebar.checkbox('Global fit of several decays'):
+        global_fit()
+        return
+
     demo_mode=st.checkbox('Use demo mode', help="if you don't have your own datasets to test the software")
 
     if demo_mode:
         file = "demo"
-        data = np.loadtxt(os.getcwd()+"/demo_data/demo_lifetime.dat", skiprows=10)[:, 3]
+        with stage('load'):
+            histograms, resolutions = load_histograms(os.getcwd()+"/demo_data/demo_lifetime.dat")
+        data, resolution = histograms[:, 3], resolutions[3]
     else:
-        # Upload a file from your computer. Has to be a .dat (ASCII export from HydraHarp).
-        file = st.file_uploader('Load data', type={"dat"})
+        # Upload a file from your computer. .dat (ASCII export from HydraHarp) or .ptu measured in T3 mode.
+        file = st.file_uploader('Load data', type={"dat", "ptu"})
 
     if file is not None:
         # This creates columns for widgets.
@@ -77,9 +324,12 @@ def main():
             # This is how you add womething to one column.
             with col1:
                 use_column = st.number_input('Use channel:', value = 0)
+            # Sum groups of bins: less noise per bin for long lifetimes
+            rebin = st.sidebar.number_input('Rebin', 1, 64, 1)
 
-            # For file extracted in ASCII from Picoquant software there are 10 lines of information that we skip.
-            data = np.loadtxt(file, skiprows=10)[:, use_column]
+            with stage('load'):
+                histograms, resolutions = load_histograms(file, rebin)
+            data, resolution = histograms[:, use_column], resolutions[use_column]
 
         # Peak finder
         # peaks is a list of the index of all peaks with a certain prominence and width
@@ -94,16 +344,59 @@ def main():
 
         first_peak = peaks[0]
 
+        # Sum all the laser periods into one decay: same window, many times more counts.
+        # The IRF, if any, is folded with the same periods below.
+        fold = st.sidebar.checkbox('Sum all periods', value=len(peaks) > 1,
+                                   help='Folds the histogram on the repetition period of the laser')
+        fold_info = None
+        if fold and len(peaks) > 1:
+            period, peak_position, n_pulses = detect_period(peaks)
+            data, fold_info = fold_periods(data, period, peak_position, n_periods=n_pulses)
+            first_peak = int(np.argmax(data))
+            peaks = np.array([first_peak])
+            data_pk = data[peaks]
+            st.sidebar.caption(f"{fold_info['n_periods']} periods of {period * resolution:.3f} ns summed. "
+                               f"Spread of the counts per period: {100 * fold_info['spread']:.2f} % "
+                               f"(shot noise: {100 * fold_info['poisson_spread']:.2f} %)")
+
         ## Sidebar widgets
 
+        # Reconvolution with the instrument response: the fit includes the rise of the signal.
+        # The IRF is a .dat or .ptu file measured with the same resolution and the same sync as the data.
+        reconvolution = st.sidebar.checkbox('IRF reconvolution', help='For lifetimes close to the detector jitter')
+        irf = None
+        if reconvolution:
+            irf_file = st.sidebar.file_uploader('Load IRF', type={"dat", "ptu"})
+            if irf_file is not None:
+                irf_column = st.sidebar.number_input('IRF channel:', value=0)
+                with stage('load'):
+                    irf_histograms, irf_resolutions = load_histograms(irf_file, rebin if file != "demo" else 1)
+                irf = irf_histograms[:, irf_column]
+                if not np.isclose(irf_resolutions[irf_column], resolution):
+                    st.sidebar.error('The IRF and the data must have the same resolution.')
+                    st.stop()
+                if fold_info is not None:
+                    # The same periods as the data, bin for bin
+                    try:
+                        irf = fold_periods(irf, fold_info['period'], offsets=fold_info['offsets'])[0]
+                    except ValueError:
+                        st.sidebar.error('The IRF is shorter than the periods summed in the data.')
+                        st.stop()
+            else:
+                st.sidebar.warning('Load an IRF to use the reconvolution.')
+                reconvolution = False
+
         # Start and stop in [ns]
         # We will fit between start and stop only. These parameters influence the fit a lot.
-        # Start at the first peak + 10 ps, stop 1 ns later.
-        start = st.sidebar.number_input('Start [ns]', 0.0, len(data)*0.004, first_peak*0.004+0.010)
-        stop = st.sidebar.number_input('Stop [ns]', 0.0, len(data)*0.004, first_peak*0.004+1)
+        # Start at the first peak + 10 ps (200 ps before the peak with the reconvolution), stop 1 ns later.
+        start_default = first_peak*resolution-0.200 if reconvolution else first_peak*resolution+0.010
+        start = st.sidebar.number_input('Start [ns]', 0.0, len(data)*resolution, max(start_default, 0.0))
+        stop = st.sidebar.number_input('Stop [ns]', 0.0, len(data)*resolution, first_peak*resolution+1)
 
         # We switch back to time bin for the fit.
-        data_fit = data[int(start/0.004):int(stop/0.004)]
+        data_fit = data[int(start/resolution):int(stop/resolution)]
+        if reconvolution:
+            irf_fit = irf[int(start/resolution):int(stop/resolution)]
 
         with col2:
             # Select if you want to fit a Trion or an Exciton
@@ -111,19 +404,38 @@ def main():
                 'What is it?',
                 ('Exciton', 'Trion'))
 
+        # Poisson likelihood: unbiased in the tail of the decay where there are few counts
+        likelihood = st.sidebar.radio('Fit', ('least_squares', 'poisson'),
+                                      format_func=lambda option: {'least_squares': 'Least squares',
+                                                                  'poisson': 'Poisson likelihood'}[option])
+
         # Zoom in from start - 1 ns to stop + 1 ns
         zoom_in= st.sidebar.checkbox('Zoom', value=True)
         # Display graph in log scale
         log_scale = st.sidebar.checkbox('Log scale')
 
-        # Use different parameters for the fit. If unchecked you use defualt values.
+        # Use different parameters for the fit. If unchecked, the fit starts from the result of the previous
+        # run of the page on the same data and window (warm start) or else from a log-linear fit of the decay.
         change_fit_pars = st.sidebar.checkbox('Change fit parameters')
+        warm_key = input_hash(data_fit, start, stop)
+        previous = st.session_state.get('lifetime_fit_' + excitonic_particle)
+        if previous is not None and previous.get('key') != warm_key:
+            previous = None
+        phi_ = 0
+        y0_ = 1
         if change_fit_pars:
             c_ = st.sidebar.slider('Height', 0, int(np.max(data_fit)), int(np.max(data_fit)))
             tau_ = st.sidebar.slider('Lifetime [ns]', 0.000, 0.800, 0.145)
+        elif previous is not None:
+            c_, tau_, w_ = previous['c'], previous['tau'], previous.get('w', 4.00)
+            phi_, y0_ = previous.get('phi', 0), previous.get('y0', 1)
         else:
-            c_ = 2380.00
-            tau_ = 0.145
+            # from the maximum: with the reconvolution the window also contains the rise
+            top = np.argmax(data_fit)
+            c_, tau_ = guess_decay(data_fit[top:], resolution*np.arange(0, len(data_fit)-top))
+            if excitonic_particle == 'Exciton':
+                # sin² is 1/2 on average
+                c_ = 2 * c_
             w_ = 4.00
 
         if change_fit_pars and excitonic_particle == 'Exciton':
@@ -131,9 +443,9 @@ def main():
 
 
         # Fit
-        # !!! Resolution is 4 ps. X axis is in ns !!!
-        X_fit = 0.004*np.arange(0, len(data_fit))
-        X = 0.004*np.arange(0, len(data))
+        # X axis is in ns
+        X_fit = resolution*np.arange(0, len(data_fit))
+        X = resolution*np.arange(0, len(data))
 
         fig, ax = plt.subplots()
         ax.tick_params(direction='in', bottom=True, top=True, left=True, right=True, labelsize=12)
@@ -143,9 +455,35 @@ def main():
 
         # Create an interactive plotly plot. No more comments needed here.
 
-        if excitonic_particle == 'Exciton':
+        if reconvolution:
+            # Multi-exponential decay for the trion, exciton beat for the exciton
+            if excitonic_particle == 'Exciton':
+                fit_R = fit_reconvolution(data_fit, irf_fit, resolution, model='exciton beat', tau=tau_, w=w_,
+                                          phi=phi_)
+                title_fig = 'Lifetime = ' + str(round(fit_R.params['tau'].value * 1000, 2)) + ' ps, FSS = ' + \
+                            str(round(1e9 * fit_R.params['w'].value * 2 * hbar / eV, 9)) + ' eV'
+            else:
+                n_exp = st.sidebar.number_input('Number of exponentials', 1, 3, 1)
+                fit_R = fit_reconvolution(data_fit, irf_fit, resolution, model='multi-exponential', n_exp=n_exp,
+                                          tau=tau_)
+                title_fig = 'Lifetime = ' + ', '.join(str(round(fit_R.params['tau%d' % i].value * 1000, 2))
+                                                      for i in range(1, n_exp + 1)) + ' ps'
+
+            ax.plot(X, data, '-o', markersize = 3, label="Data")
 
-            fit_X = fit_lifetime_X(data_fit, X_fit, c_, w_, tau_)
+            ax.plot(X_fit + start, fit_R.best_fit, label="Fit")
+
+            ax.set_title(title_fig)
+
+        elif excitonic_particle == 'Exciton':
+
+            fit_X = fit_lifetime_X(data_fit, X_fit, c_, w_, tau_, phi=phi_, likelihood=likelihood)
+            if fit_X.success:
+                st.session_state['lifetime_fit_Exciton'] = {'key': warm_key,
+                                                            'c': fit_X.params['c2'].value,
+                                                            'tau': fit_X.params['tau'].value,
+                                                            'w': fit_X.params['w'].value,
+                                                            'phi': fit_X.params['phi'].value}
 
             # gets the y value of the fit
             Y_fit = fit_X.best_fit
@@ -156,14 +494,19 @@ def main():
 
             ax.plot(X, data, '-o', markersize = 3, label="Data")
 
-            ax.plot(peaks*0.004, data_pk, 'o', label="Peaks")
+            ax.plot(peaks*resolution, data_pk, 'o', label="Peaks")
 
             ax.plot(X_fit+start, Y_fit, label="Fit")
 
             title_fig = 'Lifetime = ' + str(round(tau * 1000, 2)) + ' ps, FSS = ' + str(round(1e9 * w * 2 * hbar / eV, 9)) + ' eV'
             ax.set_title(title_fig)
         else:
-            fit_T = fit_lifetime_T(data_fit, X_fit, c_, tau_)
+            fit_T = fit_lifetime_T(data_fit, X_fit, c_, tau_, y0=y0_, likelihood=likelihood)
+            if fit_T.success:
+                st.session_state['lifetime_fit_Trion'] = {'key': warm_key,
+                                                          'c': fit_T.params['N0'].value,
+                                                          'tau': fit_T.params['tau'].value,
+                                                          'y0': fit_T.params['y0'].value}
 
             # gets the y value of the fit
             Y_fit = fit_T.best_fit
@@ -172,7 +515,7 @@ def main():
 
             ax.plot(X, data, '-o', markersize = 3, label="Data")
 
-            ax.plot(peaks * 0.004, data_pk, 'o', label="Peaks")
+            ax.plot(peaks * resolution, data_pk, 'o', label="Peaks")
 
             ax.plot(X_fit + start, Y_fit, label="Fit")
 
@@ -190,29 +533,28 @@ def main():
         ax.axvline(stop, linestyle="--", color="firebrick")
 
 
-        st.pyplot(fig)
+        with stage('plot'):
+            st.pyplot(fig)
 
         # Show fit report
         show_report = st.sidebar.checkbox('Show fit report')
-        if show_report and excitonic_particle == 'Trion':
+        if show_report and reconvolution:
+            st.write(fit_report(fit_R))
+        elif show_report and excitonic_particle == 'Trion':
             st.write(fit_T.fit_report())
-        if show_report and excitonic_particle == 'Exciton':
+        elif show_report and excitonic_particle == 'Exciton':
             st.write(fit_X .fit_report())
 
+        # Bootstrap / profile likelihood errors on the lifetime (and the FSS), not for the reconvolution
+        if not reconvolution and excitonic_particle == 'Exciton':
+            show_uncertainties(fit_X, ['tau', 'FSS'], derived={'FSS': 'w*' + repr(1e9 * 2 * hbar / eV)},
+                               profile=['tau'], scales={'tau': (1000, 'ps'), 'FSS': (1, 'eV')})
+        elif not reconvolution:
+            show_uncertainties(fit_T, ['tau'], profile=['tau'], scales={'tau': (1000, 'ps')})
+
         if file != "demo":
-            # To download the plot
-            directory = os.getcwd()
-            local_path = directory + os.sep + "temp_picture.pdf"
-            fig.savefig(local_path, bbox_inches='tight')
-            with open("temp_picture.pdf", "rb") as picture:
-                btn = st.download_button(
-                    label="Save plot",
-                    data=picture,
-                    file_name=file.name[:-4] + ".pdf",
-                    mime="image/pdf"
-                )
-            if btn:
-                os.remove(local_path)
+            # To download the plot. The pdf is rendered in memory, nothing is written on the server.
+            download_plot(fig, file.name)
 
 
 if __name__ == "__main__":
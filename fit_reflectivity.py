@@ -20,6 +20,10 @@ Delimiter = Tab            Output order = Pixel, Intensity
 X-Axis unit = pixel        New Line Characters = Carriage return: yes, Line Feed: yes.
 Output File Options = One File For All Frames and Single Column
 Pixel Format = Convert CCD X/Y Dimension into 1 Dimension
+The binary .spe file of the camera can also be loaded directly, without export.
+
+A file with several frames (tuning series, map of micropillars) can be fitted frame by frame in the background with
+cavity_toolbox.fit_cav_batch. The table of xc, κ and Q is saved as Parquet.
 
 """
 
@@ -31,26 +35,27 @@ import streamlit as st
 import plotly.graph_objects as go
 from plotly.graph_objs import *
 import os
-import pandas as pd
+
+from result_cache import cached
+from profiling import stage, timed
+from uncertainty import show_uncertainties, LORENTZIAN_DERIVED, LORENTZIAN_SCALES
+from poisson_fit import poisson_fit, lorentzian_model, spectral_start
+from varpro_fit import varpro_fit
+from spectro_toolbox import Calibration, get_calibration, nearest_index, index_range, nm_to_eV, eV_to_nm, \
+    read_redback_csv, load_frames, show_batch
+from cavity_toolbox import fit_cav_batch
+from mode_tracker import track_modes
+from job_queue import submit, show_progress
 
 
 # Conversion from px to eV
 def px_to_eV(spectro, px, calib):
-    return 1239.8 / (spectro - (670 - px) * 1 / calib)
+    return Calibration(spectro, calib).px_to_eV(px)
 
 
 # Conversion from px to nm
 def px_to_nm(spectro, px, calib):
-    return spectro - (670 - px) * 1 / calib
-
-
-# Conversion from px to nm
-def eV_to_nm(eV):
-    return np.array([1239.8 / E for E in eV])
-
-
-def nm_to_eV(nm):
-    return np.array([1239.8 / WL for WL in nm])
+    return Calibration(spectro, calib).px_to_nm(px)
 
 
 # Create the X axis of the camera in px depending on the horizontal size
@@ -58,9 +63,9 @@ def get_Xaxis(nb_px):
     return np.arange(1, nb_px + 1, 1)
 
 
-# get WL (in nm) axis
+# get WL (in nm) axis, computed once per calibration
 def get_WLaxis(spectro, nb_px, calib):
-    return px_to_nm(spectro, get_Xaxis(nb_px), calib)
+    return get_calibration(spectro, calib, nb_px).nm
 
 
 # Toolbox for fit.
@@ -73,7 +78,12 @@ def add_peak(prefix, center, amplitude=-1000, sigma=100e-6):
     return peak, pars
 
 
-def fit_cav(x, y, start_search, stop_search, number_of_elements, zoom_fit):
+@timed('fit_cav')
+@cached('fit_cav')
+def fit_cav(x, y, start_search, stop_search, number_of_elements, zoom_fit, likelihood='least_squares',
+            solver='lmfit'):
+    # likelihood='poisson' minimises the Poisson deviance instead of the squares (poisson_fit)
+    # solver='varpro' solves the least squares by variable projection (varpro_fit), much faster than lmfit
 
     xdat = x[start_search:stop_search]
     ydat = y[start_search:stop_search]
@@ -106,7 +116,13 @@ def fit_cav(x, y, start_search, stop_search, number_of_elements, zoom_fit):
         params.update(pars)
 
     init = model.eval(params, x=xdat_fit)
-    result = model.fit(ydat_fit, params, x=xdat_fit)
+    if likelihood == 'poisson':
+        result = poisson_fit(lorentzian_model(len(rough_peak_positions), 'linear'),
+                             spectral_start(params, xdat_fit, ydat_fit), ydat_fit, xdat_fit)
+    elif solver == 'varpro':
+        result = varpro_fit(params, ydat_fit, xdat_fit, 'linear', model=model)
+    else:
+        result = model.fit(ydat_fit, params, x=xdat_fit)
     xc = result.params["lz1_center"].value
     sigma = result.params["lz1_sigma"].value
 
@@ -118,7 +134,7 @@ def fit_cav(x, y, start_search, stop_search, number_of_elements, zoom_fit):
     FWHM = round(FWHM * 1e6, 2)
     xc = round(xc, 6)
 
-    return xdat, ydat, model, parameters, xc, FWHM, Q
+    return xdat, ydat, model, parameters, xc, FWHM, Q, result
 
 
 def main():
@@ -133,19 +149,13 @@ def main():
 
     if spectro == 'Spectra Physics':
 
-        file = st.file_uploader('Load data', type={"txt"})
+        file = st.file_uploader('Load data', type={"txt", "spe"})
 
         if demo_mode:
             file = "demo"
-            data = np.loadtxt(os.getcwd()+"/demo_data/demo_reflectivity.txt")[:, 1]
 
         if file is not None:
 
-            if file != "demo":
-                data = np.loadtxt(file)[:, 1]
-                # We only use the y axis stored in the second column of the .txt file here.
-
-
             # !!!! Calibration !!!!
 
             with st.sidebar.expander("Calibration"):
@@ -160,26 +170,34 @@ def main():
                 Calib = st.number_input('Calibration [px/nm]', value = 45.34942)
 
 
-            # X acis must be in energy
-            X = np.array([px_to_eV(Spectro, i, Calib) for i in range(1, Nb_px+1)])
-            Y = np.array(data)
+            # .txt: we only use the y axis stored in the second column of the file here.
+            # One File For All Frames: the frames follow each other, they are parsed block by block.
+            # .spe: binary file of the camera, read without export
+            with stage('load'):
+                frames = load_frames(os.getcwd() + "/demo_data/demo_reflectivity.txt" if file == "demo" else file,
+                                     Nb_px)
+            n_frames, Nb_px = frames.shape
+
+            # X acis must be in energy. The axis is computed once per calibration.
+            X = get_calibration(Spectro, Calib, Nb_px).eV
+            Y = frames[0].astype(float)
 
 
 
             stop = st.sidebar.number_input('Start [eV]',
-                                           value=X[np.where(abs(X - 1.33) < 300e-6)[0][0]],
+                                           value=float(X[nearest_index(X, 1.33)]),
                                            step=1e-4,
                                            format="%.4f"
                                            )
 
             start = st.sidebar.number_input('Stop [eV]',
-                                            value=X[np.where(abs(X - 1.35) < 300e-6)[0][0]],
+                                            value=float(X[nearest_index(X, 1.35)]),
                                             step=1e-4,
                                             format="%.4f"
                                             )
 
-            i_start = np.where(abs(X - start) < 300e-6)[0][0]
-            i_stop = np.where(abs(X - stop) < 300e-6)[0][0]
+            # The energy decreases with the pixel: the range is sorted by index_range
+            i_start, i_stop = index_range(X, start, stop)
 
             # Find the number_of_elements largest peaks in peaks.
             # This is usefull is you see many modes that are too close to each other. If you only see one use 1
@@ -189,8 +207,44 @@ def main():
             # Try more or less, but around 100 is good for Q = 10 000
             zoom_fit = st.sidebar.number_input('Zoom fit', value=75)
 
-            xdat, ydat, model, params, xc, FWHM, Q = fit_cav(X, Y, i_start, i_stop, number_of_elements, zoom_fit)
-
+            # Poisson likelihood for spectra in counts: unbiased in the wings of the lines
+            likelihood = 'poisson' if st.sidebar.checkbox('Poisson likelihood fit') else 'least_squares'
+            # Variable projection: the same least squares, in a few iterations
+            solver = 'varpro' if st.sidebar.checkbox('Fast solver (variable projection)', value=True) else 'lmfit'
+
+            if n_frames > 1:
+                with st.sidebar.expander("Frames"):
+                    batch = st.checkbox('Fit all the %d frames' % n_frames, value=True)
+                    # 0 for a series (temperature, voltage...), the width of the map for a map of micropillars
+                    map_width = st.number_input('Frames per line of the map (0 for a series)', value=0, min_value=0)
+                    # Series: the modes of the first frame are followed in narrow windows
+                    track = st.checkbox('Track the modes along the series', value=True)
+                    frame = st.number_input('Frame to display', value=0, min_value=0, max_value=n_frames - 1)
+                Y = frames[frame].astype(float)
+
+                if batch and track and not map_width:
+                    table = show_progress(submit(track_modes, X, frames, number_of_elements, 'dip',
+                                                 start_search=i_start, stop_search=i_stop, zoom_fit=zoom_fit,
+                                                 likelihood=likelihood, solver=solver),
+                                          'Tracking the modes...')
+                    if table is None:
+                        st.stop()
+                    show_batch(table, 'demo_reflectivity.txt' if file == 'demo' else file.name)
+                elif batch and map_width and n_frames % map_width:
+                    st.error('The %d frames do not fill a map of %d frames per line.' % (n_frames, map_width))
+                elif batch:
+                    stack = frames
+                    if map_width:
+                        stack = frames.reshape(n_frames // map_width, map_width, Nb_px)
+                    table = show_progress(submit(fit_cav_batch, X, stack, i_start, i_stop, number_of_elements,
+                                                 zoom_fit, likelihood=likelihood, solver=solver),
+                                          'Fitting the frames...')
+                    if table is None:
+                        st.stop()
+                    show_batch(table, 'demo_reflectivity.txt' if file == 'demo' else file.name)
+
+            xdat, ydat, model, params, xc, FWHM, Q, result = fit_cav(X, Y, i_start, i_stop, number_of_elements, zoom_fit,
+                                                                     likelihood=likelihood, solver=solver)
             title_fig = "xc = " + str(round(xc,5))+"eV | κ = " + str(FWHM) + " µeV" + " | Q = " + str(Q)
             layout = Layout(
                 plot_bgcolor='whitesmoke'
@@ -220,7 +274,12 @@ def main():
                               xaxis=dict(tickformat="000"),
                               yaxis=dict(tickformat="000")
             )
-            st.plotly_chart(fig)
+            with stage('plot'):
+                st.plotly_chart(fig)
+
+            # Bootstrap / profile likelihood errors on the linewidth and the Q factor
+            show_uncertainties(result, ['lz1_center', 'kappa', 'Q'], derived=LORENTZIAN_DERIVED,
+                               profile=['lz1_sigma'], scales=LORENTZIAN_SCALES)
 
 
     else:
@@ -231,14 +290,9 @@ def main():
         file = st.file_uploader('Load data', type={"csv"})
 
         if file is not None:
-            header = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 12, 14]
-            df = pd.read_csv(file,
-                             delimiter=',',
-                             skiprows=header)
-            # We only use the y axis stored in the second column of the .txt file here.
-
-            X = df['# wavelength'].to_numpy()
-            Y = df[' signal'].to_numpy()
+            # Only the wavelength and signal columns are parsed, once per file
+            with stage('load'):
+                X, Y = read_redback_csv(file)
 
             unit = st.sidebar.selectbox("Choose unit for plot range",
                                         ("nm",
@@ -246,29 +300,27 @@ def main():
                                         )
 
             if unit == 'nm':
-                start = st.sidebar.number_input('Start', value=X[np.where(abs(X - 924) < 0.01)[0][0]])
-                stop = st.sidebar.number_input('Stop', value=X[np.where(abs(X - 926) < 0.01)[0][0]])
+                start = st.sidebar.number_input('Start', value=float(X[nearest_index(X, 924)]))
+                stop = st.sidebar.number_input('Stop', value=float(X[nearest_index(X, 926)]))
 
                 # In WL
-                i_start = np.where(abs(X - start) < 0.01)[0][0]
-                i_stop = np.where(abs(X - stop) < 0.01)[0][0]
+                i_start, i_stop = index_range(X, start, stop)
 
             if unit == 'eV':
                 start = st.sidebar.number_input('Start',
-                                                value=1239.8 / X[np.where(abs(X - 926) < 0.01)[0][0]],
+                                                value=float(nm_to_eV(X[nearest_index(X, 926)])),
                                                 step =1e-4,
                                                 format="%.4f"
                                                 )
 
                 stop = st.sidebar.number_input('Stop',
-                                               value=1239.8 / X[np.where(abs(X - 924) < 0.01)[0][0]],
+                                               value=float(nm_to_eV(X[nearest_index(X, 924)])),
                                                step=1e-4,
                                                format="%.4f"
                                                )
 
                 # In energy we switch start and stop
-                i_start = np.where(abs(X - 1239.8 / stop) < 0.01)[0][0]
-                i_stop = np.where(abs(X - 1239.8 / start) < 0.01)[0][0]
+                i_start, i_stop = index_range(X, eV_to_nm(stop), eV_to_nm(start))
 
             # Find the number_of_elements largest peaks in peaks.
             # This is usefull is you see many modes that are too close to each other. If you only see one use 1
@@ -278,8 +330,13 @@ def main():
             # Try more or less, but around 100 is good for Q = 10 000
             zoom_fit = st.sidebar.number_input('Zoom fit', value=75)
 
-            xdat, ydat, model, params, xc, FWHM, Q = fit_cav(nm_to_eV(X), Y, i_start, i_stop, number_of_elements, zoom_fit)
+            # Poisson likelihood for spectra in counts: unbiased in the wings of the lines
+            likelihood = 'poisson' if st.sidebar.checkbox('Poisson likelihood fit') else 'least_squares'
+            # Variable projection: the same least squares, in a few iterations
+            solver = 'varpro' if st.sidebar.checkbox('Fast solver (variable projection)', value=True) else 'lmfit'
 
+            xdat, ydat, model, params, xc, FWHM, Q, result = fit_cav(nm_to_eV(X), Y, i_start, i_stop, number_of_elements, zoom_fit,
+                                                                     likelihood=likelihood, solver=solver)
             title_fig = "xc = " + str(round(xc, 5)) + "eV | κ = " + str(FWHM) + " µeV" + " | Q = " + str(Q)
             layout = Layout(
                 plot_bgcolor='whitesmoke'
@@ -310,7 +367,12 @@ def main():
                               yaxis=dict(tickformat="000")
                               )
 
-            st.plotly_chart(fig)
+            with stage('plot'):
+                st.plotly_chart(fig)
+
+            # Bootstrap / profile likelihood errors on the linewidth and the Q factor
+            show_uncertainties(result, ['lz1_center', 'kappa', 'Q'], derived=LORENTZIAN_DERIVED,
+                               profile=['lz1_sigma'], scales=LORENTZIAN_SCALES)
 
 if __name__ == "__main__":
     main()
@@ -8,10 +8,18 @@ Input: .PTU using Mode 2 on ch 1 and 2. Either path OR file from streamlit
 
 Output: Returns the histogram
 
+Lifetime histograms are built from the records of .PTU files measured in Mode 3 (T3): the delay of each photon
+after the sync (dtime) is histogrammed for each channel, with the resolution read from the header. The records are
+read by chunks: large files are never loaded in memory at once.
+
 """
 
+import struct
+
+import numpy as np
 from readPTU import PTUfile, PTUmeasurement
-import os
+from session_toolbox import uploaded_file_path
+from result_cache import cached
 
 def get_ptu_frompath(path):
 
@@ -30,17 +38,121 @@ def get_ptu_frompath(path):
 
     return hist_x, hist_y
 
-def get_ptu_fromfile(streamlit_file):
-    directory = os.getcwd()
+@cached('ptu_histogram')
+def get_ptu_fromfile(streamlit_file, job=None):
     # file is a file that has been uploaded using streamlit
+    # job is given when the function is run in the background by job_queue
     if streamlit_file is not None:
-        local_path = directory + os.sep + "temporaryfile.ptu"
-        with open(local_path, "wb") as binary_file:
-            # Write bytes to file
-            binary_file.write(streamlit_file.read())
-
+        if job is not None:
+            job.set_progress(0, 'Correlating the PTU records...')
+        # readPTU needs a path: the upload is copied to a unique temporary file, removed after reading.
+        with uploaded_file_path(streamlit_file, suffix=".ptu") as local_path:
             hist_x, hist_y = get_ptu_frompath(local_path)
 
-            os.remove(local_path)
+        return hist_x, hist_y
+
+
+# Types of the tags of the PTU header
+tyEmpty8 = 0xFFFF0008
+tyBool8 = 0x00000008
+tyInt8 = 0x10000008
+tyBitSet64 = 0x11000008
+tyColor8 = 0x12000008
+tyFloat8 = 0x20000008
+tyTDateTime = 0x21000008
+tyFloat8Array = 0x2001FFFF
+tyAnsiString = 0x4001FFFF
+tyWideString = 0x4002FFFF
+tyBinaryBlob = 0xFFFFFFFF
+
+# T3 record types with the HydraHarp layout: special (1 bit), channel (6), dtime (15), nsync (10)
+# HydraHarp V1 counts one overflow per overflow record, the others give the number of overflows in nsync.
+T3_RECORD_TYPES = {0x00010304: 'HydraHarp V1',
+                   0x01010304: 'HydraHarp V2',
+                   0x00010306: 'TimeHarp 260N',
+                   0x00010307: 'TimeHarp 260P',
+                   0x00010308: 'MultiHarp'}
+
+
+def read_ptu_header(f):
+    """
+    :param f: binary file object at the beginning of a .ptu file
+    :return: dict - value of each tag of the header. Tags of arrays are named 'ident(index)'.
+    f is left at the first record.
+    """
+    if f.read(8).rstrip(b'\x00') != b'PQTTTR':
+        raise ValueError('Not a PTU file')
+    f.read(8)  # version
+
+    tags = {}
+    while True:
+        ident, index, tag_type = struct.unpack('<32siI', f.read(40))
+        ident = ident.rstrip(b'\x00').decode(errors='replace')
+        name = ident if index == -1 else ident + '(' + str(index) + ')'
+        if tag_type == tyFloat8 or tag_type == tyTDateTime:
+            value = struct.unpack('<d', f.read(8))[0]
+        elif tag_type in (tyAnsiString, tyWideString, tyFloat8Array, tyBinaryBlob):
+            length = struct.unpack('<q', f.read(8))[0]
+            value = f.read(length)
+            if tag_type == tyAnsiString:
+                value = value.rstrip(b'\x00').decode(errors='replace')
+            elif tag_type == tyWideString:
+                value = value.decode('utf-16-le', errors='replace').rstrip('\x00')
+        else:
+            value = struct.unpack('<q', f.read(8))[0]
+        tags[name] = value
+        if ident == 'Header_End':
+            return tags
+
+
+def get_lifetime_histogram(f, rebin=1, chunk_records=2**22, job=None):
+    """
+    Lifetime histogram of each channel of a T3 .ptu file.
+
+    :param f: binary file object at the beginning of the file (open file or uploaded file)
+    :param rebin: int - number of dtime bins summed in one bin of the histogram
+    :param chunk_records: int - number of records read at once
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: array, float - histograms (one column per channel, as the .dat exports) and resolution [ns]
+    """
+    tags = read_ptu_header(f)
+    record_type = tags['TTResultFormat_TTTRRecType']
+    if record_type not in T3_RECORD_TYPES:
+        raise ValueError('Only T3 files (Mode 3) of HydraHarp, TimeHarp 260 and MultiHarp are supported')
+    resolution = tags['MeasDesc_Resolution'] * 1e9
+    n_records = tags['TTResult_NumberOfRecords']
+    n_channels = tags.get('HW_InpChannels', 2)
+
+    # Bins in one sync period, at most the 15 bits of dtime
+    n_bins = 2**15
+    if tags.get('TTResult_SyncRate'):
+        n_bins = min(n_bins, int(np.ceil(1e9 / tags['TTResult_SyncRate'] / resolution)) + 1)
+
+    counts = np.zeros(n_channels * 2**15, dtype=np.int64)
+    done = 0
+    while done < n_records:
+        records = np.frombuffer(f.read(4 * min(chunk_records, n_records - done)), dtype='<u4')
+        if len(records) == 0:
+            break
+        done += len(records)
+        # Photons only: the special records are the overflows and markers
+        photons = records[(records >> 31) == 0]
+        channel = (photons >> 25) & 63
+        photons = photons[channel < n_channels]
+        dtime = (photons >> 10) & 0x7FFF
+        counts += np.bincount(channel[channel < n_channels] * 2**15 + dtime, minlength=len(counts))
+        if job is not None:
+            job.set_progress(done / n_records, 'Histogramming the PTU records...')
+
+    histograms = counts.reshape(n_channels, 2**15)[:, :n_bins].T
+    if rebin > 1:
+        n_bins = len(histograms) // rebin * rebin
+        histograms = histograms[:n_bins].reshape(-1, rebin, n_channels).sum(axis=1)
+    return histograms.astype(float), resolution * rebin
+
 
-            return hist_x, hist_y
+@cached('ptu_lifetime')
+def get_lifetime_fromfile(streamlit_file, rebin=1, job=None):
+    # file is a file that has been uploaded using streamlit, read from the beginning
+    streamlit_file.seek(0)
+    return get_lifetime_histogram(streamlit_file, rebin=rebin, job=job)
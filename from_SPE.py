@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+This script reads the binary .spe files of the Princeton CCD cameras (Winspec SPE 2.x and LightField SPE 3.0)
+without any ASCII export.
+
+Input: .spe file, either path OR file from streamlit
+
+Output: spectra (n_frames, n_px) for the fits of fit_reflectivity / fit_PL, or the raw frames
+(n_frames, n_rows, n_px).
+
+The frames are never copied when the file is opened: a path is memory-mapped and an uploaded file (already in
+memory) is viewed in place. The region of interest is sliced from this view and the vertical binning (sum over the
+rows of the ROI) is done by blocks of frames, so that only the pixels of the ROI of one block are read at a time.
+
+"""
+
+import re
+import struct
+
+import numpy as np
+
+from result_cache import cached
+
+# Size of the binary header, the frames follow it
+SPE_HEADER_SIZE = 4100
+
+# Codes of the data types of the frames
+SPE_DTYPES = {0: np.float32,
+              1: np.int32,
+              2: np.int16,
+              3: np.uint16,
+              8: np.uint32}
+
+
+def _buffer(source):
+    # :return: read-only array of bytes of the file, without copy
+    if isinstance(source, str):
+        return np.memmap(source, dtype=np.uint8, mode='r')
+    if hasattr(source, 'getbuffer'):
+        # streamlit UploadedFile is a BytesIO
+        return np.frombuffer(source.getbuffer(), dtype=np.uint8)
+    return np.frombuffer(source, dtype=np.uint8)
+
+
+def read_spe_header(buffer):
+    """
+    :param buffer: array of bytes of the file (see _buffer)
+    :return: dict - 'xdim' (px), 'ydim' (rows), 'n_frames', 'dtype', 'version', 'frame_stride' (bytes between two
+    frames) and 'wavelength' (array [nm], None if the file is not calibrated)
+    """
+    header = bytes(buffer[:SPE_HEADER_SIZE])
+    if len(header) < SPE_HEADER_SIZE:
+        raise ValueError('Not a SPE file: the header is incomplete')
+    xdim, = struct.unpack_from('<H', header, 42)
+    datatype, = struct.unpack_from('<h', header, 108)
+    ydim, = struct.unpack_from('<H', header, 656)
+    n_frames, = struct.unpack_from('<i', header, 1446)
+    version, = struct.unpack_from('<f', header, 1992)
+    if datatype not in SPE_DTYPES:
+        raise ValueError('Unknown data type %d in the SPE header' % datatype)
+    dtype = np.dtype(SPE_DTYPES[datatype]).newbyteorder('<')
+    frame_stride = xdim * ydim * dtype.itemsize
+
+    wavelength = None
+    if version >= 3:
+        # LightField: the calibration and the layout of the frames (with their metadata) are in the XML footer
+        xml_offset, = struct.unpack_from('<Q', header, 678)
+        xml = bytes(buffer[xml_offset:]).decode('utf-8', errors='replace')
+        stride = re.search(r'<DataBlock[^>]*type="Frame"[^>]*stride="(\d+)"', xml)
+        if stride is not None:
+            frame_stride = int(stride.group(1))
+        calibration = re.search(r'<Wavelength[^>]*>([^<]+)</Wavelength>', xml)
+        if calibration is not None:
+            wavelength = np.array(calibration.group(1).split(','), dtype=float)
+    else:
+        # Winspec: polynomial of the pixel number (from 1)
+        order = header[3101]
+        coefficients = struct.unpack_from('<6d', header, 3263)
+        if 0 < order < 6 and any(coefficients):
+            px = np.arange(1, xdim + 1)
+            wavelength = np.polynomial.polynomial.polyval(px, coefficients[:order + 1])
+
+    return {'xdim': xdim, 'ydim': ydim, 'n_frames': n_frames, 'dtype': dtype, 'version': version,
+            'frame_stride': frame_stride, 'wavelength': wavelength}
+
+
+def open_spe(source):
+    """
+    :param source: str (path) or uploaded .spe file
+    :return: dict, array - header and read-only view of the frames (n_frames, ydim, xdim), nothing is copied
+    """
+    buffer = _buffer(source)
+    header = read_spe_header(buffer)
+    n_bytes = header['xdim'] * header['ydim'] * header['dtype'].itemsize
+    n_frames = min(header['n_frames'], (len(buffer) - SPE_HEADER_SIZE) // header['frame_stride'])
+    data = buffer[SPE_HEADER_SIZE:SPE_HEADER_SIZE + n_frames * header['frame_stride']]
+    # The metadata of each frame (after n_bytes) is skipped by the slice, the view keeps the frames in place
+    frames = data.reshape(n_frames, header['frame_stride'])[:, :n_bytes].view(header['dtype'])
+    return header, frames.reshape(n_frames, header['ydim'], header['xdim'])
+
+
+def get_spe_spectra(source, rows=None, columns=None, frames=None, binning=True, block_frames=256):
+    """
+    :param source: str (path) or uploaded .spe file
+    :param rows: tuple - (first, last + 1) rows of the ROI, all the rows by default
+    :param columns: tuple - (first, last + 1) columns (pixels) of the ROI, all by default
+    :param frames: tuple - (first, last + 1) frames, all by default
+    :param binning: bool - sum the rows of the ROI (vertical binning)
+    :param block_frames: int - number of frames read at once for the binning
+    :return: array, array - spectra (n_frames, n_px) if binning else frames (n_frames, n_rows, n_px) as float, and
+    the wavelength of the pixels [nm] (None if the file is not calibrated)
+    """
+    header, data = open_spe(source)
+    rows, columns, frames = slice(*(rows or (None,))), slice(*(columns or (None,))), slice(*(frames or (None,)))
+    roi = data[frames, rows, columns]
+    wavelength = header['wavelength'][columns] if header['wavelength'] is not None else None
+    if not binning:
+        return roi.astype(float), wavelength
+
+    spectra = np.empty((roi.shape[0], roi.shape[2]))
+    for start in range(0, len(roi), block_frames):
+        spectra[start:start + block_frames] = roi[start:start + block_frames].sum(axis=1, dtype=float)
+    return spectra, wavelength
+
+
+@cached('spe_spectra')
+def get_spe_fromfile(streamlit_file, rows=None, columns=None, frames=None, binning=True):
+    # file is a file that has been uploaded using streamlit
+    return get_spe_spectra(streamlit_file, rows=rows, columns=columns, frames=frames, binning=binning)
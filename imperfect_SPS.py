@@ -3,6 +3,9 @@
 @Authors: Mathias Pont
 """
 
+import hashlib
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -14,6 +17,12 @@ import perceval as pcvl
 
 import streamlit as st
 
+from job_queue import submit, show_progress
+from result_cache import cached, ResultCache, input_hash, code_version
+from uncertainty import iter_tasks
+from profiling import stage, timed
+from mzi_model import hom_visibility, mzi_fock_outcomes, state_composition, FOCK_OUTCOMES, COMPONENTS
+
 
 class QPU:
 
@@ -38,45 +47,38 @@ class QPU:
         # Internal phase set to pi/2
         self.phase_shifters[1].set_value(np.pi / 2)
 
+    def __repr__(self):
+        # All the QPUs are the same MZI whose phases are set by the simulations: they share the cached results.
+        return "QPU(Naive, MZI)"
 
-# mzi_BasicState computes the output state distribution of any input Fock state.
+
+# mzi_PhotonNumberTomography computes the distribution of the number of photons in each output of the MZI.
+@cached('mzi_PhotonNumberTomography')
 def mzi_PhotonNumberTomography(scan_range=np.arange(0, 2 * np.pi, 0.1),
                                eta=0.05,
                                g2=0,
                                M=1,
-                               multiphoton_model="distinguishable"):
-    qpu = QPU()
-
-    sps = pcvl.Source(losses=(1-eta),
-                      multiphoton_component=g2,
-                      multiphoton_model=multiphoton_model,
-                      indistinguishability=M,
-                      )
-
-    outcome_theta = {}
-
-    for theta in scan_range:
-        outcome = []
-        output_prob = dict()
-
-        qpu.phase_shifters[0].set_value(0)
-        qpu.phase_shifters[1].set_value(theta)
-        p = pcvl.Processor({0: sps, 1: sps, }, qpu.mzi_circuit)
-        all_p, sv_out = p.run(qpu.simulator_backend)
-
-        for output_state in sv_out:
-
-            if str(output_state) not in outcome:
-                outcome.append(str(output_state))
+                               multiphoton_model="distinguishable",
+                               beta=1,
+                               job=None):
+    """
+    The state of the sources does not depend on the phase: mzi_model computes it once and only the unitary of the MZI
+    is computed for each phase of scan_range, all at once.
 
-            if output_state in output_prob:
-                output_prob[str(output_state)] += sv_out[output_state]
-            else:
-                output_prob[str(output_state)] = sv_out[output_state]
+    :param job: Job - optional, given when the scan is run in the background by job_queue
+    :return: array, list, array - scan_range, the outcomes that occur and their probabilities (n_phase, n_outcomes)
+    """
+    probabilities = mzi_fock_outcomes(beta, eta, g2, M, phase=np.asarray(scan_range, dtype=float),
+                                      multiphoton_model=multiphoton_model)
+    probabilities = np.atleast_2d(probabilities)
+    # Outcomes that never occur (e.g. 3 and 4 photons without multiphoton component) are not plotted
+    occurs = probabilities.max(axis=0) > 1e-12
+    outcome = [state for state, kept in zip(FOCK_OUTCOMES, occurs) if kept]
 
-        outcome_theta[theta] = output_prob
+    if job is not None:
+        job.set_progress(1.)
 
-    return scan_range, outcome, outcome_theta
+    return scan_range, outcome, probabilities[:, occurs]
 
 
 def plot_PhotonNumberTomography(projection='2D',
@@ -84,10 +86,13 @@ def plot_PhotonNumberTomography(projection='2D',
                                 beta=1, eta=0.05,
                                 g2=0, M=1,
                                 multiphoton_model="distinguishable"):
-    scan_range, outcome, outcome_theta = mzi_PhotonNumberTomography(scan_range,
-                                                                    beta, eta,
-                                                                    g2, M,
-                                                                    multiphoton_model)
+    job = submit(mzi_PhotonNumberTomography, scan_range, eta=eta, g2=g2, M=M, multiphoton_model=multiphoton_model,
+                 beta=beta)
+    with stage('tomography'):
+        tomography = show_progress(job, 'Scanning the phase of the MZI...')
+    if tomography is None:
+        return
+    scan_range, outcome, probabilities = tomography
 
     # 2D plot
     if projection == '2D':
@@ -95,14 +100,12 @@ def plot_PhotonNumberTomography(projection='2D',
             plot_bgcolor='whitesmoke'
         )
         fig = go.Figure(layout=layout)
-        for measured_state in outcome:
-            X = list(outcome_theta.keys())
-            Y = [outcome_theta[angle][measured_state] for angle in outcome_theta.keys()]
+        for i, measured_state in enumerate(outcome):
             fig.add_trace(go.Scatter(
-                x=X,
-                y=Y,
+                x=scan_range,
+                y=probabilities[:, i],
+                mode='lines',
                 line=dict(width=3),
-                marker=dict(size=10),
                 name=str(measured_state)
             ))
 
@@ -119,7 +122,8 @@ def plot_PhotonNumberTomography(projection='2D',
         fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
         fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
 
-        st.plotly_chart(fig)
+        with stage('plot'):
+            st.plotly_chart(fig)
 
     # 3D plot
     if projection == '3D':
@@ -129,13 +133,13 @@ def plot_PhotonNumberTomography(projection='2D',
         verts = []
         ys = np.linspace(0, 1, len(outcome))
         facecolors = sns.color_palette()
-        for measured_state in outcome:
-            verts.append(list(zip(xs, [outcome_theta[angle][measured_state] for angle in outcome_theta.keys()])))
+        for i, measured_state in enumerate(outcome):
+            verts.append(list(zip(xs, probabilities[:, i])))
         poly = PolyCollection(verts, facecolors=facecolors)
         for i, measured_state in enumerate(outcome):
             ax.scatter(scan_range,
                        ys[i],
-                       [outcome_theta[angle][measured_state] for angle in outcome_theta.keys()],
+                       probabilities[:, i],
                        color=facecolors[i % 10])
 
         ax.set_xlim3d(0, 2 * np.pi)
@@ -150,7 +154,8 @@ def plot_PhotonNumberTomography(projection='2D',
 
         ax.tick_params(direction='in', bottom=True, top=True, left=True, right=True, labelsize=20)
 
-        st.pyplot(fig)
+        with stage('plot'):
+            st.pyplot(fig)
 
 
 def outputstate_to_2outcome(output):
@@ -175,6 +180,7 @@ def outputstate_to_2outcome(output):
 def phase_to_balance(phase):
     return np.sin(phase / 2) ** 2
 
+@cached('perceval_visibility')
 def compute(qpu, beta, eta, g2, M, phase_mzi=np.pi/2, multiphoton_model="distinguishable"):
     # Find out all the input states that must be considered depending on the characteristics of the source
     sps = pcvl.Source(brightness=beta,
@@ -226,27 +232,162 @@ def compute(qpu, beta, eta, g2, M, phase_mzi=np.pi/2, multiphoton_model="disting
     return 1 - 2 * p_corr / p_uncorr
 
 
-def probability_distribution(beta, eta, g2, M):
+# Memo of the Perceval points of the sweeps, shared by all the sweeps: a point (beta, eta, g2, M, phase, multiphoton
+# model) is simulated once, then read from the memo whatever the range of the next sweeps.
+# - memory: LRU of the last 4096 points, shared by all sessions of the server.
+# - disk (optional): pickles in FITMYDATA_SWEEP_DIR (max 50 MB), kept from one server to the next. The pickles are
+#   loaded as they are: the directory must only be writable by the user running the app.
+_sweep_memo = ResultCache(max_entries=4096, disk_dir=os.environ.get('FITMYDATA_SWEEP_DIR'), max_disk_bytes=50e6)
+
+
+def visibility_point(beta, eta, g2, M, phase_mzi=np.pi/2, multiphoton_model="distinguishable"):
+    # V_HOM of one point of a sweep, simulated with Perceval in a worker of the process pool
+    return compute(QPU(), beta, eta, g2, M, phase_mzi, multiphoton_model)
+
 
-    distinguishability = 1 - np.sqrt(M)
-    X = np.array(np.linspace(0.0, 1, 15))
-    Y = []
+def _point_key(point):
+    # Key of a point in the memo, invalidated by any change of this module or of the modules it imports
+    return hashlib.sha256(('visibility_point:' + code_version(visibility_point) + ':' +
+                           input_hash(*point)).encode()).hexdigest()
 
-    for eta in X:
-        p2 = min(np.poly1d([g2, -2 * (1 - g2 * beta), g2 * beta ** 2]).r)
-        p1 = beta - p2
 
-        zero = 1-(eta*p1+eta**2*p2+2*eta*(1-eta)*p2)
-        one_onebar = eta ** 2 * (1 - distinguishability) * p2
-        onetilde_onebar = eta ** 2 * distinguishability * p2
-        onetilde = eta * distinguishability * p1 + eta * (1 - eta) * distinguishability * p2
-        one = eta * (1 - distinguishability) * p1 + eta * (1 - eta) * (1 - distinguishability) * p2
-        onebar = eta * (1 - eta) * p2
+def sweep_visibility(x_axis, X, beta, eta, g2, M, multiphoton_model="distinguishable", job=None):
+    """
+    The points already in the memo are read from it, the others are simulated in parallel in the process pool (each
+    distinct point once). The values are reported to the job as they come (job.partial), NaN for the missing ones.
+
+    :param x_axis: str - 'eta', 'beta', 'g2' or 'R' (phase of the MZI), the parameter that is scanned
+    :param X: list - values of the scanned parameter
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: array - V_HOM for each value of X
+    """
+    source = {'beta': beta, 'eta': eta, 'g2': g2, 'M': M}
+    points = []
+    for x in X:
+        if x_axis == 'R':
+            point = {**source, 'phase_mzi': float(x)}
+        else:
+            point = {**source, x_axis: float(x), 'phase_mzi': np.pi / 2}
+        points.append((point['beta'], point['eta'], point['g2'], point['M'], point['phase_mzi'], multiphoton_model))
+
+    V = np.full(len(points), np.nan)
+    # key of each missing point: indices of the sweep where it appears
+    missing = {}
+    for i, point in enumerate(points):
+        hit, value = _sweep_memo.get(_point_key(point), 'visibility_point')
+        if hit:
+            V[i] = value
+        else:
+            missing.setdefault(_point_key(point), []).append(i)
+    if job is not None:
+        job.set_progress(1 - len(missing) / max(len(points), 1), partial=V.copy())
+
+    keys = list(missing)
+    tasks = [points[missing[key][0]] for key in keys]
+    results = iter_tasks(visibility_point, tasks)
+    try:
+        for n_done, (k, value) in enumerate(results, 1):
+            _sweep_memo.put(keys[k], value)
+            V[missing[keys[k]]] = value
+            if job is not None:
+                job.set_progress(1 - (len(keys) - n_done) / len(points), partial=V.copy())
+    finally:
+        # a cancelled sweep cancels the points that are not simulated yet
+        results.close()
+
+    return V
+
+
+# Components of probability_distribution, relative to |1>
+DISTRIBUTION_COMPONENTS = ('|0>', '|1b>', '|1,1b>', '|1~>', '|1~,1b>')
+
+
+def relative_composition(beta, eta, g2, M):
+    """
+    :param beta, eta, g2, M: float or array - broadcast together, e.g. eta[:, None] and g2[None, :] for a map
+    :return: array (..., 5) - probabilities of DISTRIBUTION_COMPONENTS relative to the probability of |1>
+    """
+    composition = state_composition(beta, eta, g2, M)
+    columns = [COMPONENTS.index(name) for name in DISTRIBUTION_COMPONENTS]
+    # inf where no photon reaches the output (eta = 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return composition[..., columns] / composition[..., COMPONENTS.index('|1>'), np.newaxis]
 
-        Y.append([zero / one, onebar / one, one_onebar / one, onetilde / one, onetilde_onebar / one])
 
-    return X, Y
+@timed('probability_distribution')
+@cached('probability_distribution')
+def probability_distribution(beta, eta, g2, M, n_points=101):
+    # eta is scanned from 0 to 1: the value of the slider is not used
+    X = np.linspace(0.0, 1, n_points)
+    return X, relative_composition(beta, X, g2, M)
+
+
+def plot_interference(x_axis, X_model, V_model, X, V, g2, M):
+    """
+    :param X_model, V_model: array - V_HOM of the closed-form model (mzi_model)
+    :param X, V: array - points simulated with Perceval, V is None if there are none (NaN for the missing points)
+    :return: plotly figure - V_HOM vs the scanned parameter (balance of the MZI for 'R')
+    """
+    layout = Layout(
+        plot_bgcolor='whitesmoke'
+    )
+    fig = go.Figure(layout=layout)
+
+    fig.add_trace(go.Scatter(
+        x=X_model,
+        y=V_model,
+        line=dict(width=3),
+        name='Model'
+    ))
+
+    if V is not None:
+        fig.add_trace(go.Scatter(
+            x=X,
+            y=V,
+            mode='markers',
+            marker=dict(size=10),
+            name='Perceval'
+        ))
+
+    if x_axis == 'R':
+        fig.add_trace(go.Scatter(
+            x=X,
+            y=4*X*(1-X)*(1+M-(M+1)*g2)-1,
+            line=dict(width=3),
+            name='4RT*(1+M-(M+1)*g2)-1'
+        ))
+
+    if x_axis == 'g2':
+        fig.add_trace(go.Scatter(
+            x=X,
+            y=(M - X),
+            line=dict(width=3),
+            marker=None,
+            name='M-g2'
+        ))
+    if x_axis == 'g2':
+        fig.add_trace(go.Scatter(
+            x=X,
+            y=M - (1 + M) * X,
+            line=dict(width=3),
+            marker=None,
+            name='M-(1+M)*g2'
+        ))
+
+    fig.update_layout(width=900, height=600,
+                      margin=dict(l=40, r=40, b=40, t=40),
+                      xaxis_title=x_axis,
+                      yaxis_title='V_HOM',
+                      font=dict(
+                          family="Courier New, monospace",
+                          size=18,
+                          color="White"
+                      )
+                      )
+    fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
+    fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
 
+    return fig
 
 
 def main():
@@ -263,13 +404,14 @@ def main():
             M = st.slider("Indistinguishability", min_value=0.0, max_value=1.0, value=1.0)
             multiphoton_model = st.selectbox('Multiphoton model', ("distinguishable", "indistinguishable"))
 
-        scan_range = np.arange(start_stop[0], start_stop[1], 0.1)
+        # The whole scan is computed at once: a fine step costs nothing
+        scan_range = np.arange(start_stop[0], start_stop[1], 0.01)
 
         plot_PhotonNumberTomography(projection,
                                     scan_range,
-                                    beta, eta,
-                                    g2, M,
-                                    multiphoton_model)
+                                    eta=eta,
+                                    g2=g2, M=M,
+                                    multiphoton_model=multiphoton_model)
 
     if tab == "2-photon interference":
         st.subheader("2-photon interference")
@@ -291,75 +433,38 @@ def main():
             multiphoton_model = st.selectbox('Multiphoton model', ("distinguishable", "indistinguishable"),
                                              key='model_interfences')
 
-        qpunit = QPU()
+            check = st.checkbox('Check against Perceval', value=False, key='check_interfences')
 
-        X = np.linspace(start_stop[0], start_stop[1], 15)
-
-        # V_HOM vs g2
-        if x_axis == 'g2':
-            V = [compute(qpunit, beta, eta, g2, M, phase_mzi=np.pi/2, multiphoton_model=multiphoton_model) for g2 in X]
-        if x_axis == 'eta':
-            V = [compute(qpunit, beta, eta, g2, M, phase_mzi=np.pi/2, multiphoton_model=multiphoton_model) for eta in X]
-        if x_axis == 'beta':
-            V = [compute(qpunit, beta, eta, g2, M, phase_mzi=np.pi/2, multiphoton_model=multiphoton_model) for beta in X]
+        # Closed-form model (mzi_model): the whole curve at once
+        X_model = np.linspace(start_stop[0], start_stop[1], 10000)
+        source = {'beta': beta, 'eta': eta, 'g2': g2, 'M': M}
         if x_axis == 'R':
-            V = [compute(qpunit, beta, eta, g2, M, phase_mzi=R, multiphoton_model=multiphoton_model) for R in X]
-            X = np.array([phase_to_balance(teta) for teta in X])
-
-        # Plot V_HOM vs g2
-
-        layout = Layout(
-            plot_bgcolor='whitesmoke'
-        )
-        fig = go.Figure(layout=layout)
-
-        fig.add_trace(go.Scatter(
-            x=X,
-            y=V,
-            line=dict(width=3),
-            marker=dict(size=10),
-            name='Simulation'
-        ))
+            V_model = hom_visibility(phase=X_model, multiphoton_model=multiphoton_model, **source)
+        else:
+            V_model = hom_visibility(phase=np.pi / 2, multiphoton_model=multiphoton_model,
+                                     **{**source, x_axis: X_model})
 
+        X = np.linspace(start_stop[0], start_stop[1], 15)
+        X_plot = phase_to_balance(X) if x_axis == 'R' else X
         if x_axis == 'R':
-            fig.add_trace(go.Scatter(
-                x=X,
-                y=4*X*(1-X)*(1+M-(M+1)*g2)-1,
-                line=dict(width=3),
-                name='4RT*(1+M-(M+1)*g2)-1'
-            ))
+            X_model = phase_to_balance(X_model)
 
-        if x_axis == 'g2':
-            fig.add_trace(go.Scatter(
-                x=X,
-                y=(M - X),
-                line=dict(width=3),
-                marker=None,
-                name='M-g2'
-            ))
-        if x_axis == 'g2':
-            fig.add_trace(go.Scatter(
-                x=X,
-                y=M - (1 + M) * X,
-                line=dict(width=3),
-                marker=None,
-                name='M-(1+M)*g2'
-            ))
+        # The Perceval points are drawn as they come
+        chart = st.empty()
 
-        fig.update_layout(width=900, height=600,
-                          margin=dict(l=40, r=40, b=40, t=40),
-                          xaxis_title=x_axis,
-                          yaxis_title='V_HOM',
-                          font=dict(
-                              family="Courier New, monospace",
-                              size=18,
-                              color="White"
-                          )
-                          )
-        fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
-        fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
+        def draw(V):
+            with stage('plot'):
+                chart.plotly_chart(plot_interference(x_axis, X_model, V_model, X_plot, V, g2, M))
 
-        st.plotly_chart(fig)
+        draw(None)
+        if check:
+            # The Perceval simulations run in the background: changing an unrelated widget attaches to the running sweep.
+            # The points simulated before, by any sweep, are read from the memo of sweep_visibility.
+            job = submit(sweep_visibility, x_axis, X, beta, eta, g2, M, multiphoton_model=multiphoton_model)
+            with stage('perceval'):
+                V = show_progress(job, 'Simulating the 2-photon interference...', on_update=draw)
+            if V is not None:
+                draw(V)
 
     if tab == "Probability distribution":
 
@@ -368,37 +473,60 @@ def main():
             g2 = st.slider("g2", min_value=0.0, max_value=0.5, value=0.02, key='g2_pro')
             eta = st.slider("Overall transmission", min_value=0.0, max_value=1.0, value=0.05, key='eta_pro')
             M = st.slider("Indistinguishability", min_value=0.0, max_value=1.0, value=1.0, key='M_pro')
+            view = st.selectbox('View', ('vs eta', 'Map vs eta and g2'), key='view_pro')
 
-        X, Y = probability_distribution(beta, eta, g2, M)
-
-        # Plot V_HOM vs g2
         label = [r'$|0>$', r'$|\bar{1}>$', r'$|1,\bar{1}>$', r'$|\tilde{1}>$', r'$|\tilde{1},\bar{1}>$']
-        layout = Layout(
-            plot_bgcolor='whitesmoke'
-        )
-        fig = go.Figure(layout=layout)
-        for idx in range(5):
-            fig.add_trace(go.Scatter(
-                x=X,
-                y=[Y[i][idx] for i in range(len(Y))],
-                line=dict(width=2),
-                marker=dict(size=12),
-                name=label[idx]
-            ))
-        fig.update_layout(width=900, height=600,
-                          margin=dict(l=40, r=40, b=40, t=40),
-                          xaxis_title='eta',
-                          yaxis_title='V_HOM',
-                          font=dict(
-                              family="Courier New, monospace",
-                              size=18,
-                              color="White"
-                          )
-                          )
-        fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
-        fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
 
-        st.plotly_chart(fig)
+        if view == 'Map vs eta and g2':
+            component = st.sidebar.selectbox('Component', DISTRIBUTION_COMPONENTS, index=1, key='component_pro')
+            # The whole map is one call of relative_composition
+            eta_grid = np.linspace(0.01, 1, 200)
+            g2_grid = np.linspace(0, 0.5, 200)
+            Z = relative_composition(beta, eta_grid[:, np.newaxis], g2_grid[np.newaxis, :], M)
+            fig = go.Figure(go.Heatmap(x=g2_grid, y=eta_grid, z=Z[..., DISTRIBUTION_COMPONENTS.index(component)],
+                                       colorbar=dict(title='P / P(|1>)')))
+            fig.update_layout(width=900, height=600,
+                              margin=dict(l=40, r=40, b=40, t=40),
+                              xaxis_title='g2',
+                              yaxis_title='eta',
+                              font=dict(
+                                  family="Courier New, monospace",
+                                  size=18,
+                                  color="White"
+                              )
+                              )
+            with stage('plot'):
+                st.plotly_chart(fig)
+        else:
+            X, Y = probability_distribution(beta, eta, g2, M)
+
+            # Plot the components vs eta
+            layout = Layout(
+                plot_bgcolor='whitesmoke'
+            )
+            fig = go.Figure(layout=layout)
+            for idx in range(5):
+                fig.add_trace(go.Scatter(
+                    x=X,
+                    y=Y[:, idx],
+                    line=dict(width=2),
+                    name=label[idx]
+                ))
+            fig.update_layout(width=900, height=600,
+                              margin=dict(l=40, r=40, b=40, t=40),
+                              xaxis_title='eta',
+                              yaxis_title='P / P(|1>)',
+                              font=dict(
+                                  family="Courier New, monospace",
+                                  size=18,
+                                  color="White"
+                              )
+                              )
+            fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
+            fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='dimgrey')
+
+            with stage('plot'):
+                st.plotly_chart(fig)
 
 
 
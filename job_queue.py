@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Background jobs for the long computations of the app (PTU correlations, bootstrap errors, Perceval sweeps).
+
+Streamlit reruns the whole script at every widget change. Heavy functions are therefore not called directly by
+the pages but submitted to a worker pool shared by all the sessions of the server:
+- a job is identified by the function and a hash of its inputs. Submitting the same computation again (a rerun,
+  another user) attaches to the job that is already running or returns its result if it is finished.
+- the function receives a `job` keyword argument. It reports its progress with job.set_progress(fraction) and
+  calls job.check_cancelled() regularly so that it can be stopped from the page.
+- show_progress(job) displays a progress bar and a cancel button in the page and returns the result. The sessions
+  waiting for a job are its subscribers: the cancel button detaches the session, and the computation is only
+  stopped when the last of them cancels.
+
+Example:
+    job = submit(poisson_error, get_g2_1input, data, peak_width, peak_sep, central_peak, num_peaks)
+    errg2 = show_progress(job, 'Computing the error on g2')
+
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from result_cache import input_hash
+
+# Number of finished jobs whose results are kept in memory
+MAX_FINISHED_JOBS = 64
+
+# Threads rather than processes: numpy, lmfit and readPTU release the GIL in their heavy parts and the jobs
+# can share their progress and cancel flag with the page without any serialisation.
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='fitmydata_job')
+_jobs = OrderedDict()
+_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, key, fn, args, kwargs):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.progress = 0.
+        self.message = ''
+        self.partial = None
+        self.future = None
+        self._cancel_event = threading.Event()
+        # Ids of the sessions waiting for the result
+        self._subscribers = set()
+
+    def set_progress(self, fraction, message='', partial=None):
+        # Called by the job. fraction goes from 0 to 1. partial: optional result so far, displayed by show_progress.
+        self.progress = min(max(float(fraction), 0.), 1.)
+        self.message = message
+        if partial is not None:
+            self.partial = partial
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        # Called by the job at safe points: stops the computation if the user asked for it.
+        if self._cancel_event.is_set():
+            raise JobCancelled(self.key)
+
+    def cancel(self):
+        self._cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def subscribe(self, session):
+        with _lock:
+            self._subscribers.add(session)
+
+    def unsubscribe(self, session):
+        # The session stops waiting for the job. The computation is cancelled when no session waits for it anymore.
+        with _lock:
+            self._subscribers.discard(session)
+            last = not self._subscribers
+        if last:
+            self.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def failed(self):
+        return self.done() and not self.future.cancelled() and self.future.exception() is not None
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def _run(self):
+        self.check_cancelled()
+        result = self.fn(*self.args, job=self, **self.kwargs)
+        self.progress = 1.
+        return result
+
+
+def _forget_old_jobs():
+    # Drop the oldest finished jobs. Called with the lock held.
+    finished = [key for key, job in _jobs.items() if job.done()]
+    for key in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+        del _jobs[key]
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Submit fn(*args, job=job, **kwargs) to the shared worker pool.
+
+    :return: Job - the job of an identical computation if there is one that is running, finished or was cancelled
+    (call restart() to run a cancelled or failed job again).
+    """
+    key = fn.__module__ + '.' + fn.__qualname__ + ':' + input_hash(*args, **kwargs)
+    with _lock:
+        if key in _jobs:
+            _jobs.move_to_end(key)
+            return _jobs[key]
+        job = Job(key, fn, args, kwargs)
+        job.future = _executor.submit(job._run)
+        _jobs[key] = job
+        _forget_old_jobs()
+    return job
+
+
+def restart(job):
+    with _lock:
+        _jobs.pop(job.key, None)
+    return submit(job.fn, *job.args, **job.kwargs)
+
+
+def _session_id():
+    # Id of the streamlit session running the page
+    if '_job_session' not in st.session_state:
+        st.session_state['_job_session'] = uuid.uuid4().hex
+    return st.session_state['_job_session']
+
+
+def show_progress(job, label='Computing...', poll_interval=0.1, on_update=None):
+    """
+    Display the progress of a job in the page until it is finished.
+
+    :param job: Job - returned by submit
+    :param label: str - displayed above the progress bar
+    :param on_update: function - optional, called with job.partial each time the job reports a new partial result
+    (e.g. to draw the points of a sweep as they come)
+    :return: the result of the job, None if it has been cancelled (by this session) or has failed
+    """
+    session = _session_id()
+    # Keys of the jobs cancelled by this session, which may still run for other sessions
+    cancelled_here = st.session_state.setdefault('_cancelled_jobs', set())
+    if not job.done() and job.key not in cancelled_here:
+        job.subscribe(session)
+        # A click on the button reruns the script: the job keeps running in the pool and is cancelled on the rerun.
+        if st.button('Cancel', key='cancel_' + job.key):
+            cancelled_here.add(job.key)
+            job.unsubscribe(session)
+
+    if job.key in cancelled_here or job.cancelled:
+        st.warning(label + ' cancelled.')
+        if st.button('Restart', key='restart_' + job.key):
+            cancelled_here.discard(job.key)
+            # Still running for other sessions: wait for it again
+            job = restart(job) if job.cancelled else job
+            job.subscribe(session)
+        else:
+            return None
+
+    # A failed job stays in the pool (same inputs, same error): it is only run again from the Restart button.
+    restart_shown = job.failed()
+    if restart_shown:
+        st.error(f'{label} failed: {job.future.exception()!r}')
+        if st.button('Restart', key='restart_failed_' + job.key):
+            job = restart(job)
+            job.subscribe(session)
+        else:
+            return None
+
+    if not job.done():
+        caption = st.empty()
+        bar = st.progress(0)
+        shown = None
+        while not job.done():
+            caption.text(label + ' ' + job.message)
+            bar.progress(int(100 * job.progress))
+            if on_update is not None and job.partial is not None and job.partial is not shown:
+                shown = job.partial
+                on_update(shown)
+            time.sleep(poll_interval)
+        caption.empty()
+        bar.empty()
+
+    if job.future.cancelled() or isinstance(job.future.exception(), JobCancelled):
+        st.warning(label + ' cancelled.')
+        return None
+
+    if job.failed():
+        st.error(f'{label} failed: {job.future.exception()!r}')
+        if not restart_shown:
+            # The click reruns the script, which restarts the job above
+            st.button('Restart', key='restart_failed_' + job.key)
+        return None
+
+    return job.result()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Functions to fit lifetime histograms that are not much longer than the instrument response (IRF).
+
+The measured histogram is (decay ⊗ IRF)(t) + background. The decay model is evaluated on the time bins of the fit
+window and convolved with the measured IRF by FFT at each iteration of the fit: the fit can start before the rise
+of the signal instead of after first_peak + 10 ps.
+
+Decay models (the decay starts at t = 0, when the laser pulse arrives):
+- 'multi-exponential': sum of A_i * exp(-t/tau_i)
+- 'exciton beat': A * sin²(w*t + phi) * exp(-t/tau)
+
+A histogram of a few µs contains one decay per laser pulse. fold_periods sums all of them into a single decay
+with the statistics of the whole acquisition.
+
+fit_global fits a stack of decays (power or temperature series) at once, some parameters (lifetime, FSS) being
+shared by all the decays.
+
+"""
+
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import sparse
+from scipy.optimize import least_squares
+from lmfit import Parameters, minimize
+
+from result_cache import cached
+from profiling import timed
+
+
+class IRFConvolution:
+    """
+    Convolution with a measured IRF. The FFT of the IRF is computed once for all the iterations of a fit.
+
+    :param irf: array - IRF histogram, on the same time bins as the data
+    :param n: int - number of bins of the decay models
+    """
+
+    def __init__(self, irf, n):
+        irf = np.asarray(irf, dtype=float)
+        # Background of the IRF (dark counts) removed, area normalised to 1: the amplitudes of the model are the
+        # amplitudes of the decay.
+        irf = np.clip(irf - np.median(irf), 0, None)
+        if irf.sum() == 0:
+            raise ValueError('The IRF is empty')
+        irf = irf / irf.sum()
+
+        self.n = n
+        # Zero padding: linear convolution instead of circular, on a size with small prime factors
+        self.n_fft = sp_fft.next_fast_len(n + len(irf) - 1, real=True)
+        self.irf_fft = sp_fft.rfft(irf, self.n_fft)
+        # Frequencies in cycles per bin, for the sub-bin shifts of the IRF
+        self.phase = -2j * np.pi * np.fft.rfftfreq(self.n_fft)
+
+    def __call__(self, decay, shift=0.):
+        """
+        :param decay: array - decay model on the n bins of the window
+        :param shift: float - delay of the IRF [bins], can be a fraction of a bin
+        :return: array - decay ⊗ IRF on the n bins of the window
+        """
+        spectrum = sp_fft.rfft(decay, self.n_fft) * self.irf_fft
+        if shift:
+            spectrum = spectrum * np.exp(self.phase * shift)
+        return sp_fft.irfft(spectrum, self.n_fft)[:self.n]
+
+
+def decay_model(params, t, model='multi-exponential', n_exp=1):
+    """
+    :param params: lmfit Parameters
+    :param t: array - time from the excitation [ns]
+    :return: array - decay before the convolution with the IRF
+    """
+    if model == 'exciton beat':
+        return params['A'].value * np.sin(params['w'].value*t + params['phi'].value)**2 * \
+               np.exp(-t / params['tau'].value)
+    decay = np.zeros_like(t)
+    for i in range(1, n_exp + 1):
+        decay += params['A%d' % i].value * np.exp(-t / params['tau%d' % i].value)
+    return decay
+
+
+def guess_decay(data_fit, x_axis):
+    """
+    Closed-form initial guess: linear fit of log(counts - background) vs time, weighted by the counts.
+
+    :return: float, float - height [counts] and lifetime [ns] at the beginning of the window
+    """
+    background = np.min(data_fit)
+    signal = data_fit - background
+    # Bins close to the background only add noise to the log
+    keep = signal > 0.05 * np.max(signal)
+    if np.count_nonzero(keep) < 2:
+        return float(np.max(data_fit)), 0.145
+    slope, intercept = np.polyfit(x_axis[keep], np.log(signal[keep]), 1, w=np.sqrt(signal[keep]))
+    tau = -1 / slope if slope < 0 else 0.145
+    return float(np.exp(intercept)), float(tau)
+
+
+def detect_period(peaks):
+    """
+    Repetition period of the laser from the positions of the peaks, some of them may be missing.
+
+    :param peaks: array - index of the laser peaks in the histogram
+    :return: float, float, int - period [bins] and position of the first peak [bins], from a linear fit of the
+    positions, and number of pulses from the first to the last peak
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    if len(peaks) < 2:
+        raise ValueError('At least two laser peaks are needed to find the period')
+    # Number of the pulse of each peak
+    pulse = np.round((peaks - peaks[0]) / np.median(np.diff(peaks)))
+    period, first = np.polyfit(pulse, peaks, 1)
+    return float(period), float(first), int(pulse[-1]) + 1
+
+
+@timed('fold_periods')
+def fold_periods(data, period, first_peak=None, n_periods=None, pre=None, offsets=None):
+    """
+    Sum all the laser periods of a histogram into one decay.
+
+    :param data: array - lifetime histogram
+    :param period: float - repetition period [bins], does not have to be an integer
+    :param first_peak: float - position of the first laser peak [bins], not used if offsets is given
+    :param n_periods: int - number of pulses after first_peak, by default all the periods of the histogram (the
+    end of a histogram can be empty when its range is longer than the sync period)
+    :param pre: int - number of bins kept before each peak, 10 % of the period by default
+    :param offsets: array - first bin of each period, to fold another histogram (the IRF) exactly as a previous one
+    (its info['offsets'])
+    :return: array, dict - folded decay (the peak is at index pre) and
+    {'period', 'n_periods', 'offsets': first bin of each period, 'amplitudes': counts in each period,
+     'spread': std/mean of the amplitudes, 'poisson_spread': spread expected from the shot noise only}
+    """
+    data = np.asarray(data)
+    length = int(np.floor(period))
+    if offsets is not None:
+        offsets = np.asarray(offsets, dtype=int)
+        if offsets[0] < 0 or offsets[-1] + length > len(data):
+            raise ValueError('The periods are not all in the histogram')
+    else:
+        if pre is None:
+            pre = length // 10
+        # Periods that are entirely in the histogram
+        k_first = max(int(np.ceil((pre - first_peak) / period)), 0)
+        k_last = int(np.floor((len(data) - length + pre - first_peak) / period))
+        if n_periods is not None:
+            k_last = min(k_last, n_periods - 1)
+        if k_last < k_first:
+            raise ValueError('The histogram is shorter than one period')
+        offsets = np.round(first_peak - pre + period * np.arange(k_first, k_last + 1)).astype(int)
+
+    if period == length:
+        # Integer period: the periods are rows of a view of the histogram
+        frames = data[offsets[0]:offsets[0] + len(offsets) * length].reshape(len(offsets), length)
+    else:
+        # Each period starts at the closest bin: the jitter of the start is at most half a bin
+        frames = data[offsets[:, None] + np.arange(length)]
+
+    amplitudes = frames.sum(axis=1)
+    mean = amplitudes.mean()
+    info = {'period': period,
+            'n_periods': len(offsets),
+            'offsets': offsets,
+            'amplitudes': amplitudes,
+            'spread': float(amplitudes.std() / mean) if mean > 0 else np.nan,
+            'poisson_spread': float(1 / np.sqrt(mean)) if mean > 0 else np.nan}
+    return frames.sum(axis=0), info
+
+
+@timed('fit_reconvolution')
+@cached('fit_reconvolution')
+def fit_reconvolution(data_fit, irf, resolution=0.004, model='multi-exponential', n_exp=1, tau=0.145, w=4.,
+                      phi=0., shift=0.):
+    """
+    Fit (decay ⊗ IRF) + background to a lifetime histogram.
+
+    :param data_fit: array - histogram in the fit window, including the rise
+    :param irf: array - IRF histogram in the same window
+    :param resolution: float - bin width [ns]
+    :param model: str - 'multi-exponential' or 'exciton beat'
+    :param n_exp: int - number of exponentials of the multi-exponential model
+    :param tau: float - initial lifetime [ns]. The i-th exponential starts at tau * 3**(i-1).
+    :param w: float - initial pulsation of the exciton beat [1/ns]
+    :param phi: float - initial phase of the exciton beat
+    :param shift: float - initial delay of the IRF [bins]
+    :return: lmfit MinimizerResult, with the fitted curve in result.best_fit
+    """
+    data_fit = np.asarray(data_fit, dtype=float)
+    n = len(data_fit)
+    t = resolution * np.arange(n)
+    convolve = IRFConvolution(irf, n)
+
+    background = float(np.min(data_fit))
+    height = float(np.max(data_fit)) - background
+
+    pars = Parameters()
+    pars.add('y0', value=background, min=0)
+    pars.add('shift', value=shift, min=-n/4, max=n/4)
+    if model == 'exciton beat':
+        # sin² is 1/2 on average
+        pars.add('A', value=2*height, min=0)
+        pars.add('phi', value=phi)
+        pars.add('w', value=w, min=0)
+        pars.add('tau', value=tau, min=resolution/10)
+    else:
+        for i in range(1, n_exp + 1):
+            pars.add('A%d' % i, value=height/n_exp, min=0)
+            pars.add('tau%d' % i, value=tau * 3**(i-1), min=resolution/10)
+
+    def residual(params):
+        return data_fit - params['y0'].value - convolve(decay_model(params, t, model, n_exp),
+                                                        params['shift'].value)
+
+    result = minimize(residual, pars)
+    result.best_fit = data_fit - result.residual
+    return result
+
+
+# Parameters of the models of the global fit. Same models as fit_lifetime_T and fit_lifetime_X (with c = c1*c2).
+GLOBAL_PARAMETERS = {'Trion': ('y0', 'N0', 'tau'),
+                     'Exciton': ('c', 'phi', 'w', 'tau')}
+
+
+def _global_model(model, x, p):
+    """
+    :param p: dict - value of each parameter, arrays of shape (number of decays, 1)
+    :return: array, dict - model (one decay per row) and its derivative with respect to each parameter
+    """
+    decay = np.exp(-x / p['tau'])
+    if model == 'Exciton':
+        sin2 = np.sin(p['w']*x + p['phi'])**2
+        y = p['c'] * sin2 * decay
+        dphi = p['c'] * np.sin(2*(p['w']*x + p['phi'])) * decay
+        derivatives = {'c': sin2 * decay, 'phi': dphi, 'w': x * dphi, 'tau': y * x / p['tau']**2}
+    else:
+        y = p['y0'] + p['N0'] * decay
+        derivatives = {'y0': np.ones_like(y), 'N0': decay * np.ones_like(y), 'tau': p['N0'] * decay * x / p['tau']**2}
+    return y, derivatives
+
+
+@timed('fit_global')
+@cached('fit_global')
+def fit_global(stack, x_axis, model='Trion', shared=('tau',), initial=None, job=None):
+    """
+    Fit all the decays of a stack at once. The shared parameters have one value for all the decays, the others one
+    value per decay.
+
+    The Jacobian is block-sparse: the local parameters of a decay only act on its rows. It is given to the solver as
+    a sparse matrix and the errors are computed with the Schur complement of the shared block, so that the cost
+    grows linearly with the number of decays.
+
+    :param stack: array - one decay per row, already cut to the fit window
+    :param x_axis: array - time axis of the window [ns]
+    :param model: str - 'Trion' (y0 + N0*exp(-x/tau)) or 'Exciton' (c*sin²(w*x+phi)*exp(-x/tau))
+    :param shared: tuple - names of the shared parameters, in GLOBAL_PARAMETERS[model]
+    :param initial: dict - optional initial values (scalars or one value per decay), guessed otherwise
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: dict - for each parameter an array of one value per decay (repeated for the shared ones) and its
+    standard error (name + '_err'), 'best_fit' with the fitted decays and 'redchi', 'nfev', 'success'
+    """
+    stack = np.atleast_2d(np.asarray(stack, dtype=float))
+    x = np.asarray(x_axis, dtype=float)[None, :]
+    n_sets, n_x = stack.shape
+    names = GLOBAL_PARAMETERS[model]
+    shared = tuple(name for name in names if name in shared)
+    local = tuple(name for name in names if name not in shared)
+    n_shared, n_local = len(shared), len(local)
+
+    # Initial values: closed-form guess for each decay, median of the guesses for the shared parameters
+    guesses = np.array([guess_decay(data_fit, x[0]) for data_fit in stack])
+    start = {'tau': guesses[:, 1], 'w': np.full(n_sets, 4.), 'phi': np.zeros(n_sets)}
+    if model == 'Exciton':
+        # sin² is 1/2 on average
+        start['c'] = 2 * guesses[:, 0]
+    else:
+        start['y0'] = np.min(stack, axis=1)
+        start['N0'] = guesses[:, 0]
+    for name, value in (initial or {}).items():
+        start[name] = np.broadcast_to(np.asarray(value, dtype=float), (n_sets,))
+    lower = {'tau': 1e-4, 'w': 0.}
+
+    # Vector of the parameters: shared parameters first, then the local parameters decay by decay
+    p0 = np.concatenate([[np.median(start[name]) for name in shared],
+                         np.column_stack([start[name] for name in local]).ravel() if n_local else []])
+    bounds = (np.concatenate([[lower.get(name, -np.inf) for name in shared],
+                              np.tile([lower.get(name, -np.inf) for name in local], n_sets)]), np.inf)
+
+    def unpack(p):
+        values = {name: np.full((n_sets, 1), p[j]) for j, name in enumerate(shared)}
+        local_values = p[n_shared:].reshape(n_sets, n_local)
+        for j, name in enumerate(local):
+            values[name] = local_values[:, j:j+1]
+        return values
+
+    # Sparsity pattern of the Jacobian, built once: row of each entry and column of its parameter
+    rows = np.arange(n_sets * n_x)
+    columns = {name: np.full(n_sets * n_x, j) for j, name in enumerate(shared)}
+    for j, name in enumerate(local):
+        columns[name] = np.repeat(n_shared + n_local * np.arange(n_sets) + j, n_x)
+    jac_rows = np.tile(rows, len(names))
+    jac_columns = np.concatenate([columns[name] for name in names])
+    jac_shape = (n_sets * n_x, len(p0))
+
+    nfev = [0]
+
+    def residual(p):
+        nfev[0] += 1
+        if job is not None:
+            job.set_progress(0, f'{nfev[0]} evaluations')
+        y, _ = _global_model(model, x, unpack(p))
+        return (y - stack).ravel()
+
+    def jacobian(p):
+        _, derivatives = _global_model(model, x, unpack(p))
+        entries = np.concatenate([derivatives[name].ravel() for name in names])
+        return sparse.csr_matrix((entries, (jac_rows, jac_columns)), shape=jac_shape)
+
+    solution = least_squares(residual, p0, jac=jacobian, bounds=bounds, method='trf', tr_solver='lsmr',
+                             x_scale='jac')
+
+    values = unpack(solution.x)
+    y, derivatives = _global_model(model, x, values)
+    chisqr = float(np.sum((y - stack)**2))
+    dof = max(n_sets * n_x - len(p0), 1)
+
+    # Errors: the normal matrix is an arrow matrix. Blocks A_i of the local parameters of each decay, B_i coupling
+    # them to the shared parameters and C of the shared parameters.
+    J_local = np.stack([derivatives[name] for name in local], axis=-1) if n_local else np.zeros((n_sets, n_x, 0))
+    J_shared = np.stack([derivatives[name] for name in shared], axis=-1) if n_shared \
+        else np.zeros((n_sets, n_x, 0))
+    A = np.einsum('inj,inl->ijl', J_local, J_local)
+    B = np.einsum('inj,inl->ijl', J_local, J_shared)
+    C = np.einsum('inj,inl->jl', J_shared, J_shared)
+    try:
+        A_inv = np.linalg.inv(A)
+        A_inv_B = A_inv @ B
+        schur_inv = np.linalg.inv(C - np.einsum('ijs,ijt->st', B, A_inv_B)) if n_shared else np.zeros((0, 0))
+        var_shared = np.diag(schur_inv)
+        var_local = np.diagonal(A_inv, axis1=1, axis2=2) + np.einsum('ijs,st,ijt->ij', A_inv_B, schur_inv, A_inv_B)
+        scale = chisqr / dof
+        err_shared, err_local = np.sqrt(scale * var_shared), np.sqrt(scale * var_local)
+    except np.linalg.LinAlgError:
+        err_shared, err_local = np.full(n_shared, np.nan), np.full((n_sets, n_local), np.nan)
+
+    result = {'best_fit': y, 'redchi': chisqr / dof, 'nfev': solution.nfev, 'success': solution.success}
+    for j, name in enumerate(shared):
+        result[name] = np.full(n_sets, solution.x[j])
+        result[name + '_err'] = np.full(n_sets, err_shared[j])
+    for j, name in enumerate(local):
+        result[name] = values[name][:, 0]
+        result[name + '_err'] = err_local[:, j]
+    return result
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Load test of the g2 page: drives N simultaneous sessions through the same path as fit_g2.main
+(upload -> histogram -> side peaks -> g2 and its Poisson error -> pdf of the figure) and reports
+the throughput and the latency of the sessions.
+
+Each session works on its own in-memory copy of the upload, exactly like streamlit does. Use a .ptu file to
+go through from_PTU (readPTU must be installed), otherwise a Swabian .txt histogram is used (demo data by default).
+
+python load_test.py --sessions 8 --rounds 5
+python load_test.py --sessions 8 --file my_measurement.ptu
+
+"""
+
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+
+from antibunching_toolbox import find_sidepeaks, get_g2_1input
+from session_toolbox import fig_to_bytes
+
+
+class FakeUpload(io.BytesIO):
+    # Mimics the UploadedFile given by st.file_uploader: a BytesIO with a name.
+    def __init__(self, content, name):
+        super().__init__(content)
+        self.name = name
+
+
+def run_session(content, name, num_peaks=6, n_bootstrap=100):
+    """
+    :param content: bytes - content of the uploaded file
+    :param name: str - name of the uploaded file
+    :return: float - latency of the session in s
+    """
+    t0 = time.perf_counter()
+    file = FakeUpload(content, name)
+
+    if name[-3:] == 'ptu':
+        from from_PTU import get_ptu_fromfile
+        _, data = get_ptu_fromfile(file)
+    else:
+        data = np.loadtxt(file)[1]
+
+    peaks, data_pk, central_peak, peak_sep, peak_width = find_sidepeaks(data)
+    g2 = get_g2_1input(data, peak_width, peak_sep, central_peak, num_peaks)
+    errg2 = np.std([get_g2_1input(np.random.poisson(data), peak_width, peak_sep, central_peak, num_peaks)
+                    for sim in range(n_bootstrap)])
+
+    # pyplot is not thread safe, the figure is created directly.
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.set_title(f'g2 = {g2 * 100:.3} ± {errg2 * 100:.2} %')
+    ax.plot(np.arange(0, len(data)), data, '-')
+    ax.set_xlim(central_peak - (num_peaks + 2) * peak_sep, central_peak + (num_peaks + 2) * peak_sep)
+    fig_to_bytes(fig, fmt='pdf')
+
+    return time.perf_counter() - t0
+
+
+def load_test(path, sessions=4, rounds=3):
+    """
+    :param path: str - file uploaded by every session
+    :param sessions: int - number of simultaneous sessions
+    :param rounds: int - number of times each session goes through the page
+    :return: dict - throughput [sessions/s] and latencies [s]
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    name = os.path.basename(path)
+
+    # Warm up (imports, readPTU compilation...) so that it is not counted in the first latency.
+    run_session(content, name)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        latencies = list(pool.map(lambda _: run_session(content, name), range(sessions * rounds)))
+    elapsed = time.perf_counter() - t0
+
+    latencies = np.array(latencies)
+    return {'sessions': sessions,
+            'runs': len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'latency_mean': latencies.mean(),
+            'latency_p50': np.percentile(latencies, 50),
+            'latency_p95': np.percentile(latencies, 95),
+            'latency_max': latencies.max()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the g2/PTU path of the app.')
+    parser.add_argument('--file', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       'demo_data', 'demo_g2.txt'),
+                        help='.ptu or Swabian .txt file uploaded by every session')
+    parser.add_argument('--sessions', type=int, default=4, help='number of simultaneous sessions')
+    parser.add_argument('--rounds', type=int, default=3, help='runs per session')
+    args = parser.parse_args()
+
+    report = load_test(args.file, args.sessions, args.rounds)
+
+    print(f"{report['sessions']} sessions, {report['runs']} runs")
+    print(f"throughput: {report['throughput']:.2f} sessions/s")
+    print(f"latency: mean {report['latency_mean'] * 1000:.0f} ms | p50 {report['latency_p50'] * 1000:.0f} ms | "
+          f"p95 {report['latency_p95'] * 1000:.0f} ms | max {report['latency_max'] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Tracking of the modes (reflectivity dips) or lines (PL peaks) along a series of spectra: temperature or voltage
+tuning, kinetic series.
+
+fit_cav and fit_lines look for the peaks of each spectrum independently, with a fixed prominence, and fit a wide
+window (zoom_fit). Here:
+- the modes are detected once, on the first spectrum, with a prominence relative to the noise of the spectrum
+  (snr times the noise estimated from the differences between neighbouring pixels)
+- the position of each mode in the next spectrum is predicted from the two previous ones (constant drift)
+- each mode is fitted (Lorentzian + background, variable projection by default, or lmfit / Poisson likelihood as in
+  cavity_toolbox) in a narrow window around the prediction, a few linewidths wide, starting from its previous fit
+- a mode that is not found where predicted is searched again in its window. If it is still lost, its trajectory has
+  a gap and the prediction continues from its last position.
+
+    table = track_modes(X, frames, n_modes=2, kind='dip', job=job)
+
+The result is a DataFrame with one line per spectrum and mode: continuous trajectories of xc, κ (kappa) and Q.
+
+"""
+
+import numpy as np
+import pandas as pd
+from lmfit.models import LorentzianModel, LinearModel, QuadraticModel
+from scipy.signal import find_peaks
+
+from result_cache import cached
+from profiling import timed
+from spectro_toolbox import nearest_index
+from poisson_fit import poisson_fit, lorentzian_model, spectral_start
+from varpro_fit import varpro_fit
+
+
+def noise_level(y):
+    """
+    :param y: array - spectrum
+    :return: float - standard deviation of the noise, from the median absolute deviation of the differences
+    between neighbouring pixels (insensitive to the lines, which are much wider than a pixel)
+    """
+    differences = np.diff(y)
+    return 1.4826 * np.median(np.abs(differences - np.median(differences))) / np.sqrt(2)
+
+
+def detect_modes(y, n_modes=1, kind='dip', snr=5.):
+    """
+    :param y: array - spectrum
+    :param n_modes: int - maximum number of modes
+    :param kind: str - 'dip' (reflectivity) or 'peak' (PL)
+    :param snr: float - minimum prominence in units of the noise
+    :return: array - indices of the most prominent modes, in the order of the pixels
+    """
+    signal = -np.asarray(y, dtype=float) if kind == 'dip' else np.asarray(y, dtype=float)
+    peaks, properties = find_peaks(signal, prominence=snr * max(noise_level(signal), 1e-12))
+    largest = np.argsort(properties['prominences'])[::-1][:n_modes]
+    return np.sort(peaks[largest])
+
+
+def _line_model(background):
+    model = QuadraticModel(prefix='bkg_') if background == 'quadratic' else LinearModel(prefix='bkg_')
+    return model + LorentzianModel(prefix='lz1_')
+
+
+def _fit_window(model, params, x, y, center, half_width, background, likelihood='least_squares', solver='varpro'):
+    """
+    Fit one mode in the window of half_width pixels around the pixel center.
+
+    :param likelihood: str - 'least_squares' or 'poisson'
+    :param solver: str - 'varpro' or 'lmfit', for the least squares
+    :return: fit result (VarProResult, lmfit ModelResult or PoissonFitResult), None if the fit fails or the mode
+    leaves the window
+    """
+    window = slice(max(center - half_width, 0), center + half_width + 1)
+    xdat_fit, ydat_fit = x[window], y[window]
+    if len(xdat_fit) < 6:
+        return None
+    try:
+        if likelihood == 'poisson':
+            result = poisson_fit(lorentzian_model(1, background), params, ydat_fit, xdat_fit)
+        elif solver == 'varpro':
+            result = varpro_fit(params, ydat_fit, xdat_fit, background)
+        else:
+            result = model.fit(ydat_fit, params, x=xdat_fit)
+    except (ValueError, np.linalg.LinAlgError):
+        return None
+    xc, sigma = result.params['lz1_center'].value, result.params['lz1_sigma'].value
+    inside = min(xdat_fit[0], xdat_fit[-1]) < xc < max(xdat_fit[0], xdat_fit[-1])
+    if not (result.success and inside and 0 < sigma < abs(xdat_fit[-1] - xdat_fit[0])):
+        return None
+    return result
+
+
+@timed('track_modes')
+@cached('track_modes')
+def track_modes(x, stack, n_modes=1, kind='dip', background='linear', start_search=None, stop_search=None,
+                zoom_fit=75, window=5., min_window=8, snr=5., likelihood='least_squares', solver='varpro', job=None):
+    """
+    Follow the modes of the first spectrum along a series of spectra.
+
+    :param x: array - energy axis shared by all the spectra [eV]
+    :param stack: array - (n_spectra, n_px), in the order of the series
+    :param n_modes: int - number of modes to follow
+    :param kind: str - 'dip' (reflectivity) or 'peak' (PL)
+    :param background: str - 'linear' or 'quadratic'
+    :param start_search, stop_search: int - range of pixels where the modes are detected in the first spectrum
+    :param zoom_fit: int - half width of the windows of the first fits [px]
+    :param window: float - half width of the next windows, in linewidths (FWHM)
+    :param min_window: int - minimum half width of the windows [px]
+    :param snr: float - prominence of the modes in the first spectrum, in units of the noise
+    :param likelihood: str - 'least_squares' or 'poisson'
+    :param solver: str - 'varpro' or 'lmfit', for the least squares
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: DataFrame - one line per spectrum and mode: 'spectrum', 'mode', xc [eV], kappa [eV], Q, their errors,
+    'found' (False where the mode was lost: the values are NaN)
+    """
+    x = np.asarray(x, dtype=float)
+    stack = np.atleast_2d(np.asarray(stack, dtype=float))
+    search = slice(start_search, stop_search)
+    first = detect_modes(stack[0, search], n_modes, kind, snr) + (start_search or 0)
+    if not len(first):
+        raise ValueError('No mode found in the first spectrum: lower snr or change the search range')
+
+    dx = np.abs(np.gradient(x))
+    model = _line_model(background)
+    n_found = len(first)
+    values = np.full((len(stack), n_found, 6), np.nan)
+
+    # Per mode: fitted parameters, pixels and energies of the last positions, half width of the window
+    params = []
+    for px in first:
+        p = model.make_params()
+        p['lz1_center'].set(value=x[px])
+        p['lz1_sigma'].set(value=100e-6)
+        # Background and amplitude from the first window: lmfit and the Poisson likelihood do not solve them
+        first_window = slice(max(px - zoom_fit, 0), px + zoom_fit + 1)
+        params.append(spectral_start(p, x[first_window], stack[0, first_window]))
+    pixels = list(first)
+    history = [[] for _ in first]
+    half_widths = [zoom_fit] * n_found
+
+    for i, y in enumerate(stack):
+        for m in range(n_found):
+            # Prediction: constant drift from the two last positions
+            if len(history[m]) > 1:
+                predicted = 2 * history[m][-1] - history[m][-2]
+            else:
+                predicted = x[pixels[m]]
+            center = nearest_index(x, predicted)
+            params[m]['lz1_center'].set(value=x[center])
+            result = _fit_window(model, params[m], x, y, center, half_widths[m], background, likelihood, solver)
+
+            if result is None:
+                # Search again: extremum of the window
+                search_window = slice(max(center - half_widths[m], 0), center + half_widths[m] + 1)
+                extremum = np.argmin(y[search_window]) if kind == 'dip' else np.argmax(y[search_window])
+                center = search_window.start + int(extremum)
+                params[m]['lz1_center'].set(value=x[center])
+                result = _fit_window(model, params[m], x, y, center, half_widths[m], background, likelihood, solver)
+            if result is None:
+                continue
+
+            params[m] = result.params
+            xc, sigma = result.params['lz1_center'].value, result.params['lz1_sigma'].value
+            xc_err = result.params['lz1_center'].stderr or np.nan
+            kappa, kappa_err = 2 * sigma, 2 * (result.params['lz1_sigma'].stderr or np.nan)
+            Q = xc / kappa
+            values[i, m] = (xc, kappa, Q, xc_err, kappa_err, abs(Q) * np.hypot(xc_err / xc, kappa_err / kappa))
+            history[m].append(xc)
+            pixels[m] = nearest_index(x, xc)
+            half_widths[m] = max(int(np.ceil(window * kappa / dx[pixels[m]])), min_window)
+
+        if job is not None:
+            job.set_progress((i + 1) / len(stack))
+
+    columns = ['xc', 'kappa', 'Q', 'xc_err', 'kappa_err', 'Q_err']
+    table = pd.DataFrame(values.reshape(-1, len(columns)), columns=columns)
+    table.insert(0, 'mode', np.tile(np.arange(1, n_found + 1), len(stack)))
+    table.insert(0, 'spectrum', np.repeat(np.arange(len(stack)), n_found))
+    table['found'] = np.isfinite(table['xc'])
+    return table
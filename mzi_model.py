@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Closed-form model of the 2-photon interference of two imperfect single-photon sources in a MZI (imperfect_SPS).
+
+Each source emits a statistical mixture of Fock states, with the phenomenological model of Perceval
+(pcvl.Source, Pont et al. PRX 12, 031033 (2022)):
+    p2 = (1 - beta*g2 - sqrt(1 - 2*beta*g2)) / g2,  p1 = beta - p2,  d = 1 - sqrt(M)
+and, after the transmission eta, the components
+    |0>                    1 - eta*p1 - 2*eta*(1-eta)*p2 - eta²*p2
+    |1>    signal          (1-d) * (eta*p1 + eta*(1-eta)*p2)
+    |1~>   distinguishable d * (eta*p1 + eta*(1-eta)*p2)
+    |1b>   noise photon    eta*(1-eta)*p2
+    |1,1b>                 (1-d) * eta²*p2
+    |1~,1b>                d * eta²*p2
+The signal photons |1> of the two sources are identical. The |1~> photons are distinguishable from everything. The
+noise photon |1b> is distinguishable (multiphoton_model 'distinguishable') or identical to the signal photons
+('indistinguishable').
+
+The MZI (PS, BS, PS(phase), BS) only mixes Fock states: the probability that all the photons leave in the output
+mode j is a product of the transmissions T_jk = |U_jk|², times n!/(a! b!) for the n = a + b identical photons
+(a from the first source, b from the second one). The threshold outcomes |0,0>, |1,0>, |0,1> and |1,1> follow from
+the probabilities that each output is empty. Every function is made of numpy expressions and broadcasts over
+arrays of parameters: a curve of 10^4 points is computed at once.
+
+    P = mzi_outcomes(beta, eta, g2, M, phase=np.linspace(0, np.pi, 10000))    # (10000, 4)
+
+mzi_fock_outcomes resolves the number of photons in each output (photon-number tomography).
+
+"""
+
+import numpy as np
+from scipy.special import comb, factorial
+
+# Threshold outcomes, in the order of the last axis of mzi_outcomes
+OUTCOMES = ('|0,0>', '|1,0>', '|0,1>', '|1,1>')
+
+# Components of the state of one source, in the order of the last axis of state_composition
+COMPONENTS = ('|0>', '|1>', '|1~>', '|1b>', '|1,1b>', '|1~,1b>')
+
+# Photon-number outcomes (at most 2 photons per source), in the order of the last axis of mzi_fock_outcomes
+FOCK_OUTCOMES = tuple('|%d,%d>' % (k, n - k) for n in range(5) for k in range(n, -1, -1))
+
+
+def emission_probabilities(beta, g2):
+    """
+    :param beta: float or array - brightness, probability that the source emits at least one photon
+    :param g2: float or array - second order autocorrelation at zero delay
+    :return: p1, p2 - probabilities to emit one and two photons
+    """
+    beta, g2 = np.broadcast_arrays(np.asarray(beta, dtype=float), np.asarray(g2, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p2 = np.where(g2 > 0, (1 - beta * g2 - np.sqrt(np.clip(1 - 2 * beta * g2, 0, None))) / g2, 0.)
+    return beta - p2, p2
+
+
+def state_composition(beta, eta, g2, M):
+    """
+    State of one source after the losses (table above), broadcast over grids of parameters:
+        state_composition(beta, eta[:, None], g2[None, :], M)    # (n_eta, n_g2, 6)
+
+    :param beta, eta, g2, M: float or array - brightness, overall transmission, g2 and indistinguishability
+    :return: array (..., 6) - probabilities of COMPONENTS
+    """
+    p1, p2 = emission_probabilities(beta, g2)
+    d = 1 - np.sqrt(M)
+    one = eta * p1 + eta * (1 - eta) * p2
+    noise = eta * (1 - eta) * p2
+    two = eta**2 * p2
+    return np.stack(np.broadcast_arrays(1 - eta * p1 - 2 * noise - two,
+                                        (1 - d) * one,
+                                        d * one,
+                                        noise,
+                                        (1 - d) * two,
+                                        d * two), axis=-1)
+
+
+def source_components(beta, eta, g2, M, multiphoton_model='distinguishable'):
+    """
+    Components of the state of one source after the losses, grouped by number of photons n and number a of them
+    that are identical to the signal photons of the other source.
+
+    :return: dict - (n, a): probability (float or array)
+    """
+    zero, one, tilde, noise, one_noise, tilde_noise = np.moveaxis(state_composition(beta, eta, g2, M), -1, 0)
+    # the noise photon counts as a signal photon in the indistinguishable model
+    b = int(multiphoton_model == 'indistinguishable')
+
+    components = {key: 0. for key in [(0, 0), (1, 0), (1, 1), (2, 0), (2, 1), (2, 2)]}
+    components[(0, 0)] = zero
+    components[(1, 1)] += one
+    components[(1, 0)] += tilde
+    components[(1, b)] += noise
+    components[(2, 1 + b)] += one_noise
+    components[(2, b)] += tilde_noise
+    return components
+
+
+def mzi_unitary(phase, phase_in=0.):
+    """
+    Unitary of the MZI of imperfect_SPS.QPU: PS(phase_in) on mode 0, BS, PS(phase) on mode 0, BS, with the
+    symmetric beam splitter of Perceval [[1, i], [i, 1]] / sqrt(2).
+
+    :param phase: float or array - internal phase of the MZI
+    :return: array (..., 2, 2)
+    """
+    phase = np.asarray(phase, dtype=float)
+    bs = np.array([[1, 1j], [1j, 1]]) / np.sqrt(2)
+
+    def shifter(angle):
+        ps = np.zeros(np.shape(angle) + (2, 2), dtype=complex)
+        ps[..., 0, 0] = np.exp(1j * np.asarray(angle))
+        ps[..., 1, 1] = 1
+        return ps
+
+    return bs @ shifter(phase) @ bs @ shifter(phase_in)
+
+
+def mzi_outcomes(beta, eta, g2, M, phase=np.pi / 2, multiphoton_model='distinguishable'):
+    """
+    Probabilities of the threshold outcomes at the output of the MZI, one source on each input.
+
+    :param beta, eta, g2, M: float or array - brightness, overall transmission, g2 and indistinguishability (HOM
+    visibility of the signal photons) of the sources
+    :param phase: float or array - internal phase of the MZI
+    :param multiphoton_model: str - 'distinguishable' or 'indistinguishable'
+    :return: array (..., 4) - probabilities of OUTCOMES, broadcast over the parameters
+    """
+    components = source_components(beta, eta, g2, M, multiphoton_model)
+    T = np.abs(mzi_unitary(phase))**2
+
+    # Probability that all the photons leave in the mode j, for j = 0 and 1
+    empty = []
+    for j in (0, 1):
+        transmission = T[..., j, 0], T[..., j, 1]
+        p = 0.
+        for (n_a, a), p_a in components.items():
+            for (n_b, b), p_b in components.items():
+                p = p + p_a * p_b * transmission[0]**n_a * transmission[1]**n_b * comb(a + b, a)
+        empty.append(p)
+    # empty[0]: nothing in the mode 1 (|1,0>), empty[1]: nothing in the mode 0 (|0,1>)
+    vacuum = components[(0, 0)]**2
+    return np.stack(np.broadcast_arrays(vacuum,
+                                        empty[0] - vacuum,
+                                        empty[1] - vacuum,
+                                        1 - empty[0] - empty[1] + vacuum), axis=-1)
+
+
+def _identical_distribution(U, n0, n1):
+    """
+    :param U: array (..., 2, 2) - unitary of the MZI
+    :param n0, n1: int - number of identical photons in the input modes 0 and 1
+    :return: array (..., n0 + n1 + 1) - probability of k photons in the output mode 0 (and n0 + n1 - k in the mode 1)
+    """
+    n = n0 + n1
+    amplitudes = np.zeros(U.shape[:-2] + (n + 1,), dtype=complex)
+    # Coefficient of a0^k a1^(n-k) in (U00 a0 + U10 a1)^n0 (U01 a0 + U11 a1)^n1
+    for s in range(n0 + 1):
+        for t in range(n1 + 1):
+            amplitudes[..., s + t] += comb(n0, s) * comb(n1, t) * U[..., 0, 0]**s * U[..., 1, 0]**(n0 - s) \
+                                      * U[..., 0, 1]**t * U[..., 1, 1]**(n1 - t)
+    k = np.arange(n + 1)
+    return np.abs(amplitudes)**2 * factorial(k) * factorial(n - k) / (factorial(n0) * factorial(n1))
+
+
+def _convolve(p, q):
+    # Distribution of the number of photons in the output 0 of two independent groups of photons
+    result = np.zeros(np.broadcast_shapes(p.shape[:-1], q.shape[:-1]) + (p.shape[-1] + q.shape[-1] - 1,))
+    for j in range(q.shape[-1]):
+        result[..., j:j + p.shape[-1]] += p * q[..., j:j + 1]
+    return result
+
+
+def mzi_fock_outcomes(beta, eta, g2, M, phase=np.pi / 2, multiphoton_model='distinguishable'):
+    """
+    Probabilities of the photon-number outcomes at the output of the MZI, one source on each input.
+
+    The components of the sources do not depend on the phase: they are computed once, and only the unitary is computed
+    for each phase. The identical photons of a pair of components interfere (_identical_distribution), the others
+    leave independently with the probabilities T_jk = |U_jk|².
+
+    :param beta, eta, g2, M: float or array - as mzi_outcomes
+    :param phase: float or array - internal phase of the MZI
+    :param multiphoton_model: str - 'distinguishable' or 'indistinguishable'
+    :return: array (..., 15) - probabilities of FOCK_OUTCOMES, broadcast over the parameters
+    """
+    components = source_components(beta, eta, g2, M, multiphoton_model)
+    U = mzi_unitary(phase)
+    T = np.abs(U)**2
+    # A distinguishable photon from the input j: 0 or 1 photon in the output 0
+    alone = [np.stack([T[..., 1, j], T[..., 0, j]], axis=-1) for j in (0, 1)]
+
+    # by total number of photons n: probability of n - k photons in the output 1 (index k)
+    by_number = [0.] * 5
+    for (n_a, a), p_a in components.items():
+        for (n_b, b), p_b in components.items():
+            distribution = _identical_distribution(U, a, b)
+            for _ in range(n_a - a):
+                distribution = _convolve(distribution, alone[0])
+            for _ in range(n_b - b):
+                distribution = _convolve(distribution, alone[1])
+            weight = np.asarray(p_a * p_b)[..., np.newaxis]
+            by_number[n_a + n_b] = by_number[n_a + n_b] + weight * distribution
+
+    # FOCK_OUTCOMES lists the photons in the output 0 from n down to 0
+    columns = [by_number[n][..., k] for n in range(5) for k in range(n, -1, -1)]
+    return np.stack(np.broadcast_arrays(*columns), axis=-1)
+
+
+def hom_visibility(beta, eta, g2, M, phase=np.pi / 2, multiphoton_model='distinguishable'):
+    """
+    V_HOM = 1 - 2 * P(|1,1>, phase) / P(|1,1>, 0), as imperfect_SPS.compute
+
+    :return: float or array - broadcast over the parameters
+    """
+    correlated = mzi_outcomes(beta, eta, g2, M, phase, multiphoton_model)[..., 3]
+    uncorrelated = mzi_outcomes(beta, eta, g2, M, 0., multiphoton_model)[..., 3]
+    # NaN where no coincidence is possible (eta = 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - 2 * correlated / uncorrelated
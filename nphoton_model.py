@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Interference of N imperfect single-photon sources in a multimode interferometer (N up to about 12), for the photon
+numbers of N_Photons_coinc.
+
+The sources follow the phenomenological model of mzi_model (and pcvl.Source): after the losses, each source is in
+one of the components |0>, |1>, |1~>, |1b>, |1,1b>, |1~,1b> (state_composition). The signal photons |1> of all the
+sources are identical, the |1~> photons are distinguishable from everything, and the noise photons |1b> are
+distinguishable or identical to the signal ('indistinguishable' multiphoton model).
+
+- the configurations of the N sources are enumerated from the ideal one (every source in |1>), up to max_defects
+  sources in another component. Their total probability (captured) tells how much of the state is neglected.
+- in a configuration, the identical photons interfere: the probability of an output pattern t is
+  |Perm(U[t, s])|² / (prod s! prod t!), s being their input pattern. Each distinguishable photon leaves
+  independently, with the probability |U_ij|², and the output distribution is the convolution of both.
+- the permanents are computed with the formula of Glynn, the sign vectors being visited in Gray code order so that
+  each term is updated from the previous one: O(2^(n-1) n) per permanent, as a cumulative sum over a batch of
+  matrices. The configurations share most of their submatrices U[t, s]: each distinct one is computed once, and the
+  large batches are computed in the process pool of uncertainty.
+
+    U = fourier_unitary(6)
+    patterns = np.ones((1, 6), dtype=int)
+    probabilities, photon_numbers, captured = nphoton_outcomes(U, patterns, beta, eta, g2, M)
+
+"""
+
+import functools
+import itertools
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from result_cache import cached
+from profiling import timed
+from mzi_model import state_composition, COMPONENTS
+from uncertainty import run_tasks
+
+# Work (number of Glynn terms times the size of the matrices) above which the permanents run in the process pool
+PARALLEL_WORK = 1e8
+# Work of a batch of permanents computed at once, which bounds the memory of the cumulative sums (16 bytes per term)
+PERMANENT_CHUNK = 2e6
+
+
+@functools.lru_cache(maxsize=None)
+def _gray_code(n):
+    """
+    :param n: int - size of the matrices
+    :return: array, array - for each step of the Gray code after the first one: row whose sign flips and its new sign
+    """
+    steps = np.arange(1, 2 ** (n - 1))
+    # The step k flips the lowest set bit of k, i.e. the sign of the row 1 + that bit (the row 0 keeps the sign +)
+    bits = np.log2(steps & -steps).astype(int)
+    gray = steps ^ (steps >> 1)
+    signs = np.where(gray >> bits & 1, -1., 1.)
+    return bits + 1, signs
+
+
+def permanent(A):
+    """
+    Permanent of the formula of Glynn, the sign vectors being visited in Gray code order.
+
+    :param A: array (..., n, n) - matrix or batch of matrices
+    :return: complex or array (...)
+    """
+    A = np.asarray(A)
+    n = A.shape[-1]
+    if n == 0:
+        return np.ones(A.shape[:-2], dtype=A.dtype)
+    if n == 1:
+        return A[..., 0, 0]
+    rows, signs = _gray_code(n)
+    # Sums over the rows, weighted by the signs, for every sign vector: the first one (all +), then one update per step
+    sums = np.empty(A.shape[:-2] + (2 ** (n - 1), n), dtype=A.dtype)
+    sums[..., 0, :] = A.sum(axis=-2)
+    np.multiply(A[..., rows, :], 2 * signs[:, np.newaxis], out=sums[..., 1:, :])
+    np.cumsum(sums, axis=-2, out=sums)
+    # The sign of the product of the signs changes at every step
+    alternate = np.where(np.arange(2 ** (n - 1)) % 2, -1., 1.)
+    return np.prod(sums, axis=-1) @ alternate / 2 ** (n - 1)
+
+
+def fourier_unitary(m):
+    """
+    :param m: int - number of modes
+    :return: array (m, m) - discrete Fourier transform interferometer
+    """
+    k = np.arange(m)
+    return np.exp(2j * np.pi * np.outer(k, k) / m) / np.sqrt(m)
+
+
+def _photons(multiphoton_model):
+    """
+    :return: dict - name of the component: (number of identical photons, number of distinguishable photons)
+    """
+    b = int(multiphoton_model == 'indistinguishable')
+    return {'|0>': (0, 0), '|1>': (1, 0), '|1~>': (0, 1), '|1b>': (b, 1 - b), '|1,1b>': (1 + b, 1 - b),
+            '|1~,1b>': (b, 2 - b)}
+
+
+def source_configurations(n_sources, beta, eta, g2, M, multiphoton_model='distinguishable', max_defects=2):
+    """
+    :param n_sources: int - number of sources, the same for all
+    :param max_defects: int - maximum number of sources in another component than |1>
+    :return: list - (probability, identical photons per source, distinguishable photons per source), the
+    configurations of probability 0 being skipped
+    """
+    composition = dict(zip(COMPONENTS, state_composition(beta, eta, g2, M)))
+    photons = _photons(multiphoton_model)
+    defects = [name for name in COMPONENTS if name != '|1>' and composition[name] > 0]
+
+    configurations = []
+    for k in range(min(max_defects, n_sources) + 1):
+        for positions in itertools.combinations(range(n_sources), k):
+            for names in itertools.product(defects, repeat=k):
+                probability = composition['|1>'] ** (n_sources - k) * np.prod([composition[n] for n in names])
+                if probability <= 0:
+                    continue
+                identical, distinguishable = [1] * n_sources, [0] * n_sources
+                for position, name in zip(positions, names):
+                    identical[position], distinguishable[position] = photons[name]
+                configurations.append((float(probability), tuple(identical), tuple(distinguishable)))
+    return configurations
+
+
+def _assignments(pattern, inputs):
+    """
+    Output modes of the distinguishable photons that fit in the pattern.
+
+    :param pattern: tuple - output pattern
+    :param inputs: list - input mode of each distinguishable photon
+    :return: generator - (output modes, remaining pattern for the identical photons)
+    """
+    if not inputs:
+        yield (), pattern
+        return
+    for mode in range(len(pattern)):
+        if pattern[mode] > 0:
+            rest = pattern[:mode] + (pattern[mode] - 1,) + pattern[mode + 1:]
+            for modes, remaining in _assignments(rest, inputs[1:]):
+                yield (mode,) + modes, remaining
+
+
+def _permanent_chunk(matrices):
+    # Worker of the process pool
+    return permanent(matrices)
+
+
+def _identical_probabilities(U, keys, job=None):
+    """
+    :param keys: set - (input pattern, output pattern) of the identical photons
+    :return: dict - key: |Perm(U[t, s])|² / (prod s! prod t!)
+    """
+    modes = np.arange(U.shape[0])
+    by_size = {}
+    for key in keys:
+        by_size.setdefault(sum(key[0]), []).append(key)
+
+    values = {}
+    for n, group in by_size.items():
+        matrices = np.array([U[np.ix_(np.repeat(modes, t), np.repeat(modes, s))] for s, t in group])
+        work = len(group) * 2 ** max(n - 1, 0) * n
+        if work > PARALLEL_WORK:
+            chunks = np.array_split(matrices, max(2 * (os.cpu_count() or 4), math.ceil(work / PERMANENT_CHUNK)))
+            permanents = np.concatenate(run_tasks(_permanent_chunk, [(chunk,) for chunk in chunks], job))
+        else:
+            chunks = np.array_split(matrices, min(len(group), max(1, math.ceil(work / PERMANENT_CHUNK))))
+            permanents = np.concatenate([permanent(chunk) for chunk in chunks])
+        norms = [math.prod(map(math.factorial, s)) * math.prod(map(math.factorial, t)) for s, t in group]
+        values.update(zip(group, np.abs(permanents) ** 2 / norms))
+    return values
+
+
+@timed('nphoton_outcomes')
+@cached('nphoton_outcomes')
+def nphoton_outcomes(U, patterns, beta, eta, g2, M, multiphoton_model='distinguishable', max_defects=2,
+                     n_sources=None, job=None):
+    """
+    Probabilities of output patterns of N sources on the first N inputs of an interferometer.
+
+    :param U: array (m, m) - unitary of the interferometer, output modes in rows
+    :param patterns: array (n_patterns, m) - numbers of photons in the output modes (photon-number resolving)
+    :param beta, eta, g2, M: float - brightness, overall transmission, g2 and indistinguishability of the sources
+    :param multiphoton_model: str - 'distinguishable' or 'indistinguishable'
+    :param max_defects: int - maximum number of sources in another component than |1> (see source_configurations)
+    :param n_sources: int - number of sources, one on each of the first inputs. Default: one on every input.
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: array, array, float - probabilities of the patterns, probabilities of n photons at the output (index n)
+    and total probability of the configurations that are taken into account
+    """
+    U = np.asarray(U, dtype=complex)
+    patterns = [tuple(int(n) for n in pattern) for pattern in np.atleast_2d(patterns)]
+    n_sources = n_sources or U.shape[1]
+    configurations = source_configurations(n_sources, beta, eta, g2, M, multiphoton_model, max_defects)
+    T = (np.abs(U) ** 2).tolist()
+    pad = (0,) * (U.shape[1] - n_sources)
+
+    # Terms of each pattern: (weight, key of the identical photons)
+    terms = [[] for _ in patterns]
+    photon_numbers = np.zeros(3 * n_sources + 1)
+    for probability, identical, distinguishable in configurations:
+        photon_numbers[sum(identical) + sum(distinguishable)] += probability
+        inputs = [mode for mode, n in enumerate(distinguishable) for _ in range(n)]
+        for i, pattern in enumerate(patterns):
+            if sum(pattern) != sum(identical) + len(inputs):
+                continue
+            for outputs, remaining in _assignments(pattern, inputs):
+                weight = probability * math.prod(T[output][mode] for output, mode in zip(outputs, inputs))
+                terms[i].append((weight, (identical + pad, remaining)))
+
+    values = _identical_probabilities(U, {key for pattern_terms in terms for _, key in pattern_terms}, job)
+    probabilities = np.array([sum(weight * values[key] for weight, key in pattern_terms) for pattern_terms in terms])
+    return probabilities, photon_numbers, sum(probability for probability, _, _ in configurations)
+
+
+@cached('fourier_coincidences')
+def fourier_coincidences(n_max, eta, g2, M, multiphoton_model='distinguishable', max_defects=2, job=None):
+    """
+    N-photon generalisation of the HOM dip: N sources in the N-mode Fourier interferometer, probability of one photon
+    in each output. It vanishes for identical photons and even N (suppression law).
+
+    :param n_max: int - largest number of photons, from 2
+    :param eta: float - overall transmission (the brightness is included)
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: DataFrame - one line per N: probability for perfect ('ideal'), distinguishable ('distinguishable') and
+    imperfect sources ('imperfect', given that N photons are detected), and 'captured' (see nphoton_outcomes)
+    """
+    rows = []
+    for N in range(2, n_max + 1):
+        U = fourier_unitary(N)
+        pattern = np.ones((1, N), dtype=int)
+        # The job reaches the permanents of the process pool: the expensive N can be cancelled
+        probabilities, photon_numbers, captured = nphoton_outcomes(U, pattern, 1., eta, g2, M, multiphoton_model,
+                                                                   max_defects, job=job)
+        rows.append({'N': N,
+                     'ideal': abs(permanent(U)) ** 2,
+                     'distinguishable': permanent(np.abs(U) ** 2).real,
+                     'imperfect': probabilities[0] / photon_numbers[N],
+                     'captured': captured})
+        if job is not None:
+            # the cost doubles with every photon
+            job.set_progress((2 ** (N + 1) - 4) / (2 ** (n_max + 1) - 4))
+    return pd.DataFrame(rows)
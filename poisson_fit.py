@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Maximum likelihood fits of histograms and spectra of counts.
+
+Least squares on raw counts give the same weight to a bin with 2 counts and to a bin with 2000 counts: the tails of
+the decays and the wings of the lines bias the result. Here the Poisson deviance
+    D = 2 * sum(mu - y + y*log(y/mu))
+is minimised, mu being the model. With the Jacobian J of the model (analytic, no finite differences):
+    gradient    dD/dp = 2 * J^T (1 - y/mu)
+    Hessian     d²D/dp² ≈ 2 * J^T diag(1/mu) J        (Fisher information, always positive)
+and the minimiser is a Levenberg-Marquardt on this Hessian. The standard errors come from the inverse of the Fisher
+information at the optimum.
+
+The models have the parameters (and the names) of the lmfit models of the app, so that the initial values come from
+lmfit Parameters and the result can be used as an lmfit result (result.params, result.best_fit):
+- exp_decay: y0 + N0*exp(-x/tau), as fit_lifetime_T (t0 = 0)
+- cosine_decay: c2*sin²(w*x + phi)*exp(-x/tau), as fit_lifetime_X (c1 = 1)
+- lorentzian_model(n_peaks, background): LinearModel(prefix='bkg_') or QuadraticModel(prefix='bkg_') + n
+  LorentzianModel(prefix='lz%d_'), as fit_cav and fit_lines
+
+"""
+
+import numpy as np
+from scipy.special import xlogy
+
+
+def exp_decay(x, p):
+    """
+    :param x: array - time [ns]
+    :param p: dict - values of the parameters
+    :return: array, dict - model and its derivative with respect to each parameter
+    """
+    decay = np.exp(-x / p['tau'])
+    return p['y0'] + p['N0'] * decay, {'y0': np.ones_like(x),
+                                        'N0': decay,
+                                        'tau': p['N0'] * decay * x / p['tau']**2}
+
+
+def cosine_decay(x, p):
+    decay = np.exp(-x / p['tau'])
+    sin2 = np.sin(p['w']*x + p['phi'])**2
+    dphi = p['c2'] * np.sin(2*(p['w']*x + p['phi'])) * decay
+    y = p['c2'] * sin2 * decay
+    return y, {'c2': sin2 * decay,
+               'phi': dphi,
+               'w': x * dphi,
+               'tau': y * x / p['tau']**2}
+
+
+def lorentzian_model(n_peaks, background='linear'):
+    """
+    :param n_peaks: int - number of Lorentzians, prefixes lz1_, lz2_...
+    :param background: str - 'linear' (bkg_slope, bkg_intercept) or 'quadratic' (bkg_a, bkg_b, bkg_c)
+    :return: function - model(x, p) -> (model, derivatives)
+    """
+    def model(x, p):
+        if background == 'quadratic':
+            y = p['bkg_a']*x**2 + p['bkg_b']*x + p['bkg_c']
+            derivatives = {'bkg_a': x**2, 'bkg_b': x, 'bkg_c': np.ones_like(x)}
+        else:
+            y = p['bkg_slope']*x + p['bkg_intercept']
+            derivatives = {'bkg_slope': x, 'bkg_intercept': np.ones_like(x)}
+        for i in range(1, n_peaks + 1):
+            prefix = 'lz%d_' % i
+            amplitude, center, sigma = p[prefix + 'amplitude'], p[prefix + 'center'], p[prefix + 'sigma']
+            # lmfit lorentzian: amplitude/pi * sigma / ((x - center)² + sigma²)
+            d = x - center
+            denominator = d**2 + sigma**2
+            shape = sigma / (np.pi * denominator)
+            y = y + amplitude * shape
+            derivatives[prefix + 'amplitude'] = shape
+            derivatives[prefix + 'center'] = amplitude * shape * 2 * d / denominator
+            derivatives[prefix + 'sigma'] = amplitude / np.pi * (d**2 - sigma**2) / denominator**2
+        return y, derivatives
+    return model
+
+
+def deviance(y, mu):
+    # Poisson deviance, infinite if the model is not positive where there are counts
+    if np.any(mu <= 0):
+        return np.inf
+    return 2 * np.sum(mu - y + xlogy(y, y) - xlogy(y, mu))
+
+
+def spectral_start(params, x, y):
+    """
+    Initial values for a Poisson fit of Lorentzians: the model has to be positive everywhere. The background starts
+    at the median of the counts and each Lorentzian at the height of the data at its center.
+
+    :param params: lmfit Parameters of lorentzian_model
+    :return: lmfit Parameters - copy with the new initial values
+    """
+    params = params.copy()
+    baseline = float(np.median(y))
+    for name in params:
+        if name.startswith('bkg_') and params[name].vary:
+            params[name].set(value=baseline if name in ('bkg_intercept', 'bkg_c') else 0)
+    i = 1
+    while 'lz%d_center' % i in params:
+        prefix = 'lz%d_' % i
+        height = y[np.argmin(abs(x - params[prefix + 'center'].value))] - baseline
+        # A dip cannot go below 0 counts
+        height = max(height, -0.9 * baseline)
+        params[prefix + 'amplitude'].set(value=height * np.pi * params[prefix + 'sigma'].value)
+        i += 1
+    return params
+
+
+class PoissonFitResult:
+    """
+    Result of poisson_fit with the attributes of an lmfit result that the pages use: params (lmfit Parameters with
+    their standard errors), best_fit, success, nfev, redchi (deviance / degrees of freedom) and fit_report().
+    """
+
+    def __init__(self, params, best_fit, deviance, ndata, nvarys, nfev, success, message):
+        self.params = params
+        self.best_fit = best_fit
+        self.deviance = deviance
+        self.ndata = ndata
+        self.nvarys = nvarys
+        self.nfev = nfev
+        self.success = success
+        self.message = message
+        self.redchi = deviance / max(ndata - nvarys, 1)
+
+    def fit_report(self):
+        lines = ['[[Poisson maximum likelihood]]',
+                 '    function evals   = %d' % self.nfev,
+                 '    data points      = %d' % self.ndata,
+                 '    variables        = %d' % self.nvarys,
+                 '    deviance         = %.6g' % self.deviance,
+                 '    deviance / dof   = %.6g' % self.redchi,
+                 '    ' + self.message,
+                 '[[Variables]]']
+        for name, par in self.params.items():
+            if par.vary:
+                error = ' +/- %.6g' % par.stderr if par.stderr is not None else ''
+                lines.append('    %s: %.6g%s' % (name, par.value, error))
+            else:
+                lines.append('    %s: %.6g (%s)' % (name, par.value, 'fixed' if par.expr is None else par.expr))
+        return '\n'.join(lines)
+
+
+def poisson_fit(model, params, y, x, max_iter=200, tol=1e-6):
+    """
+    Minimise the Poisson deviance of model(x, p) with respect to the counts y.
+
+    :param model: function - model(x, p) -> (model, derivatives), e.g. exp_decay or lorentzian_model(2)
+    :param params: lmfit Parameters - initial values, bounds and fixed parameters (vary=False)
+    :param y: array - counts
+    :param x: array - independent variable
+    :param tol: float - stops when the deviance decreases by less than tol. The deviance is twice a log-likelihood
+    ratio: 1e-6 is far below any statistical meaning.
+    :return: PoissonFitResult
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.asarray(x, dtype=float)
+    params = params.copy()
+    values = {name: par.value for name, par in params.items() if par.expr is None}
+    free = [name for name, par in params.items() if par.vary and par.expr is None]
+    lower = np.array([params[name].min for name in free])
+    upper = np.array([params[name].max for name in free])
+    theta = np.clip(np.array([values[name] for name in free], dtype=float), lower, upper)
+
+    def evaluate(theta):
+        values.update(zip(free, theta))
+        mu, derivatives = model(x, values)
+        return mu, derivatives
+
+    mu, derivatives = evaluate(theta)
+    nfev = 1
+    D = deviance(y, mu)
+    if not np.isfinite(D):
+        raise ValueError('The initial model must be positive wherever there are counts')
+
+    lam = 1e-3
+    success = False
+    message = 'Maximum number of iterations reached'
+    for _ in range(max_iter):
+        J = np.column_stack([derivatives[name] for name in free])
+        gradient = J.T @ (1 - y / mu)
+        fisher = (J / mu[:, None]).T @ J
+        # Solved with the parameters scaled to a unit diagonal: the polynomial backgrounds are nearly collinear on
+        # the narrow energy window of a spectrum
+        scale = np.sqrt(np.diag(fisher)) + 1e-300
+        scaled = fisher / np.outer(scale, scale)
+        while True:
+            try:
+                step = np.linalg.solve(scaled + lam * np.eye(len(free)), -gradient / scale) / scale
+            except np.linalg.LinAlgError:
+                step = np.zeros_like(theta)
+            new_theta = np.clip(theta + step, lower, upper)
+            new_mu, new_derivatives = evaluate(new_theta)
+            nfev += 1
+            new_D = deviance(y, new_mu)
+            if new_D <= D:
+                lam = max(lam / 10, 1e-15)
+                break
+            lam *= 10
+            if lam > 1e10:
+                break
+        if new_D > D:
+            # No step decreases the deviance any more
+            evaluate(theta)
+            success = True
+            message = 'Converged (no better step)'
+            break
+        improvement = D - new_D
+        theta, mu, derivatives, D = new_theta, new_mu, new_derivatives, new_D
+        if improvement <= tol:
+            success = True
+            message = 'Converged'
+            break
+
+    # Standard errors from the Fisher information at the optimum
+    J = np.column_stack([derivatives[name] for name in free])
+    try:
+        covariance = np.linalg.inv((J / mu[:, None]).T @ J)
+        stderr = np.sqrt(np.abs(np.diag(covariance)))
+    except np.linalg.LinAlgError:
+        stderr = np.full(len(free), np.nan)
+    for name, value, error in zip(free, theta, stderr):
+        params[name].value = value
+        params[name].stderr = error
+
+    return PoissonFitResult(params, mu, D, len(y), len(free), nfev, success, message)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Lightweight instrumentation to find out which stage of a page is slow (parsing, peak finding, bootstrap, fit, plot).
+
+    with stage('load'):
+        data = np.loadtxt(file)
+
+    @timed('find_sidepeaks')
+    def find_sidepeaks(data):
+        ...
+
+When profiling is on, each stage records its wall time and its peak memory (tracemalloc). The records belong to
+the thread running the streamlit script, i.e. to one session. Stages running in a background job are timed from
+the page, around show_progress.
+
+The peak of tracemalloc is global to the process: only one run traces the memory at a time, the runs of the other
+sessions that start meanwhile record the wall time only. The allocations of the other threads (their runs, the
+background jobs) still count in the peaks of the traced run.
+
+Profiling is on when the 'Profiling' panel of the sidebar is checked or when FITMYDATA_PROFILE is set:
+    FITMYDATA_PROFILE=json:/path/stages.json        appends the stages of every run as a line of JSON
+    FITMYDATA_PROFILE=cprofile:/path/run.prof       dumps the cProfile statistics of the last run
+
+"""
+
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import streamlit as st
+
+_local = threading.local()
+# Held by the run that traces the memory, from start_run to end_run
+_tracemalloc_lock = threading.Lock()
+
+
+def _state():
+    if not hasattr(_local, 'records'):
+        _local.records = []
+        _local.stack = []
+        _local.enabled = False
+        _local.tracing = False
+        _local.profiler = None
+    return _local
+
+
+def records():
+    """
+    :return: list - dicts with the name, depth, wall time [s] and peak memory [MB] of the stages of the current run,
+    in the order in which they started
+    """
+    return sorted(_state().records, key=lambda record: record['start'])
+
+
+@contextmanager
+def stage(name):
+    state = _state()
+    if not state.enabled:
+        # Nothing is recorded when profiling is off (and in the threads of the background jobs).
+        yield
+        return
+    frame = {'name': name, 'depth': len(state.stack), 'peak': 0}
+    tracing = state.tracing
+    if tracing:
+        frame['start_memory'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    state.stack.append(frame)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        state.stack.pop()
+        record = {'name': name, 'depth': frame['depth'], 'start': t0, 'time': wall}
+        if tracing:
+            # The peak of a nested stage is reset by its children: they report their own peak to the parent.
+            peak = max(tracemalloc.get_traced_memory()[1], frame['peak'])
+            record['peak_memory'] = (peak - frame['start_memory']) / 1e6
+            if state.stack:
+                state.stack[-1]['peak'] = max(state.stack[-1]['peak'], peak)
+        state.records.append(record)
+
+
+def timed(name=None):
+    """
+    Decorator recording a stage each time the function is called.
+
+    :param name: str - name of the stage, by default the name of the function
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _profile_target():
+    # (mode, path) from FITMYDATA_PROFILE, (None, None) if it is not set
+    target = os.environ.get('FITMYDATA_PROFILE', '')
+    if ':' not in target:
+        return None, None
+    mode, path = target.split(':', 1)
+    return mode, path
+
+
+def start_run(enabled=False):
+    """
+    Called at the beginning of each run of the app.
+
+    :param enabled: bool - record the stages (the profiling panel is shown)
+    """
+    state = _state()
+    state.records = []
+    state.stack = []
+    mode, _ = _profile_target()
+    state.enabled = enabled or mode is not None
+
+    # The memory is traced if no other session is tracing it
+    state.tracing = state.enabled and _tracemalloc_lock.acquire(blocking=False)
+    if state.tracing:
+        tracemalloc.start()
+
+    if mode == 'cprofile':
+        state.profiler = cProfile.Profile()
+        try:
+            state.profiler.enable()
+        except ValueError:
+            # Another session is already being profiled
+            state.profiler = None
+
+
+def end_run():
+    # Called at the end of each run of the app, even if the page stopped early.
+    state = _state()
+    mode, path = _profile_target()
+
+    state.enabled = False
+    if state.tracing:
+        state.tracing = False
+        tracemalloc.stop()
+        _tracemalloc_lock.release()
+
+    if state.profiler is not None:
+        state.profiler.disable()
+        state.profiler.dump_stats(path)
+        state.profiler = None
+
+    if mode == 'json':
+        with open(path, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'stages': records()}) + '\n')
+
+
+def show_profile_panel():
+    # Table of the stages of the current run in the sidebar. Call it at the end of the run.
+    stages = records()
+    if not stages:
+        return
+    with st.sidebar.expander('Profiling', expanded=True):
+        lines = []
+        for record in stages:
+            line = ' ' * 4 * record['depth'] + f"{record['name']}: {record['time'] * 1000:.1f} ms"
+            if 'peak_memory' in record:
+                line += f" | {record['peak_memory']:.1f} MB"
+            lines.append(line)
+        st.text('\n'.join(lines))
+        if not any('peak_memory' in record for record in stages):
+            st.caption('Peak memory not recorded: another session was tracing the memory')
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Content-addressed cache for the results of the analyses.
+
+Streamlit reruns the page at every widget change, so the same peak finding, bootstrap, fit or Perceval simulation
+is computed again and again. Decorating a function with @cached('name') stores its results under a key built from
+    (hash of the input data and parameters, name of the analysis, version of the code)
+where the version of the code is a hash of the module of the function and of the modules of the repository it
+imports, directly or not: editing the fit routines of varpro_fit, poisson_fit... invalidates the results of the
+pages that call them.
+
+Two tiers:
+- memory: LRU of the last FITMYDATA_CACHE_ENTRIES results (default 256), shared by all sessions of the server.
+- disk (optional): pickles in FITMYDATA_CACHE_DIR, evicted oldest first when they use more than
+  FITMYDATA_CACHE_SIZE_MB (default 500 MB). Results that cannot be pickled only live in memory.
+
+cache_stats() gives the hits and misses per analysis, show_cache_stats() displays them in the sidebar.
+
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+
+
+def _update_hash(h, obj):
+    # Feed a hashlib object with a canonical representation of obj.
+    if isinstance(obj, np.ndarray):
+        h.update(b'ndarray' + str(obj.dtype).encode() + str(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (bytes, bytearray)):
+        h.update(b'bytes' + bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode() + str(len(obj)).encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update(b'dict' + str(len(obj)).encode())
+        for key in sorted(obj, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif hasattr(obj, 'getvalue'):
+        # file uploaded with streamlit
+        _update_hash(h, obj.getvalue())
+    elif callable(obj):
+        h.update(b'callable' + getattr(obj, '__module__', '').encode() + obj.__qualname__.encode())
+    else:
+        h.update(type(obj).__name__.encode() + repr(obj).encode())
+
+
+def input_hash(*args, **kwargs):
+    """
+    :return: str - hash of the arguments. numpy arrays, uploaded files and nested containers are hashed by content.
+    """
+    h = hashlib.sha256()
+    _update_hash(h, args)
+    _update_hash(h, kwargs)
+    return h.hexdigest()
+
+
+# Directory of the modules of the repository
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _local_modules(module_name, found):
+    # Collect in found (name: path) the module and the modules of the repository that it imports, recursively
+    module = sys.modules.get(module_name)
+    path = getattr(module, '__file__', None)
+    if module_name in found or path is None or os.path.dirname(os.path.abspath(path)) != _REPO_DIR:
+        return
+    found[module_name] = path
+    for value in list(vars(module).values()):
+        # `import varpro_fit` binds the module, `from varpro_fit import varpro_fit` a function of the module
+        name = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+        if isinstance(name, str):
+            _local_modules(name, found)
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(fn):
+    """
+    :param fn: function
+    :return: str - hash of the source files of the module where fn is defined and of the modules of the repository
+    it depends on
+    """
+    found = {}
+    _local_modules(fn.__module__, found)
+    if not found:
+        return 'unknown'
+    h = hashlib.sha256()
+    try:
+        for path in sorted(found.values()):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    except OSError:
+        return 'unknown'
+    return h.hexdigest()[:16]
+
+
+class ResultCache:
+
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_bytes=500e6):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = {}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    def _count(self, name, event):
+        counts = self.stats.setdefault(name, {'memory_hits': 0, 'disk_hits': 0, 'misses': 0})
+        counts[event] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def _disk_files(self):
+        # (last access, path, size) of the cached pickles
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+
+    def get(self, key, name=''):
+        """
+        :return: (bool, object) - (True, result) if key is cached, (False, None) otherwise
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._count(name, 'memory_hits')
+                return True, self._memory[key]
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+                # The modification time is used as last access time for the eviction.
+                os.utime(path)
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                pass
+            else:
+                with self._lock:
+                    self._count(name, 'disk_hits')
+                    self._put_memory(key, value)
+                return True, value
+
+        with self._lock:
+            self._count(name, 'misses')
+        return False, None
+
+    def _put_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_memory(key, value)
+
+        if self.disk_dir is not None:
+            try:
+                content = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # lmfit results with lambdas, Perceval objects...: memory only
+                return
+            path = self._disk_path(key)
+            # Written under a temporary name first: another process never reads half a pickle.
+            tmp_path = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += len(content)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+
+    def _evict_disk(self):
+        # Remove the least recently used pickles until the disk tier fits in max_disk_bytes.
+        # Called with the lock held.
+        files = sorted(self._disk_files())
+        self._disk_bytes = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.stats = {}
+            if self.disk_dir is not None:
+                for _, path, _ in self._disk_files():
+                    os.remove(path)
+                self._disk_bytes = 0
+
+
+_cache = ResultCache(max_entries=int(os.environ.get('FITMYDATA_CACHE_ENTRIES', 256)),
+                     disk_dir=os.environ.get('FITMYDATA_CACHE_DIR'),
+                     max_disk_bytes=float(os.environ.get('FITMYDATA_CACHE_SIZE_MB', 500)) * 1e6)
+
+
+def cached(name):
+    """
+    Decorator caching the results of an analysis.
+
+    :param name: str - name of the analysis, used in the key and in the statistics
+    The keyword argument `job` (progress handle given by job_queue) is not part of the key.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key_kwargs = {k: v for k, v in kwargs.items() if k != 'job'}
+            key = hashlib.sha256((name + ':' + code_version(fn) + ':' +
+                                  input_hash(*args, **key_kwargs)).encode()).hexdigest()
+            hit, value = _cache.get(key, name)
+            if hit:
+                return value
+            value = fn(*args, **kwargs)
+            _cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def cache_stats():
+    """
+    :return: dict - for each analysis, the number of memory hits, disk hits and misses
+    """
+    with _cache._lock:
+        stats = {name: dict(counts) for name, counts in _cache.stats.items()}
+        stats['total'] = {'memory_entries': len(_cache._memory),
+                          'disk_MB': _cache._disk_bytes / 1e6}
+    return stats
+
+
+def show_cache_stats():
+    # Sidebar panel to tune the size of the cache
+    with st.sidebar.expander('Cache statistics'):
+        stats = cache_stats()
+        total = stats.pop('total')
+        st.write(f"{total['memory_entries']} results in memory, {total['disk_MB']:.1f} MB on disk")
+        for name, counts in stats.items():
+            calls = counts['memory_hits'] + counts['disk_hits'] + counts['misses']
+            st.write(f"{name}: {counts['memory_hits']} memory hits, {counts['disk_hits']} disk hits, "
+                     f"{counts['misses']} misses ({100 * (calls - counts['misses']) / calls:.0f} % hit rate)")
+        if st.button('Clear cache'):
+            _cache.clear()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Helpers to keep every intermediate artifact of a page private to the streamlit session that created it.
+
+Several users share the same server, so nothing must be written under a fixed name in os.getcwd():
+- uploaded files that have to be handed to a library expecting a path (readPTU) are spooled to a unique
+  temporary file that is removed as soon as we are done with it.
+- figures and tables offered for download are rendered in memory.
+
+"""
+
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+
+import streamlit as st
+
+
+@contextmanager
+def uploaded_file_path(streamlit_file, suffix=''):
+    """
+    :param streamlit_file: file uploaded with st.file_uploader (or any object with a read() method)
+    :param suffix: str - extension of the temporary file, e.g. '.ptu'
+    :return: str - path of a unique temporary copy of the file, deleted when leaving the context
+    """
+    # mkstemp gives a name that no other session can get. The file is closed before yielding so that
+    # the path can be reopened by C libraries, also on Windows.
+    fd, local_path = tempfile.mkstemp(suffix=suffix, prefix='fitmydata_')
+    try:
+        with os.fdopen(fd, 'wb') as binary_file:
+            streamlit_file.seek(0)
+            binary_file.write(streamlit_file.read())
+        yield local_path
+    finally:
+        os.remove(local_path)
+
+
+def fig_to_bytes(fig, fmt='pdf'):
+    """
+    :param fig: matplotlib figure
+    :param fmt: str - any format supported by savefig
+    :return: bytes - the rendered figure
+    """
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt, bbox_inches='tight')
+    return buffer.getvalue()
+
+
+def download_plot(fig, file_name=None, output_name=None):
+    """
+    Render a matplotlib figure in memory and show a download button for it.
+
+    :param fig: matplotlib figure
+    :param file_name: str - name of the uploaded file, its 4 last characters (extension) are replaced by .pdf
+    :param output_name: str - name of the downloaded file, used as is instead of file_name (plot of several files)
+    :return: bool - True if the button was clicked
+    """
+    return st.download_button(label="Save plot",
+                              data=fig_to_bytes(fig, fmt='pdf'),
+                              file_name=output_name or file_name[:-4] + ".pdf",
+                              mime="application/pdf")
+
+
+def download_table(table, file_name):
+    """
+    Write a DataFrame to Parquet in memory and show a download button for it.
+
+    :param table: DataFrame
+    :param file_name: str - name of the uploaded file, its 4 last characters (extension) are replaced by .parquet
+    :return: bool - True if the button was clicked
+    """
+    buffer = io.BytesIO()
+    table.to_parquet(buffer, index=False)
+    return st.download_button(label="Save table",
+                              data=buffer.getvalue(),
+                              file_name=file_name[:-4] + ".parquet",
+                              mime="application/octet-stream")
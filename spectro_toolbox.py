@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Tools for the spectra of the CCD spectrometers (reflectivity and PL pages).
+
+Calibration of the spectrometer: the wavelength of the pixel px is
+    WL = spectro - (center_px - px) / calib         [nm]
+where spectro is the wavelength of the central pixel and calib the dispersion in px/nm. The axes of a calibration
+are computed once (vectorized) and shared by all the runs of the pages and all the frames of a file:
+get_calibration(spectro, calib, nb_px).eV
+
+Ranges are looked up with searchsorted on the monotonic axes instead of scanning for values within a tolerance.
+
+Reading of the files:
+- read_redback_csv: only the wavelength and signal columns of the RS40k (Redback) CSV files are parsed, by the C
+  engine of pandas, and the arrays are cached (result_cache): the reruns of the page do not parse the file again.
+- Winspec ASCII exports with 'One File For All Frames' (Pixel, Intensity): iter_winspec_frames parses the file by
+  blocks of frames, so that a kinetic series of thousands of frames is never held as text or as a DataFrame.
+  load_winspec_frames keeps the frames as a float32 stack (n_frames, nb_px).
+- binary .spe files (from_SPE) are read without export, with a region of interest and vertical binning.
+load_frames reads any of these files for the pages.
+
+show_batch displays the table of a batch fit (cavity_toolbox.fit_cav_batch) or of the tracked modes
+(mode_tracker.track_modes) in the reflectivity and PL pages.
+
+"""
+
+import functools
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import plotly.graph_objects as go
+
+from result_cache import cached
+from from_SPE import open_spe, get_spe_fromfile
+from cavity_toolbox import batch_map
+from session_toolbox import download_table
+
+# h*c in eV.nm, as in the rest of the app
+HC = 1239.8
+
+# Lines of the header of the Redback CSV files (the line 13 has the names of the columns) and columns that are used
+REDBACK_SKIPROWS = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14]
+REDBACK_COLUMNS = ('# wavelength', ' signal')
+
+
+class Calibration:
+
+    def __init__(self, spectro, calib, nb_px=1340, center_px=670):
+        """
+        :param spectro: float - wavelength of the central pixel [nm]
+        :param calib: float - dispersion [px/nm]
+        :param nb_px: int - number of pixels of the camera (horizontal axis)
+        :param center_px: int - central pixel (pixels are numbered from 1)
+        """
+        self.spectro = spectro
+        self.calib = calib
+        self.nb_px = nb_px
+        self.center_px = center_px
+
+    def __repr__(self):
+        return 'Calibration(%r, %r, nb_px=%r, center_px=%r)' % (self.spectro, self.calib, self.nb_px, self.center_px)
+
+    def px_to_nm(self, px):
+        return self.spectro - (self.center_px - np.asarray(px)) / self.calib
+
+    def px_to_eV(self, px):
+        return HC / self.px_to_nm(px)
+
+    @functools.cached_property
+    def px(self):
+        return _read_only(np.arange(1, self.nb_px + 1))
+
+    @functools.cached_property
+    def nm(self):
+        return _read_only(self.px_to_nm(self.px))
+
+    @functools.cached_property
+    def eV(self):
+        return _read_only(HC / self.nm)
+
+
+def _read_only(array):
+    # The axes are shared: nobody should modify them in place
+    array.setflags(write=False)
+    return array
+
+
+@functools.lru_cache(maxsize=32)
+def get_calibration(spectro, calib, nb_px=1340, center_px=670):
+    """
+    :return: Calibration - the same object (and the same axes) for the same parameters
+    """
+    return Calibration(spectro, calib, nb_px, center_px)
+
+
+def nm_to_eV(nm):
+    return HC / np.asarray(nm, dtype=float)
+
+
+def eV_to_nm(eV):
+    return HC / np.asarray(eV, dtype=float)
+
+
+def nearest_index(axis, value):
+    """
+    Index of the point of a monotonic axis (increasing or decreasing) closest to value(s).
+    Values outside of the axis give the first or last index.
+
+    :param axis: array - monotonic axis
+    :param value: float or array
+    :return: int or array of int
+    """
+    axis = np.asarray(axis)
+    descending = axis[-1] < axis[0]
+    ascending_axis = axis[::-1] if descending else axis
+    i = np.clip(np.searchsorted(ascending_axis, value), 1, len(axis) - 1)
+    # closest of the two neighbours
+    i = i - (np.abs(value - ascending_axis[i - 1]) <= np.abs(ascending_axis[i] - value))
+    i = len(axis) - 1 - i if descending else i
+    return int(i) if np.ndim(i) == 0 else i
+
+
+def index_range(axis, start, stop):
+    """
+    :param axis: array - monotonic axis
+    :param start, stop: float - limits of the range, in any order
+    :return: int, int - first and last indices of the range, first < last
+    """
+    i, j = nearest_index(axis, start), nearest_index(axis, stop)
+    return int(min(i, j)), int(max(i, j))
+
+
+def _rewind(file):
+    # Uploaded files are read again at each rerun, paths are opened by pandas
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return file
+
+
+@cached('redback_csv')
+def read_redback_csv(file):
+    """
+    :param file: uploaded .csv file of the RS40k spectrometer, or its path
+    :return: array, array - wavelength [nm] and signal
+    """
+    df = pd.read_csv(_rewind(file), delimiter=',', skiprows=REDBACK_SKIPROWS, usecols=list(REDBACK_COLUMNS),
+                     dtype=float, engine='c')
+    return df[REDBACK_COLUMNS[0]].to_numpy(), df[REDBACK_COLUMNS[1]].to_numpy()
+
+
+def iter_winspec_frames(file, nb_px, frames_per_block=64):
+    """
+    Parse a Winspec ASCII export (Pixel, Intensity, one file for all frames) block by block.
+
+    :param file: uploaded .txt file or its path
+    :param nb_px: int - number of pixels of a frame
+    :param frames_per_block: int - number of frames parsed at once
+    :return: generator of float32 arrays (n, nb_px) - the frames. An incomplete last frame is dropped.
+    """
+    reader = pd.read_csv(_rewind(file), sep=r'\s+', header=None, usecols=[1], dtype=np.float32,
+                         engine='c', chunksize=nb_px * frames_per_block)
+    for block in reader:
+        intensity = block[1].to_numpy()
+        n_frames = len(intensity) // nb_px
+        if n_frames:
+            yield intensity[:n_frames * nb_px].reshape(n_frames, nb_px)
+
+
+@cached('winspec_frames')
+def load_winspec_frames(file, nb_px):
+    """
+    :param file: uploaded .txt file or its path
+    :param nb_px: int - number of pixels of a frame
+    :return: array - float32 stack of the frames (n_frames, nb_px)
+    """
+    blocks = list(iter_winspec_frames(file, nb_px))
+    if not blocks:
+        raise ValueError('The file has less than %d lines: check the number of pixels of the camera' % nb_px)
+    return np.concatenate(blocks)
+
+
+def load_frames(file, nb_px):
+    """
+    Frames of a Winspec ASCII export (.txt) or of a binary .spe file, for the pages. For a .spe file the rows of the
+    region of interest are chosen in the sidebar and summed (vertical binning).
+
+    :param file: uploaded file or path
+    :param nb_px: int - number of pixels of a frame of a .txt file (a .spe file has it in its header)
+    :return: array - (n_frames, n_px)
+    """
+    name = file if isinstance(file, str) else file.name
+    if not name.lower().endswith('.spe'):
+        return load_winspec_frames(file, nb_px)
+
+    header, _ = open_spe(file)
+    with st.sidebar.expander("CCD region of interest"):
+        first_row = st.number_input('First row', value=0, min_value=0, max_value=header['ydim'] - 1)
+        last_row = st.number_input('Last row', value=header['ydim'] - 1, min_value=first_row,
+                                   max_value=header['ydim'] - 1)
+    spectra, _ = get_spe_fromfile(file, rows=(first_row, last_row + 1))
+    return spectra
+
+
+def show_batch(table, file_name):
+    """
+    Plots of xc, κ and Q of a batch fit (images for a map, curves for a series, one per mode for the tracked modes)
+    and the table.
+
+    :param table: DataFrame - returned by fit_cav_batch or track_modes
+    :param file_name: str - name of the uploaded file, used for the Parquet file
+    """
+    scales = {'xc': (1, 'xc [eV]'), 'kappa': (1e6, 'κ [µeV]'), 'Q': (1, 'Q')}
+    for name, (scale, label) in scales.items():
+        fig = go.Figure(layout=go.Layout(plot_bgcolor='whitesmoke'))
+        if 'row' in table:
+            fig.add_trace(go.Heatmap(z=scale * batch_map(table, name), colorbar=dict(title=label)))
+            fig.update_layout(xaxis_title="Column", yaxis_title="Row")
+        else:
+            for mode, trajectory in (table.groupby('mode') if 'mode' in table else [(1, table)]):
+                fig.add_trace(go.Scatter(
+                    x=trajectory['spectrum'],
+                    y=scale * trajectory[name],
+                    error_y=dict(type='data', array=scale * trajectory[name + '_err']),
+                    name="Mode %d" % mode,
+                    mode='markers',
+                    marker=dict(size=6)
+                ))
+            fig.update_layout(xaxis_title="Frame", yaxis_title=label)
+        fig.update_layout(title=label, width=800, height=400, margin=dict(l=40, r=40, b=40, t=40))
+        st.plotly_chart(fig)
+
+    converged = table['success'] if 'success' in table else table['found']
+    st.write('%d / %d fits converged' % (converged.sum(), len(table)))
+    st.dataframe(table)
+    download_table(table, file_name)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Uncertainties of the lmfit fits of the app (lifetime, cavity modes, PL lines) beyond the covariance matrix.
+
+- bootstrap: the fit is repeated on resampled data. 'residual' adds the residuals of the fit, drawn with replacement,
+  to the best fit. 'poisson' draws counts from the best fit.
+- profile_likelihood: the chi-square is minimised with one parameter fixed on a grid of values. The interval is
+  where it increases by less than the reduced chi-square of the best fit (1 sigma).
+
+lmfit conf_interval finds the limits one after the other. Here all the fits are independent: they run in a pool of
+processes, the data arrays being shared with the workers through shared memory. Derived quantities (Q, FSS...) are
+added as lmfit expressions and get their distribution from the bootstrap.
+
+    inputs = fit_inputs(result, derived={'Q': 'lz1_center/(2*lz1_sigma)'})
+    errors = bootstrap(*inputs, n_boot=500, method='poisson', job=job)
+
+Both functions take a `job` argument (job_queue) and report their progress through it. show_uncertainties() does
+all of this from a page. The pool and the shared memory helpers (get_pool, SharedArrays, attach_shared, run_tasks)
+are also used by the batch fits of cavity_toolbox, iter_tasks by the Perceval sweeps of imperfect_SPS.
+
+"""
+
+import contextlib
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from lmfit.model import Model
+
+from job_queue import submit, show_progress, JobCancelled
+from result_cache import cached
+from profiling import stage
+
+# Lower and upper quantiles of a 1 sigma interval
+ONE_SIGMA = (15.865, 84.135)
+
+# Linewidth and quality factor of the first Lorentzian of the cavity and PL fits
+LORENTZIAN_DERIVED = {'kappa': '2*lz1_sigma', 'Q': 'lz1_center/(2*lz1_sigma)'}
+LORENTZIAN_SCALES = {'lz1_center': (1, 'eV'), 'kappa': (1e6, 'µeV'), 'Q': (1, '')}
+
+_pool = None
+
+
+def get_pool():
+    # Created at the first use. The streamlit server runs many threads: the workers are spawned rather than forked.
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 4,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def fit_inputs(result, derived=None):
+    """
+    What is needed to repeat a fit, in a form that can be sent to other processes.
+
+    :param result: lmfit ModelResult
+    :param derived: dict - name: lmfit expression of a quantity computed from the parameters (Q, FSS...)
+    :return: tuple - (model, params, data, independent variables, fit keywords)
+    """
+    # The copy keeps the standard errors of the fit
+    params = result.params.copy()
+    for name, expr in (derived or {}).items():
+        params.add(name, expr=expr)
+    fit_kws = dict(getattr(result, 'kws', None) or {})
+    return result.model, params, np.asarray(result.data, dtype=float), dict(result.userkws), fit_kws
+
+
+def _model_state(model):
+    # The composite models cannot be pickled: they are sent as JSON with the functions that are not lmfit lineshapes.
+    funcdefs = {component.func.__name__: component.func for component in model.components
+                if not component.func.__module__.startswith('lmfit')}
+    return model.dumps(), funcdefs
+
+
+def _load_model(state):
+    dumped, funcdefs = state
+    return Model(lambda x: x).loads(dumped, funcdefs=funcdefs)
+
+
+class SharedArrays:
+    # Copies arrays to shared memory blocks, released when leaving the with block.
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.descriptors = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array, dtype=float)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=float, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.descriptors[name] = (block.name, array.shape)
+
+    def __enter__(self):
+        return self.descriptors
+
+    def __exit__(self, *exc):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+@contextlib.contextmanager
+def attach_shared(descriptors):
+    """
+    Read-only views of the shared arrays in a worker, nothing is copied. The blocks are closed when leaving the with
+    block: the views must not be used after it.
+
+        with attach_shared(descriptors) as arrays:
+            ...
+    """
+    blocks, arrays = [], {}
+    try:
+        for name, (block_name, shape) in descriptors.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype=float, buffer=block.buf)
+            arrays[name].flags.writeable = False
+        yield arrays
+    finally:
+        # The views hold the buffers of the blocks: they are released before closing them
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+
+def _refit(model, params, data, arrays, fit_kws, fixed=None):
+    # :return: (values of all the parameters, chi-square), NaN if the fit fails
+    params = params.copy()
+    if fixed is not None:
+        name, value = fixed
+        params[name].set(value=value, vary=False)
+    independent = {name: arrays[name] for name in model.independent_vars}
+    try:
+        result = model.fit(data, params, fit_kws=fit_kws, **independent)
+    except Exception:
+        return np.full(len(params), np.nan), np.nan
+    return np.array([result.params[name].value for name in params]), result.chisqr
+
+
+def _bootstrap_chunk(state, params, descriptors, fit_kws, method, seed, n):
+    model = _load_model(state)
+    rng = np.random.default_rng(seed)
+    samples = np.empty((n, len(params)))
+    with attach_shared(descriptors) as arrays:
+        best_fit = arrays['best_fit']
+        residuals = arrays['data'] - best_fit
+        for i in range(n):
+            if method == 'poisson':
+                data = rng.poisson(np.clip(best_fit, 0, None)).astype(float)
+            else:
+                data = best_fit + rng.choice(residuals, len(residuals), replace=True)
+            samples[i] = _refit(model, params, data, arrays, fit_kws)[0]
+    return samples
+
+
+def _profile_point(state, params, descriptors, fit_kws, name, value):
+    model = _load_model(state)
+    with attach_shared(descriptors) as arrays:
+        return _refit(model, params, arrays['data'], arrays, fit_kws, fixed=(name, value))[1]
+
+
+def iter_tasks(fn, tasks, job=None):
+    """
+    Run fn(*task) for each task in the process pool.
+
+    :return: generator - (index of the task, result), in the order in which the tasks finish
+    """
+    pool = get_pool()
+    futures = {pool.submit(fn, *task): i for i, task in enumerate(tasks)}
+    pending = set(futures)
+    try:
+        while pending:
+            finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield futures[future], future.result()
+            if job is not None:
+                job.set_progress(1 - len(pending) / len(tasks))
+    except (JobCancelled, GeneratorExit):
+        for future in pending:
+            future.cancel()
+        raise
+
+
+def run_tasks(fn, tasks, job=None):
+    """
+    Run fn(*task) for each task in the process pool.
+
+    :return: list - the results in the order of the tasks
+    """
+    results = [None] * len(tasks)
+    for i, result in iter_tasks(fn, tasks, job):
+        results[i] = result
+    return results
+
+
+def _shared_inputs(model, params, data, independent):
+    # Arrays to share with the workers: data, best fit and independent variables
+    arrays = {'data': data, 'best_fit': model.eval(params, **independent)}
+    for name in model.independent_vars:
+        arrays[name] = independent[name]
+    return arrays
+
+
+@cached('bootstrap')
+def bootstrap(model, params, data, independent, fit_kws=None, n_boot=200, method='residual', seed=0, job=None):
+    """
+    :param model, params, data, independent, fit_kws: returned by fit_inputs
+    :param n_boot: int - number of resampled fits
+    :param method: str - 'residual' or 'poisson'
+    :param seed: int - seed of the random generator
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: dict - for each parameter: 'value' (best fit), 'std', 'low' and 'high' (1 sigma quantiles),
+    computed from the fits that converged
+    """
+    state = _model_state(model)
+    n_chunks = min(n_boot, 4 * (os.cpu_count() or 4))
+    sizes = np.diff(np.linspace(0, n_boot, n_chunks + 1).astype(int))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+
+    with SharedArrays(_shared_inputs(model, params, data, independent)) as descriptors:
+        chunks = run_tasks(_bootstrap_chunk, [(state, params, descriptors, fit_kws or {}, method, s, n)
+                                               for s, n in zip(seeds, sizes)], job)
+    samples = np.concatenate(chunks)
+
+    errors = {}
+    for j, name in enumerate(params):
+        values = samples[:, j][np.isfinite(samples[:, j])]
+        low, high = np.percentile(values, ONE_SIGMA) if len(values) else (np.nan, np.nan)
+        errors[name] = {'value': params[name].value, 'std': np.std(values) if len(values) else np.nan,
+                        'low': low, 'high': high}
+    return errors
+
+
+@cached('profile_likelihood')
+def profile_likelihood(model, params, data, independent, fit_kws=None, name='tau', n_points=21, n_sigma=4.,
+                       job=None):
+    """
+    :param model, params, data, independent, fit_kws: returned by fit_inputs
+    :param name: str - parameter to profile, must be a parameter that is fitted
+    :param n_points: int - number of values on the grid
+    :param n_sigma: float - half width of the grid in standard errors of the fit
+    :param job: Job - optional, to report the progress when run by job_queue
+    :return: dict - 'value', 'low' and 'high' (1 sigma interval, NaN if it is not in the grid), 'grid' and 'chisqr'
+    """
+    best = params[name].value
+    stderr = params[name].stderr if params[name].stderr else 0.5 * abs(best)
+    grid = best + n_sigma * stderr * np.linspace(-1, 1, n_points)
+    grid = grid[(grid > params[name].min) & (grid < params[name].max)]
+
+    arrays = _shared_inputs(model, params, data, independent)
+    chisqr_best = np.sum((arrays['data'] - arrays['best_fit'])**2)
+    n_free = len(data) - sum(par.vary and par.expr is None for par in params.values())
+    threshold = chisqr_best + chisqr_best / max(n_free, 1)
+
+    state = _model_state(model)
+    with SharedArrays(arrays) as descriptors:
+        chisqr = np.array(run_tasks(_profile_point, [(state, params, descriptors, fit_kws or {}, name, value)
+                                                      for value in grid], job), dtype=float)
+
+    # Crossing of the threshold on each side of the minimum, interpolated linearly
+    low = high = np.nan
+    below = grid <= best
+    above = grid >= best
+    if np.any(chisqr[below] > threshold):
+        i = np.nonzero(below & (chisqr > threshold))[0][-1]
+        low = np.interp(threshold, [chisqr[i + 1], chisqr[i]], [grid[i + 1], grid[i]])
+    if np.any(chisqr[above] > threshold):
+        i = np.nonzero(above & (chisqr > threshold))[0][0]
+        high = np.interp(threshold, [chisqr[i - 1], chisqr[i]], [grid[i - 1], grid[i]])
+    return {'value': best, 'low': low, 'high': high, 'grid': grid, 'chisqr': chisqr}
+
+
+def show_uncertainties(result, names, derived=None, profile=(), scales=None, key=''):
+    """
+    Sidebar options to compute bootstrap and profile likelihood errors for a fit, and table of the results.
+
+    :param result: lmfit ModelResult
+    :param names: list - parameters and derived quantities to display
+    :param derived: dict - name: lmfit expression of the derived quantities
+    :param profile: list - fitted parameters that can be profiled
+    :param scales: dict - name: (factor, unit) for the display
+    :param key: str - to make the widgets unique in the page
+    """
+    if not hasattr(result, 'model'):
+        # Poisson likelihood fits: the errors come from the Fisher information (see the fit report)
+        return
+    use_bootstrap = st.sidebar.checkbox('Bootstrap errors', key='bootstrap' + key)
+    use_profile = st.sidebar.checkbox('Profile likelihood', key='profile' + key) if profile else False
+    if not use_bootstrap and not use_profile:
+        return
+
+    inputs = fit_inputs(result, derived)
+    scales = scales or {}
+    rows = {}
+    for name in names:
+        factor, unit = scales.get(name, (1, ''))
+        stderr = inputs[1][name].stderr
+        rows[name] = {'value': inputs[1][name].value * factor,
+                      'covariance error': stderr * factor if stderr is not None else np.nan,
+                      'unit': unit}
+
+    if use_bootstrap:
+        method = st.sidebar.radio('Resampling', ('poisson', 'residual'), key='method' + key,
+                                  help='poisson for counts, residual otherwise')
+        n_boot = st.sidebar.number_input('Number of resampled fits', 10, 10000, 200, key='n_boot' + key)
+        with stage('bootstrap'):
+            errors = show_progress(submit(bootstrap, *inputs, n_boot=n_boot, method=method),
+                                   'Bootstrapping the fit...')
+        if errors is not None:
+            for name in names:
+                factor = scales.get(name, (1, ''))[0]
+                rows[name].update({'bootstrap std': errors[name]['std'] * factor,
+                                   'bootstrap low': errors[name]['low'] * factor,
+                                   'bootstrap high': errors[name]['high'] * factor})
+
+    if use_profile:
+        for name in profile:
+            with stage('profile'):
+                interval = show_progress(submit(profile_likelihood, *inputs, name=name),
+                                         'Profiling ' + name + '...')
+            if interval is not None and name in rows:
+                factor = scales.get(name, (1, ''))[0]
+                rows[name].update({'profile low': interval['low'] * factor,
+                                   'profile high': interval['high'] * factor})
+
+    st.write('Uncertainties (1 sigma)')
+    st.table(pd.DataFrame(rows).T)
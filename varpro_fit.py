@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+@Authors: Mathias Pont
+@Contributors:
+
+Variable projection fits of Lorentzian lines on a polynomial background (fit_cav, fit_lines, cavity_toolbox).
+
+The model
+    y = bkg(x) + sum_i amplitude_i * sigma_i / (pi * ((x - center_i)² + sigma_i²))
+is linear in the background coefficients and in the amplitudes. For given centers and widths θ these are the linear
+least squares solution α(θ) = Φ(θ)⁺ y, Φ being the matrix of the basis functions (1, x, x², one Lorentzian shape
+per line). Only θ is left to the nonlinear solver, which minimises the projected residual
+    r(θ) = y - Φ(θ) α(θ) = (I - P(θ)) y
+with the Jacobian of Kaufman: J = -(I - P) dΦ/dθ α. There are half as many nonlinear parameters as in lmfit, and no
+wrong initial amplitude or background to recover from: it converges in a few iterations.
+
+The parameters have the names of the lmfit models of the app (LinearModel or QuadraticModel with prefix 'bkg_',
+LorentzianModel with prefix 'lz%d_'), so that the result can be used as an lmfit result:
+
+    result = varpro_fit(params, ydat_fit, xdat_fit, background='linear')
+    model.eval(result.params, x=xdat)
+
+"""
+
+from math import comb
+
+import numpy as np
+from scipy.optimize import least_squares
+
+# Background parameters, in the order of the powers of x
+BACKGROUNDS = {'linear': ('bkg_intercept', 'bkg_slope'),
+               'quadratic': ('bkg_c', 'bkg_b', 'bkg_a')}
+
+
+class VarProResult:
+    """
+    Result of varpro_fit with the attributes of an lmfit result that the pages use: params (lmfit Parameters with
+    their standard errors), best_fit, chisqr, redchi, nfev, success and fit_report(). When varpro_fit is given the
+    lmfit model, it also has model, data and userkws, so that uncertainty can repeat the fit.
+    """
+
+    def __init__(self, params, best_fit, chisqr, ndata, nvarys, nfev, success, message):
+        self.params = params
+        self.best_fit = best_fit
+        self.chisqr = chisqr
+        self.ndata = ndata
+        self.nvarys = nvarys
+        self.nfev = nfev
+        self.success = success
+        self.message = message
+        self.redchi = chisqr / max(ndata - nvarys, 1)
+
+    def fit_report(self):
+        lines = ['[[Variable projection]]',
+                 '    function evals   = %d' % self.nfev,
+                 '    data points      = %d' % self.ndata,
+                 '    variables        = %d' % self.nvarys,
+                 '    chi-square       = %.6g' % self.chisqr,
+                 '    reduced chi-sq   = %.6g' % self.redchi,
+                 '    ' + self.message,
+                 '[[Variables]]']
+        for name, par in self.params.items():
+            if par.vary:
+                error = ' +/- %.6g' % par.stderr if par.stderr is not None else ''
+                lines.append('    %s: %.6g%s' % (name, par.value, error))
+            else:
+                lines.append('    %s: %.6g (fixed)' % (name, par.value))
+        return '\n'.join(lines)
+
+
+def _lorentzian(x, center, sigma):
+    # Shape of unit area and its derivatives with respect to the center and the width
+    d = x - center
+    denominator = d**2 + sigma**2
+    shape = sigma / (np.pi * denominator)
+    return shape, shape * 2 * d / denominator, (d**2 - sigma**2) / (np.pi * denominator**2)
+
+
+def varpro_fit(params, y, x, background='linear', model=None, ftol=1e-10, max_nfev=200):
+    """
+    Least squares fit of Lorentzians on a polynomial background by variable projection.
+
+    :param params: lmfit Parameters - of the background ('linear' or 'quadratic') and of the Lorentzians lz1_, lz2_...
+    Only the centers and widths need initial values. Centers, widths and amplitudes with vary=False keep their
+    value, the background is always fitted and expressions are ignored.
+    :param y: array - data
+    :param x: array - independent variable
+    :param background: str - 'linear' or 'quadratic'
+    :param model: lmfit Model - optional, the same model as an lmfit composite model, kept in the result
+    :param ftol: float - relative decrease of the chi-square at convergence (scipy least_squares)
+    :param max_nfev: int - maximum number of evaluations of the projected residual
+    :return: VarProResult
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.asarray(x, dtype=float)
+    params = params.copy()
+
+    n_peaks = 0
+    while 'lz%d_center' % (n_peaks + 1) in params:
+        n_peaks += 1
+    powers = BACKGROUNDS[background]
+
+    # Linear parameters: basis functions of the background then the Lorentzians. The fixed ones are subtracted.
+    linear = list(powers) + ['lz%d_amplitude' % i for i in range(1, n_peaks + 1)]
+    free_linear = [j for j, name in enumerate(linear) if name in powers or params[name].vary]
+    fixed_linear = [j for j in range(len(linear)) if j not in free_linear]
+
+    # The background is fitted in powers of t = (x - x0) / scale: on the narrow energy window of a spectrum 1, x and
+    # x² are nearly collinear. to_powers_of_x converts the coefficients back (coefficient of x^j = sum over k).
+    x0, scale = np.mean(x), max(np.ptp(x) / 2, 1e-300)
+    t = (x - x0) / scale
+    to_powers_of_x = np.eye(len(linear))
+    for k in range(len(powers)):
+        for j in range(k + 1):
+            to_powers_of_x[j, k] = comb(k, j) * (-x0)**(k - j) / scale**k
+    nonlinear = [name for i in range(1, n_peaks + 1) for name in ('lz%d_center' % i, 'lz%d_sigma' % i)
+                 if params[name].vary]
+    lower = np.array([params[name].min for name in nonlinear])
+    upper = np.array([params[name].max for name in nonlinear])
+
+    def basis(theta):
+        values = {name: params[name].value for name in params}
+        values.update(zip(nonlinear, theta))
+        columns, derivatives = [t**k for k in range(len(powers))], {}
+        for i in range(1, n_peaks + 1):
+            shape, d_center, d_sigma = _lorentzian(x, values['lz%d_center' % i], values['lz%d_sigma' % i])
+            columns.append(shape)
+            derivatives['lz%d_center' % i] = (len(powers) + i - 1, d_center)
+            derivatives['lz%d_sigma' % i] = (len(powers) + i - 1, d_sigma)
+        Phi = np.column_stack(columns)
+        target = y - Phi[:, fixed_linear] @ np.array([params[linear[j]].value for j in fixed_linear]) \
+            if fixed_linear else y
+        return Phi, derivatives, target
+
+    # The last evaluation is shared by the residual and the Jacobian
+    last = {}
+
+    def evaluate(theta):
+        if last.get('theta') is None or not np.array_equal(last['theta'], theta):
+            Phi, derivatives, target = basis(theta)
+            Q, R = np.linalg.qr(Phi[:, free_linear])
+            alpha = np.linalg.lstsq(R, Q.T @ target, rcond=None)[0]
+            # amplitudes and background in powers of t
+            coefficients = np.array([params[name].value for name in linear], dtype=float)
+            coefficients[free_linear] = alpha
+            residual = target - Phi[:, free_linear] @ alpha
+            last.update(theta=np.array(theta), Phi=Phi, derivatives=derivatives, Q=Q,
+                        coefficients=coefficients, residual=residual)
+        return last
+
+    def residual(theta):
+        return evaluate(theta)['residual']
+
+    def jacobian(theta):
+        state = evaluate(theta)
+        Q = state['Q']
+        J = np.empty((len(x), len(nonlinear)))
+        for k, name in enumerate(nonlinear):
+            column, derivative = state['derivatives'][name]
+            v = state['coefficients'][column] * derivative
+            # Kaufman: the derivative of the optimal linear parameters is neglected
+            J[:, k] = -(v - Q @ (Q.T @ v))
+        return J
+
+    theta0 = np.clip(np.array([params[name].value for name in nonlinear], dtype=float), lower, upper)
+    if len(nonlinear):
+        solution = least_squares(residual, theta0, jac=jacobian, bounds=(lower, upper), method='trf',
+                                 x_scale='jac', ftol=ftol, max_nfev=max_nfev)
+        theta, nfev, success, message = solution.x, solution.nfev, solution.status > 0, solution.message
+    else:
+        theta, nfev, success, message = theta0, 1, True, 'Only linear parameters'
+    state = evaluate(theta)
+
+    for name, value in zip(nonlinear, theta):
+        params[name].value = value
+    for name, value in zip(linear, to_powers_of_x @ state['coefficients']):
+        params[name].value = value
+
+    # Standard errors from the full Jacobian of the model, scaled by the reduced chi-square as lmfit does
+    columns = [state['Phi'][:, j] for j in free_linear]
+    for name in nonlinear:
+        column, derivative = state['derivatives'][name]
+        columns.append(state['coefficients'][column] * derivative)
+    names = [linear[j] for j in free_linear] + nonlinear
+    chisqr = float(np.sum(state['residual']**2))
+    result = VarProResult(params, y - state['residual'], chisqr, len(y), len(names), nfev, success, message)
+    J = np.column_stack(columns)
+    transform = np.eye(len(names))
+    transform[:len(free_linear), :len(free_linear)] = to_powers_of_x[np.ix_(free_linear, free_linear)]
+    try:
+        covariance = transform @ np.linalg.inv(J.T @ J) @ transform.T * result.redchi
+        stderr = np.sqrt(np.abs(np.diag(covariance)))
+    except np.linalg.LinAlgError:
+        stderr = np.full(len(names), np.nan)
+    for name, error in zip(names, stderr):
+        params[name].stderr = error
+
+    if model is not None:
+        result.model, result.data, result.userkws = model, y, {'x': x}
+    return result